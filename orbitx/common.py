@@ -140,6 +140,18 @@ def savefile(name: str) -> Path:
     return PROGRAM_PATH / 'data' / 'saves' / name
 
 
+def ephemeris_file(name: str) -> Path:
+    return PROGRAM_PATH / 'data' / 'ephemerides' / name
+
+
+def ensemble_file(name: str) -> Path:
+    return PROGRAM_PATH / 'data' / 'ensembles' / name
+
+
+def session_file(name: str) -> Path:
+    return PROGRAM_PATH / 'data' / 'sessions' / name
+
+
 def load_savefile(file: Path) -> 'data_structures.PhysicsState':
     """Loads the physics state represented by the input file.
     If the input file is an OrbitX-style .json file, simply loads it.
@@ -6,7 +6,7 @@ online, but mainly they're helpful for serializing data over the network."""
 
 import logging
 from enum import Enum
-from typing import List, Dict, Optional, Union
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
 import vpython
@@ -29,6 +29,9 @@ _PER_ENTITY_MUTABLE_FIELDS = [field.name for
 
 _FIELD_ORDERING = {name: index for index, name in
                    enumerate(_PER_ENTITY_MUTABLE_FIELDS)}
+# PhysicsState.Positions and .Velocities rely on this.
+assert _FIELD_ORDERING['y'] == _FIELD_ORDERING['x'] + 1
+assert _FIELD_ORDERING['vy'] == _FIELD_ORDERING['vx'] + 1
 
 # A special field, we reference it a couple times so turn it into a symbol
 # to guard against string literal typos.
@@ -167,12 +170,12 @@ for field in protos.Entity.DESCRIPTOR.fields:
 
 
     def entity_view_unchanging_fget(self, name=field.name):
-        return getattr(self._creator._proto_state.entities[self._index], name)
+        return getattr(self._creator._table.entities[self._index], name)
 
 
     def entity_view_unchanging_fset(self, val, name=field.name):
-        return setattr(
-            self._creator._proto_state.entities[self._index], name, val)
+        self._creator._table = \
+            self._creator._table.replace(self._index, name, val)
 
 
     field_n: Optional[int]
@@ -211,7 +214,7 @@ for field in protos.Entity.DESCRIPTOR.fields:
                     self._creator._n * field_n + self._index])
             if entity_index == PhysicsState.NO_INDEX:
                 return ''
-            return self._creator._entity_names[entity_index]
+            return self._creator._table.names[entity_index]
 
 
         def entity_view_mutable_fset(self, val, field_n=field_n):
@@ -244,6 +247,66 @@ for field in protos.Entity.DESCRIPTOR.fields:
         ))
 
 
+class EntityTable:
+    """The fields of every entity that don't change during simulation, i.e.
+    everything in _PER_ENTITY_UNCHANGING_FIELDS.
+
+    This is only built when the list of entities changes, e.g. when a
+    savefile is loaded or the Module is spawned. Every PhysicsState made
+    from another PhysicsState shares its EntityTable, so never change one.
+    To change a field, use replace(), which makes a new EntityTable.
+
+    Example usage:
+    table = EntityTable(physical_state.entities)
+    table.mass[table.index[common.HABITAT]]
+    """
+
+    def __init__(self, entities: Iterable[protos.Entity]):
+        self.entities: Tuple[protos.Entity, ...] = tuple(
+            protos.Entity(**{
+                field: getattr(entity, field)
+                for field in _PER_ENTITY_UNCHANGING_FIELDS})
+            for entity in entities)
+        self.names: Tuple[str, ...] = tuple(
+            entity.name for entity in self.entities)
+        # If two entities have the same name, the first one is found, the
+        # same as list.index.
+        self.index: Dict[str, int] = {}
+        for index, name in enumerate(self.names):
+            self.index.setdefault(name, index)
+
+        self.mass = self._column('mass', np.float64)
+        self.r = self._column('r', np.float64)
+        self.artificial = self._column('artificial', np.bool_)
+        self.atmosphere_thickness = \
+            self._column('atmosphere_thickness', np.float64)
+        self.atmosphere_scaling = \
+            self._column('atmosphere_scaling', np.float64)
+        # Indices of entities that have an atmosphere.
+        self.atmospheres: List[int] = np.flatnonzero(
+            (self.atmosphere_scaling != 0) &
+            (self.atmosphere_thickness != 0)).tolist()
+
+    def _column(self, field: str, dtype) -> np.ndarray:
+        column = np.array(
+            [getattr(entity, field) for entity in self.entities],
+            dtype=dtype)
+        column.flags.writeable = False
+        return column
+
+    def __len__(self):
+        return len(self.entities)
+
+    def replace(self, index: int, field: str, value) -> 'EntityTable':
+        """Returns a copy of this table, with field of the entity at index
+        set to value."""
+        entities = list(self.entities)
+        entities[index] = protos.Entity()
+        entities[index].CopyFrom(self.entities[index])
+        setattr(entities[index], field, value)
+        return EntityTable(entities)
+
+
 class PhysicsState:
     """The physical state of the system for use in solve_ivp and elsewhere.
 
@@ -255,6 +318,10 @@ class PhysicsState:
     # Faster Construction from a y-vector and protos.PhysicalState
     PhysicsState(ivp_solution.y, protos.PhysicalState)
 
+    # Fastest Construction, a view of a y-vector that shares the EntityTable
+    # and copies the timestamp, reference, etc. of another PhysicsState
+    PhysicsState(y_1d, other_physics_state)
+
     # Access of a single Entity in the PhysicsState, by index or Entity name
     my_entity: Entity = PhysicsState[0]
     my_entity: Entity = PhysicsState['Earth']
@@ -275,9 +342,9 @@ class PhysicsState:
 
     See help(PhysicsState.__init__) for how to initialize. Basically, the `y`
     param should be None at the very start of the program, but for the program
-    to have good performance, PhysicsState.__init__ should have both parameters
-    filled if it's being called more than once a second while OrbitX is running
-    normally.
+    to have good performance, PhysicsState.__init__ should be given a y-vector
+    and another PhysicsState if it's being called more than once a second
+    while OrbitX is running normally.
     """
 
     class NoEntityError(ValueError):
@@ -302,7 +369,8 @@ class PhysicsState:
 
     def __init__(self,
                  y: Optional[np.ndarray],
-                 proto_state: protos.PhysicalState):
+                 proto_state: Union[protos.PhysicalState, 'PhysicsState'],
+                 copy: bool = False):
         """Collects data from proto_state and y, when y is not None.
 
         There are two kinds of values we care about:
@@ -310,25 +378,42 @@ class PhysicsState:
         2) values that do not change (like mass, radius, name, etc)
 
         If both proto_state and y are given, 1) is taken from y and
-        2) is taken from proto_state. This is a very quick operation.
+        2) is taken from proto_state. y is not copied unless copy is True, so
+        changing this PhysicsState changes y, and the other way around.
+        If proto_state is another PhysicsState, this shares its EntityTable,
+        which makes this a very quick operation.
 
         If y is None, both 1) and 2) are taken from proto_state, and a new
-        y vector is generated. This is a somewhat expensive operation."""
-        assert isinstance(proto_state, protos.PhysicalState)
+        y vector is generated. This is a somewhat expensive operation.
+
+        Headings are only normalized to [0, 2pi) in a new y vector, i.e. if
+        y is None or copy is True. Otherwise y is never changed."""
         assert isinstance(y, np.ndarray) or y is None
 
-        # self._proto_state will have positions, velocities, etc for all
-        # entities. DO NOT USE THESE they will be stale. Use the accessors of
-        # this class instead!
-        self._proto_state = protos.PhysicalState()
-        self._proto_state.CopyFrom(proto_state)
-        self._n = len(proto_state.entities)
+        self._table: EntityTable
+        if isinstance(proto_state, PhysicsState):
+            self._table = proto_state._table
+            self._timestamp = proto_state._timestamp
+            self._reference = proto_state._reference
+            self._target = proto_state._target
+            self._navmode = proto_state._navmode
+            self._parachute_deployed = proto_state._parachute_deployed
+            if y is None:
+                y = proto_state._array_rep
+                copy = True
+        else:
+            assert isinstance(proto_state, protos.PhysicalState)
+            self._table = EntityTable(proto_state.entities)
+            self._timestamp = proto_state.timestamp
+            self._reference = proto_state.reference
+            self._target = proto_state.target
+            self._navmode = proto_state.navmode
+            self._parachute_deployed = proto_state.parachute_deployed
+        self._n = len(self._table)
 
-        self._entity_names = \
-            [entity.name for entity in self._proto_state.entities]
         self._array_rep: np.ndarray
-
         if y is None:
+            assert isinstance(proto_state, protos.PhysicalState)
             # We rely on having an internal array representation we can refer
             # to, so we have to build up this array representation.
             y = np.empty(
@@ -346,26 +431,30 @@ class PhysicsState:
 
                     y[self._n * field_n + entity_index] = proto_value
 
-            y[-2] = proto_state.srb_time
-            y[-1] = proto_state.time_acc
+            y[self.SRB_TIME_INDEX] = proto_state.srb_time
+            y[self.TIME_ACC_INDEX] = proto_state.time_acc
             self._array_rep = y
+            copy = True
+        elif copy:
+            self._array_rep = np.array(y, dtype=self.DTYPE)
         else:
-            # Take everything except the SRB time, the last element.
-            self._array_rep = y.astype(self.DTYPE)
-            self._proto_state.srb_time = y[self.SRB_TIME_INDEX]
-            self._proto_state.time_acc = y[self.TIME_ACC_INDEX]
+            # Only copies if y isn't already an array of self.DTYPE.
+            self._array_rep = np.asarray(y, dtype=self.DTYPE)
 
         assert len(self._array_rep.shape) == 1, \
             f'y is not 1D: {self._array_rep.shape}'
         assert (self._array_rep.size - self.N_SINGULAR_ELEMENTS) % \
                len(_PER_ENTITY_MUTABLE_FIELDS) == 0, self._array_rep.size
         assert (self._array_rep.size - self.N_SINGULAR_ELEMENTS) // \
-               len(_PER_ENTITY_MUTABLE_FIELDS) == len(proto_state.entities), \
-            f'{self._array_rep.size} mismatches: {len(proto_state.entities)}'
+               len(_PER_ENTITY_MUTABLE_FIELDS) == self._n, \
+            f'{self._array_rep.size} mismatches: {self._n}'
 
-        np.mod(self.Heading, 2 * np.pi, out=self.Heading)
+        if copy:
+            np.mod(self.Heading, 2 * np.pi, out=self.Heading)
 
-        self._entities_with_atmospheres: Optional[List[int]] = None
+    @property
+    def _entity_names(self) -> Tuple[str, ...]:
+        return self._table.names
 
     def _y_component(self, field_name: str) -> np.ndarray:
         """Returns an n-array with the value of a component for each entity."""
@@ -377,15 +466,15 @@ class PhysicsState:
     def _index_to_name(self, index: int) -> str:
         """Translates an index into the entity list to the right name."""
         i = int(index)
-        return self._entity_names[i] if i != self.NO_INDEX else ''
+        return self._table.names[i] if i != self.NO_INDEX else ''
 
     def _name_to_index(self, name: Optional[str]) -> int:
         """Finds the index of the entity with the given name."""
         try:
             assert name is not None
-            return self._entity_names.index(name) if name != '' \
+            return self._table.index[name] if name != '' \
                 else self.NO_INDEX
-        except ValueError:
+        except KeyError:
             raise self.NoEntityError(f'{name} not in entity list')
 
     def y0(self):
@@ -399,20 +488,25 @@ class PhysicsState:
         For example, if you want to iterate over all elements, use __iter__
         by doing:
         for entity in my_physics_state: print(entity.name)"""
-        constructed_protobuf = protos.PhysicalState()
-        constructed_protobuf.CopyFrom(self._proto_state)
-        for entity_data, entity in zip(self, constructed_protobuf.entities):
-            (
-                entity.x, entity.y, entity.vx, entity.vy,
-                entity.heading, entity.spin, entity.fuel,
-                entity.throttle, entity.landed_on,
-                entity.broken
-            ) = (
-                entity_data.x, entity_data.y, entity_data.vx, entity_data.vy,
-                entity_data.heading, entity_data.spin, entity_data.fuel,
-                entity_data.throttle, entity_data.landed_on,
-                entity_data.broken
-            )
+        constructed_protobuf = protos.PhysicalState(
+            entities=self._table.entities,
+            timestamp=self.timestamp,
+            time_acc=self.time_acc,
+            craft=self.craft or '',
+            reference=self.reference,
+            target=self.target,
+            navmode=self._navmode,
+            srb_time=self.srb_time,
+            parachute_deployed=self.parachute_deployed)
+        # Convert every field of every entity to python values at once,
+        # instead of going through an _EntityView for each entity.
+        columns = dict(zip(_PER_ENTITY_MUTABLE_FIELDS, self.Fields.tolist()))
+        columns[_LANDED_ON] = [
+            self._index_to_name(index) for index in columns[_LANDED_ON]]
+        columns['broken'] = [bool(broken) for broken in columns['broken']]
+        for field_name, values in columns.items():
+            for entity, value in zip(constructed_protobuf.entities, values):
+                setattr(entity, field_name, value)
 
         return constructed_protobuf
 
@@ -435,7 +529,10 @@ class PhysicsState:
         """
         if isinstance(index, str):
             # Turn a name-based index into an integer
-            index = self._entity_names.index(index)
+            try:
+                index = self._table.index[index]
+            except KeyError:
+                raise self.NoEntityError(f'{index} not in entity list')
         i = int(index)
 
         return _EntityView(self, i)
@@ -453,7 +550,10 @@ class PhysicsState:
             return
         if isinstance(index, str):
             # Turn a name-based index into an integer
-            index = self._entity_names.index(index)
+            try:
+                index = self._table.index[index]
+            except KeyError:
+                raise self.NoEntityError(f'{index} not in entity list')
         i = int(index)
 
         entity = self[i]
@@ -476,28 +576,58 @@ class PhysicsState:
 
     @property
     def timestamp(self) -> float:
-        return self._proto_state.timestamp
+        return self._timestamp
 
     @timestamp.setter
     def timestamp(self, t: float):
-        self._proto_state.timestamp = t
+        self._timestamp = t
 
     @property
     def srb_time(self) -> float:
-        return self._proto_state.srb_time
+        return self._array_rep[self.SRB_TIME_INDEX]
 
     @srb_time.setter
     def srb_time(self, val: float):
-        self._proto_state.srb_time = val
         self._array_rep[self.SRB_TIME_INDEX] = val
 
     @property
     def parachute_deployed(self) -> bool:
-        return self._proto_state.parachute_deployed
+        return self._parachute_deployed
 
     @parachute_deployed.setter
     def parachute_deployed(self, val: bool):
-        self._proto_state.parachute_deployed = val
+        self._parachute_deployed = val
+
+    @property
+    def Fields(self) -> np.ndarray:
+        """Returns a (len(_PER_ENTITY_MUTABLE_FIELDS), n) view of y. Each
+        row is one field for every entity, in the order of _FIELD_ORDERING.
+
+        Example usage:
+        state.Fields[_FIELD_ORDERING['fuel']] += 10  # Refuel everything."""
+        # Reshaping a 1D array, even a strided one, never copies.
+        return self._array_rep[:-self.N_SINGULAR_ELEMENTS].reshape(
+            len(_PER_ENTITY_MUTABLE_FIELDS), self._n)
+
+    @property
+    def Positions(self) -> np.ndarray:
+        """Returns an (n, 2) view of y, with the (x, y) of every entity."""
+        return self.Fields[_FIELD_ORDERING['x']:
+                           _FIELD_ORDERING['y'] + 1].T
+
+    @Positions.setter
+    def Positions(self, positions: np.ndarray):
+        self.Positions[:] = positions
+
+    @property
+    def Velocities(self) -> np.ndarray:
+        """Returns an (n, 2) view of y, with the (vx, vy) of every entity."""
+        return self.Fields[_FIELD_ORDERING['vx']:
+                           _FIELD_ORDERING['vy'] + 1].T
+
+    @Velocities.setter
+    def Velocities(self, velocities: np.ndarray):
+        self.Velocities[:] = velocities
 
     @property
     def X(self):
@@ -551,22 +681,15 @@ class PhysicsState:
     @property
     def Atmospheres(self) -> List[int]:
         """Returns a list of indexes of entities that have an atmosphere."""
-        if self._entities_with_atmospheres is None:
-            self._entities_with_atmospheres = []
-            for index, entity in enumerate(self._proto_state.entities):
-                if entity.atmosphere_scaling != 0 and \
-                        entity.atmosphere_thickness != 0:
-                    self._entities_with_atmospheres.append(index)
-        return self._entities_with_atmospheres
+        return self._table.atmospheres
 
     @property
     def time_acc(self) -> float:
         """Returns the time acceleration, e.g. 1x or 50x."""
-        return self._proto_state.time_acc
+        return self._array_rep[self.TIME_ACC_INDEX]
 
     @time_acc.setter
     def time_acc(self, new_acc: float):
-        self._proto_state.time_acc = new_acc
         self._array_rep[self.TIME_ACC_INDEX] = new_acc
 
     def craft_entity(self):
@@ -577,10 +700,10 @@ class PhysicsState:
     def craft(self) -> Optional[str]:
         """Returns the currently-controlled craft.
         Not actually backed by any stored field, just a calculation."""
-        if common.HABITAT not in self._entity_names and \
-                common.AYSE not in self._entity_names:
+        if common.HABITAT not in self._table.index and \
+                common.AYSE not in self._table.index:
             return None
-        if common.AYSE not in self._entity_names:
+        if common.AYSE not in self._table.index:
             return common.HABITAT
 
         hab_index = self._name_to_index(common.HABITAT)
@@ -593,34 +716,34 @@ class PhysicsState:
 
     def reference_entity(self):
         """Convenience function, a full Entity representing the reference."""
-        return self[self._proto_state.reference]
+        return self[self._reference]
 
     @property
     def reference(self) -> str:
         """Returns current reference of the physics system, shown in GUI."""
-        return self._proto_state.reference
+        return self._reference
 
     @reference.setter
     def reference(self, name: str):
-        self._proto_state.reference = name
+        self._reference = name
 
     def target_entity(self):
         """Convenience function, a full Entity representing the target."""
-        return self[self._proto_state.target]
+        return self[self._target]
 
     @property
     def target(self) -> str:
         """Returns landing/docking target, shown in GUI."""
-        return self._proto_state.target
+        return self._target
 
     @target.setter
     def target(self, name: str):
-        self._proto_state.target = name
+        self._target = name
 
     @property
     def navmode(self) -> Navmode:
-        return Navmode(self._proto_state.navmode)
+        return Navmode(self._navmode)
 
     @navmode.setter
     def navmode(self, navmode: Navmode):
-        self._proto_state.navmode = navmode.value
+        self._navmode = navmode.value
@@ -58,8 +58,8 @@ class Earth(ThreeDeeObj):
         return entity.name
 
     def draw(self, entity: Entity,
-             state: PhysicsState, origin: Entity):
-        self._update_obj(entity, state, origin)
+             state: PhysicsState, screen_pos: vpython.vector):
+        self._update_obj(entity, state, screen_pos)
         self._obj.clouds.pos = self._obj.pos
         self._obj.clouds.axis = calc.angle_to_vpy(
             entity.heading * calc.windspeed_multiplier(entity, windspeed=100))
@@ -250,11 +250,14 @@ class FlightGui:
 
         # Have to reset origin, reference, and target with new positions
         self._origin = draw_state[self._origin.name]
+        # Where every entity is relative to the origin, all at once.
+        screen_positions = \
+            (draw_state.Positions - self._origin.pos).tolist()
 
         try:
-            for entity in draw_state:
+            for entity, (x, y) in zip(draw_state, screen_positions):
                 self._3dobjs[entity.name].draw(
-                    entity, draw_state, self.origin())
+                    entity, draw_state, vpython.vector(x, y, 0))
         except KeyError as e:
             # If we find an entity that doesn't have an associated 3dobj, try
             # once to make a corresponding 3dobj. Note, if we get another
@@ -262,9 +265,9 @@ class FlightGui:
             missing_entity = draw_state[e.args[0]]
             self._3dobjs[missing_entity.name] = \
                 self._build_threedeeobj(missing_entity)
-            for entity in draw_state:
+            for entity, (x, y) in zip(draw_state, screen_positions):
                 self._3dobjs[entity.name].draw(
-                    entity, draw_state, self.origin())
+                    entity, draw_state, vpython.vector(x, y, 0))
 
         self._orbit_projection.update(draw_state, self.origin())
 
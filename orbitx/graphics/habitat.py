@@ -145,8 +145,8 @@ class Habitat(ThreeDeeObj):
         return label
 
     def draw(self, entity: Entity,
-             state: PhysicsState, origin: Entity):
-        self._update_obj(entity, state, origin)
+             state: PhysicsState, screen_pos: vpython.vector):
+        self._update_obj(entity, state, screen_pos)
         self._obj.boosters.pos = self._obj.pos
         self._obj.boosters.axis = self._obj.axis
         # Attach the parachute to the forward cone of the habitat.
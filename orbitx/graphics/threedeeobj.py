@@ -148,19 +148,20 @@ class ThreeDeeObj(metaclass=ABCMeta):
         self._label.visible = not self._label.visible
 
     def _update_obj(self, entity: Entity,
-                    state: PhysicsState, origin: Entity) -> None:
+                    state: PhysicsState, screen_pos: vpython.vector) -> None:
         # update planet objects
-        self._obj.pos = entity.screen_pos(origin)
+        self._obj.pos = screen_pos
         self._obj.axis = calc.angle_to_vpy(entity.heading)
 
         # update label objects
         self._label.text = self._label_text(entity)
-        self._label.pos = entity.screen_pos(origin)
+        self._label.pos = screen_pos
         # update landing graphic objects
+        craft = state.craft_entity()
         self._update_landing_graphic(self._small_landing_graphic,
-                                     entity, state.craft_entity())
+                                     entity, craft)
         self._update_landing_graphic(self._large_landing_graphic,
-                                     entity, state.craft_entity())
+                                     entity, craft)
 
     def pos(self) -> vpython.vector:
         return self._obj.pos
@@ -169,8 +170,10 @@ class ThreeDeeObj(metaclass=ABCMeta):
         return self._obj.radius * 2
 
     def draw(self, entity: Entity,
-             state: PhysicsState, origin: Entity):
-        self._update_obj(entity, state, origin)
+             state: PhysicsState, screen_pos: vpython.vector):
+        """Draws entity at screen_pos, its position relative to the origin,
+        see Entity.screen_pos."""
+        self._update_obj(entity, state, screen_pos)
 
     def clear_trail(self) -> None:
         self._obj.clear_trail()
@@ -1,29 +1,405 @@
 """Network-related classes."""
 
+import asyncio
+import collections
+import contextlib
 import logging
+import math
+import socket
 import threading
 import time
 import queue
+import zlib
+from multiprocessing import resource_tracker, shared_memory
 from types import SimpleNamespace
-from typing import Dict, List, Optional, Iterable
+from typing import AsyncIterable, AsyncIterator, Callable, Dict, List, \
+    NamedTuple, Optional, Iterable, Iterator, Sequence, Tuple, Union
 
 import grpc
+import numpy as np
 
 from orbitx import orbitx_pb2 as protos
 from orbitx import orbitx_pb2_grpc as grpc_stubs
-from orbitx.data_structures import PhysicsState
+from orbitx.data_structures import Navmode, PhysicsState, _FIELD_ORDERING, \
+    _LANDED_ON, _PER_ENTITY_MUTABLE_FIELDS, _PER_ENTITY_UNCHANGING_FIELDS
 
 log = logging.getLogger()
 
 DEFAULT_PORT = 28430
 
+# Streaming RPCs like subscribe_state hold a server thread for as long as the
+# client is connected, so every client that subscribes uses two threads.
+MAX_SERVER_THREADS = 100
+
+# How often a subscribe_state stream checks if its client has disconnected,
+# when there are no new states to send.
+SUBSCRIPTION_CHECK_INTERVAL = 0.5
+
+# How many states the shared memory that a physics server publishes to, for
+# clients on the same computer, holds. See SharedStatePublisher.
+SHARED_STATE_SLOTS = 4
+
+# How many of the latest lockstep steps a StateServer keeps, so that a client
+# that falls a little behind still gets every step. A client further behind
+# gets a new snapshot instead. See physics/lockstep.py.
+LOCKSTEP_HISTORY = 100
+
+# A physics server can host many sessions, each its own simulation. Clients
+# pick one by sending its name in the metadata of every RPC. Clients that
+# don't pick one get the first session. See SessionServer.
+SESSION_METADATA_KEY = 'orbitx-session'
+DEFAULT_SESSION = ''
+
+# Segments of trajectory sent to clients are Chebyshev polynomials of this
+# degree. A segment is about a second of real time, which this fits to well
+# under a millimetre.
+TRAJECTORY_DEGREE = 8
+
 # This Request class is just an alias of the Command protobuf message. We
 # provide this so that nobody has to directly import orbitx_pb2, and so that
 # we can this wrapper class in the future.
 Request = protos.Command
 
+# Also an alias, of the protobuf message that a client uses to subscribe to
+# only part of the state. See StateClient.subscribe.
+Interest = protos.Interest
+
+
+def shared_state_name(session: str = DEFAULT_SESSION,
+                      port: int = DEFAULT_PORT) -> str:
+    """Returns the name of the shared memory that states of session are
+    published to, by the server on port. See SharedStatePublisher."""
+    name = f'orbitx-state-{port}'
+    if session == DEFAULT_SESSION:
+        return name
+    return f'{name}-{session}'
+
+
+class _DenseOutput(NamedTuple):
+    """Part of the upcoming trajectory, as given to notify_state_change. Quacks
+    like a physics.engine._Segment, which this module can't import."""
+    t_min: float
+    t_max: float
+    solution: Callable[[float], np.ndarray]
+
+
+def _fit_segment(segment: _DenseOutput) -> protos.TrajectorySegment:
+    """Fits a polynomial to every element of the y-vector that changes during
+    segment, like ephemeris.build does for planets."""
+    degree = TRAJECTORY_DEGREE
+    nodes = np.cos(np.pi * (np.arange(degree + 1) + 0.5) / (degree + 1))
+    ts = segment.t_min + (nodes + 1) / 2 * (segment.t_max - segment.t_min)
+    samples = np.column_stack([segment.solution(t) for t in ts])
+    changing = np.flatnonzero(samples.min(axis=1) != samples.max(axis=1))
+    # Positions of far-away planets are huge compared to how much they
+    # change in a segment, so only fit the change to keep full precision.
+    offsets = samples[changing].mean(axis=1)
+    coefficients = np.polynomial.chebyshev.chebfit(
+        nodes, samples[changing].T - offsets, degree)
+    coefficients[0] += offsets
+    return protos.TrajectorySegment(
+        t_min=segment.t_min, t_max=segment.t_max,
+        y_indices=changing.tolist(),
+        coefficients=coefficients.ravel().tolist())
+
+
+class _Snapshot:
+    """The latest state given to StateServer.notify_state_change, split up so
+    that it can be quickly packed for any number of subscribed clients.
+
+    Each different PackedState made from this snapshot is only serialized
+    once, no matter how many clients it's sent to."""
+
+    def __init__(self, state_version: int,
+                 entity_table: protos.EntityTable, entity_table_version: int,
+                 y: np.ndarray, physical_state: protos.PhysicalState,
+                 trajectory: List[protos.TrajectorySegment]):
+        self.state_version = state_version
+        self.entity_table = entity_table
+        self.entity_table_version = entity_table_version
+        self.y = y
+        self.physical_state = physical_state
+        self.trajectory = trajectory
+
+        # Keyed by (the state_version of the snapshot this is a delta from,
+        # or None if it isn't a delta, whether the entity table is included,
+        # whether the trajectory is included).
+        self._packed: Dict[Tuple[Optional[int], bool, bool], bytes] = {}
+        self._packed_lock = threading.Lock()
+
+    def packed(self, base: Optional['_Snapshot'],
+               include_entity_table: bool,
+               include_trajectory: bool = False) -> bytes:
+        """Returns a serialized PackedState of this snapshot. If base is
+        given, it only has what changed since base."""
+        key = (None if base is None else base.state_version,
+               include_entity_table, include_trajectory)
+        with self._packed_lock:
+            if key not in self._packed:
+                if base is not None:
+                    assert base.entity_table_version == \
+                        self.entity_table_version
+                    indices = np.flatnonzero(self.y != base.y)
+                else:
+                    indices = np.flatnonzero(self.y)
+                self._packed[key] = self.pack(
+                    indices, base is not None, include_entity_table,
+                    include_trajectory).SerializeToString()
+            return self._packed[key]
+
+    def pack(self, indices: np.ndarray, delta: bool,
+             include_entity_table: bool, include_trajectory: bool,
+             wanted: Optional[np.ndarray] = None) -> protos.PackedState:
+        """Returns a PackedState with the elements of this snapshot's y-vector
+        at indices. If wanted is given, the trajectory only includes the
+        elements of the y-vector at wanted."""
+        state = self.physical_state
+        packed = protos.PackedState(
+            entity_table_version=self.entity_table_version,
+            timestamp=state.timestamp,
+            reference=state.reference,
+            target=state.target,
+            navmode=state.navmode,
+            parachute_deployed=state.parachute_deployed)
+
+        if include_entity_table:
+            packed.entity_table.CopyFrom(self.entity_table)
+        if include_trajectory and wanted is None:
+            packed.trajectory.extend(self.trajectory)
+        elif include_trajectory:
+            for segment in self.trajectory:
+                y_indices = np.array(segment.y_indices, dtype=int)
+                included = np.isin(y_indices, wanted)
+                coefficients = np.array(segment.coefficients).reshape(
+                    -1, len(y_indices))[:, included]
+                packed.trajectory.add(
+                    t_min=segment.t_min, t_max=segment.t_max,
+                    y_indices=y_indices[included].tolist(),
+                    coefficients=coefficients.ravel().tolist())
+
+        packed.delta = delta
+        packed.y_indices.extend(indices.tolist())
+        packed.y_values.extend(self.y[indices].tolist())
+        return packed
+
+
+class PackedStateEncoder:
+    """Turns states into serialized PackedStates for one subscribed client.
+
+    The entity table is only sent when it changes. Most of the y-vector is
+    zeros, like the spin of most planets, so only nonzero elements are sent.
+    If deltas is set, only the elements that changed since the last
+    PackedState are sent. Since a subscription is a single ordered stream,
+    the client always has the last PackedState we sent when it gets the next
+    one.
+
+    If interests are given, only the parts of the y-vector in those
+    interests are sent, and only when encode() is told they're due. Then
+    every PackedState is only serialized for this client."""
+
+    def __init__(self, deltas: bool, trajectory: bool = False,
+                 interests: Sequence[protos.Interest] = ()):
+        self._deltas = deltas
+        self._trajectory = trajectory
+        self._interests = list(interests)
+        self._sent: Optional[_Snapshot] = None
+
+        # Only used with interests. The indices of the y-vector in each
+        # interest, and the y-vector the client has.
+        self._interest_indices: List[np.ndarray] = []
+        self._client_y: Optional[np.ndarray] = None
+
+    def encode(self, snapshot: _Snapshot,
+               due: Optional[Sequence[int]] = None) -> bytes:
+        """Returns the serialized PackedState to send for snapshot. If this
+        encoder has interests, due is the indices of the interests to send,
+        or None to send all of them."""
+        new_entity_table = (
+            self._sent is None or
+            self._sent.entity_table_version != snapshot.entity_table_version)
+        base = None
+        if self._deltas and not new_entity_table:
+            base = self._sent
+
+        self._sent = snapshot
+        if len(self._interests) == 0:
+            return snapshot.packed(base, new_entity_table, self._trajectory)
 
-class StateServer(grpc_stubs.StateServerServicer):
+        if new_entity_table:
+            self._interest_indices = [
+                _interest_indices(interest, snapshot.physical_state)
+                for interest in self._interests]
+            # The client fills in what we don't send with zeros.
+            self._client_y = np.zeros_like(snapshot.y)
+            due = None
+        assert self._client_y is not None
+        if due is None:
+            due = range(len(self._interests))
+
+        wanted = np.unique(np.concatenate(
+            [self._interest_indices[index] for index in due] +
+            [np.arange(-PhysicsState.N_SINGULAR_ELEMENTS, 0) +
+             len(snapshot.y)]))
+        # Without deltas, we still send everything the client wants, but
+        # only the nonzero elements the first time.
+        compare_to = self._client_y if base is not None or \
+            new_entity_table else np.full_like(snapshot.y, np.nan)
+        indices = wanted[snapshot.y[wanted] != compare_to[wanted]]
+        self._client_y[indices] = snapshot.y[indices]
+        return snapshot.pack(
+            indices, not new_entity_table, new_entity_table,
+            self._trajectory, wanted).SerializeToString()
+
+
+def _interest_indices(interest: protos.Interest,
+                      state: protos.PhysicalState) -> np.ndarray:
+    """Returns the indices of the y-vector of state that are in interest.
+
+    Every landed_on field is always included, since a landed_on of zero
+    would mean being landed on the first entity."""
+    names = [entity.name for entity in state.entities]
+    n = len(names)
+    entity_indices = np.arange(n)
+    if len(interest.entities) != 0:
+        # Entities that don't exist yet, like an AYSE that hasn't been
+        # added, are ignored.
+        entity_indices = np.array(
+            [names.index(name) for name in interest.entities
+             if name in names], dtype=int)
+    fields = list(interest.fields) or _PER_ENTITY_MUTABLE_FIELDS
+    for field in fields:
+        if field not in _FIELD_ORDERING:
+            raise ValueError(f'{field} is not a field of the y-vector')
+
+    return np.unique(np.concatenate(
+        [_FIELD_ORDERING[field] * n + entity_indices for field in fields] +
+        [_FIELD_ORDERING[_LANDED_ON] * n + np.arange(n)]))
+
+
+class _InterestSchedule:
+    """Decides when a subscribed client should be sent each of its
+    interests, going by the rates in its Subscription."""
+
+    def __init__(self, subscription: protos.Subscription):
+        self._min_interval = _min_update_interval(subscription)
+        # If there are no interests, everything is one implicit interest.
+        self._intervals = [
+            max(self._min_interval, _min_update_interval(interest))
+            for interest in subscription.interests] or [self._min_interval]
+        self._sent_times = [-math.inf] * len(self._intervals)
+
+    def next_send_time(self) -> float:
+        return min(sent_time + interval for sent_time, interval
+                   in zip(self._sent_times, self._intervals))
+
+    def pop_due(self, everything: bool) -> List[int]:
+        """Returns the indices of the interests to send now, and remembers
+        that they were sent. If everything is set, all interests are sent,
+        e.g. when the client is waiting to see its command simulated."""
+        now = time.monotonic()
+        due = [index for index in range(len(self._intervals))
+               if everything or
+               now >= self._sent_times[index] + self._intervals[index]]
+        for index in due:
+            self._sent_times[index] = now
+        return due
+
+
+class PackedStateDecoder:
+    """Turns a stream of PackedStates back into PhysicsStates.
+
+    Every PackedState from a subscription has to be given to update(), in
+    order, but state() only has to be called when a new state is needed."""
+
+    def __init__(self):
+        # Has the entity table and everything else that isn't in the
+        # y-vector. Every state from this decoder shares its EntityTable.
+        self._template: Optional[PhysicsState] = None
+        self._entity_table_version: Optional[int] = None
+        self._y: Optional[np.ndarray] = None
+        # (t_min, t_max, y_indices, coefficients) of each TrajectorySegment.
+        self._trajectory: List[
+            Tuple[float, float, np.ndarray, np.ndarray]] = []
+
+    def update(self, packed: protos.PackedState):
+        if packed.HasField('entity_table'):
+            self._template = PhysicsState(None, protos.PhysicalState(
+                entities=packed.entity_table.entities))
+            self._entity_table_version = packed.entity_table_version
+        assert self._template is not None
+        assert packed.entity_table_version == self._entity_table_version
+
+        if not packed.delta:
+            self._y = np.zeros(
+                len(self._template) * len(_PER_ENTITY_MUTABLE_FIELDS)
+                + PhysicsState.N_SINGULAR_ELEMENTS, dtype=PhysicsState.DTYPE)
+        assert self._y is not None
+        self._y[np.array(packed.y_indices, dtype=int)] = packed.y_values
+
+        # The craft isn't stored, PhysicsState.craft works it out.
+        self._template.timestamp = packed.timestamp
+        self._template.reference = packed.reference
+        self._template.target = packed.target
+        self._template.navmode = Navmode(packed.navmode)
+        self._template.parachute_deployed = packed.parachute_deployed
+
+        self._trajectory = []
+        for segment in packed.trajectory:
+            y_indices = np.array(segment.y_indices, dtype=int)
+            coefficients = np.array(
+                segment.coefficients, dtype=PhysicsState.DTYPE
+            ).reshape(-1, len(y_indices))
+            self._trajectory.append(
+                (segment.t_min, segment.t_max, y_indices, coefficients))
+
+    def state(self, y: Optional[np.ndarray] = None) -> PhysicsState:
+        """Returns the state from the last call to update(). If y is given,
+        it's used instead of the y-vector from the last call to update()."""
+        assert self._template is not None and self._y is not None
+        if y is None:
+            # self._y changes with the next update().
+            return PhysicsState(self._y, self._template, copy=True)
+        return PhysicsState(y, self._template)
+
+    @property
+    def timestamp(self) -> float:
+        assert self._template is not None
+        return self._template.timestamp
+
+    @property
+    def time_acc(self) -> float:
+        assert self._y is not None
+        return self._y[-1]
+
+    def state_at(self, t: float) -> PhysicsState:
+        """Returns the state at simtime t, evaluated from the trajectory the
+        server sent with the last update().
+
+        If t is after the end of the trajectory, this returns the state at
+        the end of the trajectory. If there's no trajectory, e.g. when the
+        simulation is paused, this returns the same as state()."""
+        assert self._template is not None and self._y is not None
+        t = max(t, self.timestamp)
+        if len(self._trajectory) == 0 or t < self._trajectory[0][0]:
+            return self.state()
+        t = min(t, self._trajectory[-1][1])
+
+        y = self._y.copy()
+        for t_min, t_max, y_indices, coefficients in self._trajectory:
+            if t_min <= t <= t_max:
+                if t_max > t_min:
+                    # Chebyshev polynomials are defined over [-1, 1].
+                    x = 2 * (t - t_min) / (t_max - t_min) - 1
+                    y[y_indices] = np.polynomial.chebyshev.chebval(
+                        x, coefficients)
+                break
+        state = PhysicsState(y, self._template)
+        np.mod(state.Heading, 2 * np.pi, out=state.Heading)
+        state.timestamp = t
+        return state
+
+
+class StateServer:
     """
     Service for sending state to clients.
 
@@ -33,9 +409,19 @@ class StateServer(grpc_stubs.StateServerServicer):
     the client's call of "get_physical_state" will return whatever value we
     produce here.
 
+    Clients can instead call "subscribe_state" once, and then this server
+    will send a new state to them every time self.notify_state_change is
+    called, up to the rate they ask for. Those clients send commands with
+    "send_commands".
+
     Make sure to call self.notify_state_change when there's a physical state
     change, e.g. when a physics step is simulated.
 
+    Every state is serialized once, no matter how many clients ask for it.
+    So the RPC methods of this class return bytes, not protobufs. Use
+    add_state_server_to_server to add this to a GRPC server, not the
+    add_StateServerServicer_to_server function in orbitx_pb2_grpc.
+
     Magic!
     """
 
@@ -45,7 +431,8 @@ class StateServer(grpc_stubs.StateServerServicer):
         'MC Flight',
         'Habitat Flight',
         'OrbitV Compatibility Server',
-        'MIST'
+        'MIST',
+        'Relay'
     ]
 
     def __init__(self):
@@ -54,64 +441,912 @@ class StateServer(grpc_stubs.StateServerServicer):
         self._commands = queue.Queue()
         self.addr_to_connected_clients: Dict[str, SimpleNamespace] = {}
 
-    def notify_state_change(self, physical_state_copy: protos.PhysicalState):
+        # Notified when there's a new state, or new commands from a client.
+        # Subscribed clients wait on this.
+        self._state_change = threading.Condition(self._internal_state_lock)
+        # Incremented every time notify_state_change is called.
+        self._state_version = 0
+        # Every command is numbered in the order it was received. These are
+        # the number of the last command each client sent, of the last
+        # command popped, and of the last command simulated in the latest
+        # state.
+        self._command_seq = 0
+        self._client_command_seqs: Dict[str, int] = {}
+        self._popped_command_seq = 0
+        self._simulated_command_seq = 0
+
+        # The latest state, ready to be packed for subscribed clients. This
+        # is only made when a subscribed client needs it.
+        self._snapshot: Optional[_Snapshot] = None
+        self._snapshot_state_version = 0
+        # The upcoming trajectory given to notify_state_change, and the
+        # TrajectorySegments fitted to the last one sent to a client, so that
+        # each segment is only fitted once.
+        self._internal_trajectory: Sequence[
+            Union[_DenseOutput, protos.TrajectorySegment]] = ()
+        self._fitted_trajectory: List[Tuple[
+            Union[_DenseOutput, protos.TrajectorySegment],
+            protos.TrajectorySegment]] = []
+
+        # The latest serialized LockstepSteps given to notify_lockstep_step,
+        # as (step, bytes) pairs, and the state after the latest one. A
+        # snapshot of that state is only serialized when a client needs it.
+        self._lockstep_steps: collections.deque = \
+            collections.deque(maxlen=LOCKSTEP_HISTORY)
+        self._lockstep_state: Optional[protos.PhysicalState] = None
+        self._lockstep_snapshot: Optional[Tuple[int, bytes]] = None
+
+    def notify_state_change(
+            self, physical_state_copy: protos.PhysicalState,
+            trajectory: Sequence[
+                Union[_DenseOutput, protos.TrajectorySegment]] = (),
+            simulated_command_seq: Optional[int] = None):
+        """Sends a new state to clients. If clients subscribed with
+        trajectory set, they're also sent trajectory, a list of segments of
+        the upcoming trajectory like PhysicsEngine.get_segments returns.
+        Segments can also be TrajectorySegments that are already fitted.
+
+        simulated_command_seq is the popped_command_seq() of the last
+        command simulated in this state. By default, every command popped so
+        far is simulated, which is the case if they're popped and simulated
+        in the same thread that calls this."""
         # This flag is to make sure this class is set up and being used
         # properly. When changing this code, consider that multithreading is
         # hard. This StateServer will be in a different thread than the main
         # thread of whatever is using this GRPC server.
         # So REMEMBER: the argument should not be modified by the main thread!
-        with self._internal_state_lock:
+        # Serialize this once, here, instead of once for every client.
+        serialized_state = physical_state_copy.SerializeToString()
+        with self._state_change:
             self._internal_state_copy = physical_state_copy
+            self._internal_state_bytes = serialized_state
+            self._internal_trajectory = trajectory
             self._class_used_properly = True
+            self._state_version += 1
+            self._simulated_command_seq = (
+                self._popped_command_seq if simulated_command_seq is None
+                else simulated_command_seq)
+            self._notify_waiters()
+
+    def notify_lockstep_step(self, step: protos.LockstepStep,
+                             physical_state_copy: protos.PhysicalState):
+        """Sends a lockstep step to clients that called subscribe_lockstep.
+        physical_state_copy is the state after the step, which is sent to
+        clients that just subscribed or fell too far behind. Like with
+        notify_state_change, don't modify physical_state_copy afterwards."""
+        serialized_step = step.SerializeToString()
+        with self._state_change:
+            assert (len(self._lockstep_steps) == 0 or
+                    step.step == self._lockstep_steps[-1][0] + 1)
+            self._lockstep_steps.append((step.step, serialized_step))
+            self._lockstep_state = physical_state_copy
+            self._notify_waiters()
+
+    def _has_lockstep_steps(self, next_step: Optional[int]) -> bool:
+        """Returns True if there are lockstep steps for a client that will
+        be sent next_step next, or None if it hasn't been sent anything. Only
+        call this while holding self._internal_state_lock."""
+        return len(self._lockstep_steps) != 0 and (
+            next_step is None or self._lockstep_steps[-1][0] >= next_step)
+
+    def _pop_lockstep_steps(self, next_step: Optional[int]) \
+            -> Tuple[int, List[bytes]]:
+        """Returns the serialized LockstepSteps to send to a client that
+        will be sent next_step next, and the step to send after those.
+        Only call this while holding self._internal_state_lock."""
+        latest_step = self._lockstep_steps[-1][0]
+        if next_step is not None and \
+                next_step >= self._lockstep_steps[0][0]:
+            return latest_step + 1, [
+                serialized_step for step, serialized_step
+                in self._lockstep_steps if step >= next_step]
+
+        # This client just subscribed, or is so far behind that we don't
+        # have every step it missed. Either way, start it at the latest
+        # state instead.
+        if self._lockstep_snapshot is None or \
+                self._lockstep_snapshot[0] != latest_step:
+            self._lockstep_snapshot = (
+                latest_step, protos.LockstepStep(
+                    step=latest_step, snapshot=self._lockstep_state
+                ).SerializeToString())
+        return latest_step + 1, [self._lockstep_snapshot[1]]
+
+    def subscribe_lockstep(self, subscription: protos.Subscription,
+                           context) -> Iterator[bytes]:
+        """Server-side implementation of the subscribe_lockstep RPC.
+
+        Sends a snapshot of the latest lockstep state, then every step after
+        it. Only subscription.client is used."""
+        peer = context.peer()
+        next_step: Optional[int] = None
+
+        while context.is_active():
+            with self._state_change:
+                if not self._state_change.wait_for(
+                        lambda: self._has_lockstep_steps(next_step),
+                        timeout=SUBSCRIPTION_CHECK_INTERVAL):
+                    continue
+                next_step, steps = self._pop_lockstep_steps(next_step)
+
+            self._update_client_list(peer, subscription.client)
+            yield from steps
 
     def get_physical_state(
             self, request_iterator: Iterable[protos.Command], context) \
-            -> protos.PhysicalState:
+            -> bytes:
         """Server-side implementation of this remote procedure call (RPC).
 
         This is called by GRPC, and the name of the function is special (it's
         referenced in orbitx.proto, under service StateServer)"""
+        client_type = self._receive_commands(request_iterator, context)
+        assert client_type is not None
+        self._update_client_list(context.peer(), client_type)
+
+        with self._internal_state_lock:
+            assert self._class_used_properly
+            return self._internal_state_bytes
+
+    def subscribe_state(self, subscription: protos.Subscription, context) \
+            -> Iterator[bytes]:
+        """Server-side implementation of the subscribe_state RPC.
+
+        Sends every new state to the client, but no more than
+        subscription.max_updates_per_second of them. If the client sent any
+        commands, the first state that has them simulated is always sent.
+
+        If the subscription has interests, each state only has the interests
+        that are due to be sent at their own rate, except for the state that
+        has the client's commands simulated, which has all of them."""
+        encoder = PackedStateEncoder(
+            subscription.deltas, subscription.trajectory,
+            subscription.interests)
+        schedule = _InterestSchedule(subscription)
+        peer = context.peer()
+        sent_version = 0
+        sent_command_seq = 0
+
+        def should_send() -> bool:
+            return self._should_send(
+                peer, sent_version, sent_command_seq,
+                schedule.next_send_time())
+
+        while context.is_active():
+            with self._state_change:
+                if not self._state_change.wait_for(
+                        should_send, timeout=SUBSCRIPTION_CHECK_INTERVAL):
+                    continue
+                assert self._class_used_properly
+                everything = self._has_new_commands_simulated(
+                    peer, sent_command_seq)
+                sent_version = self._state_version
+                sent_command_seq = self._simulated_command_seq
+                snapshot = self._latest_snapshot()
+
+            due = schedule.pop_due(everything)
+            self._update_client_list(peer, subscription.client)
+            yield encoder.encode(snapshot, due)
+
+    def _should_send(self, peer: str, sent_version: int,
+                     sent_command_seq: int, next_send_time: float) -> bool:
+        """Returns True if a client that was last sent sent_version, which
+        had commands up to sent_command_seq simulated, should be sent the
+        latest state now. Only call this while holding
+        self._internal_state_lock."""
+        if self._state_version == sent_version:
+            return False
+        return (time.monotonic() >= next_send_time or
+                self._has_new_commands_simulated(peer, sent_command_seq))
+
+    def _has_new_commands_simulated(self, peer: str,
+                                    sent_command_seq: int) -> bool:
+        """Returns True if the latest state has the last command a client
+        sent simulated, and the state it was last sent, which had commands
+        up to sent_command_seq simulated, didn't. Only call this while
+        holding self._internal_state_lock."""
+        client_command_seq = self._client_command_seqs.get(peer)
+        return (client_command_seq is not None and
+                sent_command_seq < client_command_seq <=
+                self._simulated_command_seq)
+
+    def _notify_waiters(self):
+        """Wakes up every subscribe_state stream, so that they can check if
+        they should send a new state. Only call this while holding
+        self._internal_state_lock."""
+        self._state_change.notify_all()
+
+    def _latest_snapshot(self) -> _Snapshot:
+        # Only call this while holding self._internal_state_lock.
+        if self._snapshot is None or \
+                self._snapshot_state_version != self._state_version:
+            state = self._internal_state_copy
+            entity_table = protos.EntityTable(entities=[
+                protos.Entity(**{
+                    field: getattr(entity, field)
+                    for field in _PER_ENTITY_UNCHANGING_FIELDS})
+                for entity in state.entities
+            ])
+
+            entity_table_version = 0
+            if self._snapshot is not None:
+                entity_table_version = self._snapshot.entity_table_version
+                if entity_table != self._snapshot.entity_table:
+                    entity_table_version += 1
+
+            # Segments usually last for a few states, so only fit the ones
+            # we haven't seen before.
+            already_fitted = {
+                id(segment.solution): fitted
+                for segment, fitted in self._fitted_trajectory
+                if not isinstance(segment, protos.TrajectorySegment)}
+
+            def fit(segment) -> protos.TrajectorySegment:
+                if isinstance(segment, protos.TrajectorySegment):
+                    # Already fitted, e.g. by a session's worker process.
+                    return segment
+                if id(segment.solution) in already_fitted:
+                    return already_fitted[id(segment.solution)]
+                return _fit_segment(segment)
+
+            self._fitted_trajectory = [
+                (segment, fit(segment))
+                for segment in self._internal_trajectory]
+
+            self._snapshot = _Snapshot(
+                state_version=self._state_version,
+                entity_table=entity_table,
+                entity_table_version=entity_table_version,
+                y=PhysicsState(None, state).y0(),
+                physical_state=state,
+                trajectory=[fitted for _, fitted in self._fitted_trajectory])
+            self._snapshot_state_version = self._state_version
+        return self._snapshot
+
+    def send_commands(
+            self, request_iterator: Iterable[protos.Command], context) \
+            -> protos.CommandsReceived:
+        """Server-side implementation of the send_commands RPC. Clients keep
+        this stream open while they're subscribed to state updates."""
+        n_commands = 0
+
+        def count_commands():
+            nonlocal n_commands
+            for request in request_iterator:
+                n_commands += 1
+                yield request
+
+        self._receive_commands(count_commands(), context)
+        return protos.CommandsReceived(n_commands=n_commands)
+
+    def _receive_commands(
+            self, request_iterator: Iterable[protos.Command], context) \
+            -> Optional[protos.Command.ClientType]:
+        """Queues up commands for pop_commands, and returns the type of the
+        client that sent them."""
         client_type: Optional[protos.Command.ClientType] = None
         for request in request_iterator:
-            if client_type is None:
-                client_type = request.client
-            else:
-                assert client_type == request.client
+            client_type = self._receive_command(
+                request, client_type, context.peer())
+        return client_type
 
-            if request.ident != protos.Command.NOOP:
-                self._commands.put(request)
-        assert client_type is not None
+    def _receive_command(
+            self, request: protos.Command,
+            client_type: Optional[protos.Command.ClientType], peer: str) \
+            -> protos.Command.ClientType:
+        if client_type is not None:
+            assert client_type == request.client
+
+        if request.ident != protos.Command.NOOP:
+            with self._state_change:
+                # Numbered while holding the lock, so that commands are
+                # queued in the order of their numbers.
+                self._command_seq += 1
+                self._commands.put(
+                    (time.monotonic(), self._command_seq, request))
+                self._client_command_seqs[peer] = self._command_seq
+                self._notify_waiters()
+            self._update_client_list(peer, request.client)
+        return request.client
 
-        if context.peer() not in self.addr_to_connected_clients:
-            self.addr_to_connected_clients[context.peer()] = \
+    def _update_client_list(
+            self, peer: str, client_type: protos.Command.ClientType):
+        if peer not in self.addr_to_connected_clients:
+            self.addr_to_connected_clients[peer] = \
                 SimpleNamespace(
                     client_type=self.CLIENT_TYPE_TO_STR[client_type],
-                    client_addr=context.peer()
+                    client_addr=peer
                 )
 
-        self.addr_to_connected_clients[context.peer()].last_contact = \
+        self.addr_to_connected_clients[peer].last_contact = \
             time.monotonic()
 
-        with self._internal_state_lock:
-            assert self._class_used_properly
-            return self._internal_state_copy
-
     def pop_commands(self) -> List[protos.Command]:
         """Returns all commands that have been sent to this server.
 
         Calling this method again immediately will likely return nothing."""
-        commands: List[protos.Command] = []
+        return [command for _, command in self.pop_timed_commands()]
+
+    def pop_timed_commands(self) -> List[Tuple[float, protos.Command]]:
+        """Like pop_commands, but each command comes with the
+        time.monotonic() at which this server received it."""
+        commands: List[Tuple[float, protos.Command]] = []
+        command_seq = None
         try:
             while True:
-                commands.append(self._commands.get_nowait())
+                received_time, command_seq, command = \
+                    self._commands.get_nowait()
+                commands.append((received_time, command))
         except queue.Empty:
             pass
+        if command_seq is not None:
+            with self._internal_state_lock:
+                self._popped_command_seq = command_seq
         return commands
 
+    def popped_command_seq(self) -> int:
+        """Returns the number of the last command that pop_commands
+        returned. Commands are numbered in the order they're received. Pass
+        this to notify_state_change once they're simulated, if they're
+        simulated somewhere else, like in another process."""
+        with self._internal_state_lock:
+            return self._popped_command_seq
+
+    def wait_for_commands(self, timeout: Optional[float]) -> bool:
+        """Blocks until a client has sent a command, or for timeout seconds.
+        Returns True if there are commands for pop_commands."""
+        with self._state_change:
+            return self._state_change.wait_for(
+                lambda: not self._commands.empty(), timeout)
+
     def refresh_client_list(self):
         self.addr_to_connected_clients.clear()
 
 
+class AsyncStateServer(StateServer):
+    """A StateServer that serves clients from an asyncio event loop, instead
+    of from a pool of threads.
+
+    A threaded StateServer needs a thread for every subscribed client and
+    every open command stream, and all those threads fight the simthread for
+    the GIL. This serves any number of clients from one thread.
+
+    Usage:
+        state_server = AsyncStateServer()
+        state_server.notify_state_change(initial_state)
+        state_server.start()  # Serves from a new thread, doesn't block.
+        while True:
+            commands = state_server.pop_commands()
+            ...
+            state_server.notify_state_change(state)
+        state_server.stop()
+
+    notify_state_change, pop_commands, and the client list can be used from
+    any thread, just like with a StateServer.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[threading.Thread] = None
+        self._server: Optional[grpc.aio.Server] = None
+        # Set and replaced every time there's a new state or command. Only
+        # used from the event loop.
+        self._changed: Optional[asyncio.Event] = None
+
+    def start(self, port: int = DEFAULT_PORT):
+        """Starts serving clients from a new thread running an asyncio event
+        loop. Returns once the server is ready for clients."""
+        assert self._loop is None
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(
+            target=self._loop.run_forever, name='grpc-aio', daemon=True)
+        self._loop_thread.start()
+        asyncio.run_coroutine_threadsafe(
+            self._start_server(port), self._loop).result()
+
+    async def _start_server(self, port: int):
+        self._use_loop(self._loop)
+        self._server = grpc.aio.server()
+        add_state_server_to_server(self, self._server)
+        self._server.add_insecure_port(f'[::]:{port}')
+        await self._server.start()
+
+    def stop(self, grace: Optional[float] = None):
+        """Stops serving clients, waiting up to grace seconds for RPCs to
+        finish, and stops the event loop."""
+        if self._loop is None:
+            return
+        assert self._server is not None and self._loop_thread is not None
+        asyncio.run_coroutine_threadsafe(
+            self._server.stop(grace), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def _use_loop(self, loop: asyncio.AbstractEventLoop):
+        """Serves clients from loop, which something else runs. Used
+        instead of start() and stop() by a SessionServer."""
+        self._loop = loop
+        self._changed = asyncio.Event()
+
+    def _notify_waiters(self):
+        super()._notify_waiters()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake_subscribers)
+
+    def _wake_subscribers(self):
+        # Called in the event loop.
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def get_physical_state(  # type: ignore[override]
+            self, request_iterator: AsyncIterable[protos.Command],
+            context) -> bytes:
+        """Server-side implementation of the get_physical_state RPC."""
+        client_type = await self._receive_commands_async(
+            request_iterator, context)
+        assert client_type is not None
+        self._update_client_list(context.peer(), client_type)
+
+        with self._internal_state_lock:
+            assert self._class_used_properly
+            return self._internal_state_bytes
+
+    async def subscribe_state(  # type: ignore[override]
+            self, subscription: protos.Subscription, context) \
+            -> AsyncIterator[bytes]:
+        """Server-side implementation of the subscribe_state RPC. See
+        StateServer.subscribe_state.
+
+        When the client disconnects, GRPC cancels this coroutine."""
+        encoder = PackedStateEncoder(
+            subscription.deltas, subscription.trajectory,
+            subscription.interests)
+        schedule = _InterestSchedule(subscription)
+        peer = context.peer()
+        sent_version = 0
+        sent_command_seq = 0
+
+        while True:
+            with self._internal_state_lock:
+                should_send = self._should_send(
+                    peer, sent_version, sent_command_seq,
+                    schedule.next_send_time())
+                if should_send:
+                    assert self._class_used_properly
+                    everything = self._has_new_commands_simulated(
+                        peer, sent_command_seq)
+                    sent_version = self._state_version
+                    sent_command_seq = self._simulated_command_seq
+                    snapshot = self._latest_snapshot()
+                    changed = None
+                else:
+                    # Any newer state or command will set this event, since
+                    # the event loop only replaces it after this coroutine
+                    # starts waiting on it.
+                    changed = self._changed
+                    timeout = None
+                    if self._state_version != sent_version:
+                        # There's a new state, but it's too soon to send.
+                        timeout = max(
+                            0, schedule.next_send_time() - time.monotonic())
+
+            if changed is not None:
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due = schedule.pop_due(everything)
+            self._update_client_list(peer, subscription.client)
+            yield encoder.encode(snapshot, due)
+
+    async def subscribe_lockstep(  # type: ignore[override]
+            self, subscription: protos.Subscription, context) \
+            -> AsyncIterator[bytes]:
+        """Server-side implementation of the subscribe_lockstep RPC. See
+        StateServer.subscribe_lockstep."""
+        peer = context.peer()
+        next_step: Optional[int] = None
+
+        while True:
+            with self._internal_state_lock:
+                if self._has_lockstep_steps(next_step):
+                    next_step, steps = self._pop_lockstep_steps(next_step)
+                    changed = None
+                else:
+                    changed = self._changed
+
+            if changed is not None:
+                await changed.wait()
+                continue
+
+            self._update_client_list(peer, subscription.client)
+            for step in steps:
+                yield step
+
+    async def send_commands(  # type: ignore[override]
+            self, request_iterator: AsyncIterable[protos.Command],
+            context) -> protos.CommandsReceived:
+        """Server-side implementation of the send_commands RPC."""
+        n_commands = 0
+
+        async def count_commands():
+            nonlocal n_commands
+            async for request in request_iterator:
+                n_commands += 1
+                yield request
+
+        await self._receive_commands_async(count_commands(), context)
+        return protos.CommandsReceived(n_commands=n_commands)
+
+    async def _receive_commands_async(
+            self, request_iterator: AsyncIterable[protos.Command], context) \
+            -> Optional[protos.Command.ClientType]:
+        client_type: Optional[protos.Command.ClientType] = None
+        async for request in request_iterator:
+            client_type = self._receive_command(
+                request, client_type, context.peer())
+        return client_type
+
+
+class SessionServer:
+    """Serves many sessions from one GRPC server and one event loop. Each
+    session is its own simulation, and has its own AsyncStateServer.
+
+    Clients pick a session with StateClient(session=...), and every RPC they
+    make is handled by that session's AsyncStateServer. Clients that don't
+    pick a session get the first session added. Clients that pick a session
+    that doesn't exist get a NOT_FOUND error.
+
+    Usage:
+        session_server = SessionServer()
+        alpha = session_server.add_session('alpha')
+        alpha.notify_state_change(initial_state)
+        session_server.start()  # Serves from a new thread, doesn't block.
+        while True:
+            commands = alpha.pop_commands()
+            ...
+            alpha.notify_state_change(state)
+            if session_server.idle_time('alpha') > 60:
+                ...  # Nobody has been connected to alpha for a minute.
+        session_server.stop()
+    """
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread: Optional[threading.Thread] = None
+        self._server: Optional[grpc.aio.Server] = None
+        self._sessions: Dict[str, AsyncStateServer] = {}
+        self._default_session: Optional[str] = None
+        # How many RPCs are being handled for each session, and when the
+        # last one finished. Only changed from the event loop.
+        self._active_rpcs: Dict[str, int] = {}
+        self._last_rpc_time: Dict[str, float] = {}
+
+    def add_session(self, name: str) -> AsyncStateServer:
+        """Returns the AsyncStateServer of a new session. Don't call start()
+        or stop() on it, this SessionServer does that."""
+        assert name not in self._sessions, name
+        state_server = AsyncStateServer()
+        state_server._use_loop(self._loop)
+        self._active_rpcs[name] = 0
+        self._last_rpc_time[name] = time.monotonic()
+        self._sessions[name] = state_server
+        if self._default_session is None:
+            self._default_session = name
+        return state_server
+
+    def idle_time(self, name: str) -> float:
+        """Returns how many seconds it's been since a client of the named
+        session was connected, or 0 if a client is connected now."""
+        if self._active_rpcs[name] != 0:
+            return 0.0
+        return time.monotonic() - self._last_rpc_time[name]
+
+    def last_rpc_time(self, name: str) -> float:
+        """Returns the time.monotonic() at which the last RPC of the named
+        session finished, even one too short to see in idle_time()."""
+        return self._last_rpc_time[name]
+
+    def start(self, port: int = DEFAULT_PORT):
+        """Starts serving clients from a new thread running an asyncio event
+        loop. Returns once the server is ready for clients."""
+        assert self._loop_thread is None
+        self._loop_thread = threading.Thread(
+            target=self._loop.run_forever, name='grpc-aio', daemon=True)
+        self._loop_thread.start()
+        asyncio.run_coroutine_threadsafe(
+            self._start_server(port), self._loop).result()
+
+    async def _start_server(self, port: int):
+        self._server = grpc.aio.server()
+        add_state_server_to_server(self, self._server)
+        self._server.add_insecure_port(f'[::]:{port}')
+        await self._server.start()
+
+    def stop(self, grace: Optional[float] = None):
+        """Stops serving clients, waiting up to grace seconds for RPCs to
+        finish, and stops the event loop."""
+        if self._loop_thread is None:
+            return
+        assert self._server is not None
+        asyncio.run_coroutine_threadsafe(
+            self._server.stop(grace), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop_thread = None
+        self._loop.close()
+
+    async def _session(self, context) -> Tuple[str, AsyncStateServer]:
+        """Returns the session the client of an RPC picked, and its
+        AsyncStateServer, or ends the RPC if there's no such session."""
+        metadata = dict(context.invocation_metadata() or ())
+        name = metadata.get(SESSION_METADATA_KEY, DEFAULT_SESSION)
+        if name == DEFAULT_SESSION and self._default_session is not None:
+            name = self._default_session
+        if name not in self._sessions:
+            await context.abort(
+                grpc.StatusCode.NOT_FOUND, f'There is no session "{name}".')
+        return name, self._sessions[name]
+
+    @contextlib.contextmanager
+    def _handling_rpc(self, name: str):
+        # Called from the event loop, around every RPC of the named session.
+        self._active_rpcs[name] += 1
+        try:
+            yield
+        finally:
+            self._active_rpcs[name] -= 1
+            self._last_rpc_time[name] = time.monotonic()
+
+    async def get_physical_state(
+            self, request_iterator: AsyncIterable[protos.Command],
+            context) -> bytes:
+        name, state_server = await self._session(context)
+        with self._handling_rpc(name):
+            return await state_server.get_physical_state(
+                request_iterator, context)
+
+    async def subscribe_state(
+            self, subscription: protos.Subscription, context) \
+            -> AsyncIterator[bytes]:
+        name, state_server = await self._session(context)
+        with self._handling_rpc(name):
+            async for packed_state in state_server.subscribe_state(
+                    subscription, context):
+                yield packed_state
+
+    async def send_commands(
+            self, request_iterator: AsyncIterable[protos.Command],
+            context) -> protos.CommandsReceived:
+        name, state_server = await self._session(context)
+        with self._handling_rpc(name):
+            return await state_server.send_commands(
+                request_iterator, context)
+
+    async def subscribe_lockstep(
+            self, subscription: protos.Subscription, context) \
+            -> AsyncIterator[bytes]:
+        name, state_server = await self._session(context)
+        with self._handling_rpc(name):
+            async for step in state_server.subscribe_lockstep(
+                    subscription, context):
+                yield step
+
+
+def _min_update_interval(subscription: protos.Subscription) -> float:
+    if subscription.max_updates_per_second > 0:
+        return 1 / subscription.max_updates_per_second
+    return 0.0
+
+
+def add_state_server_to_server(
+        state_server: Union[StateServer, SessionServer],
+        server: Union[grpc.Server, grpc.aio.Server]):
+    """Like orbitx_pb2_grpc.add_StateServerServicer_to_server, except that
+    responses are sent as the bytes that state_server already serialized."""
+    # A response_serializer of None means responses are already bytes.
+    server.add_generic_rpc_handlers([grpc.method_handlers_generic_handler(
+        'StateServer', {
+            'get_physical_state': grpc.stream_unary_rpc_method_handler(
+                state_server.get_physical_state,
+                request_deserializer=protos.Command.FromString,
+                response_serializer=None),
+            'subscribe_state': grpc.unary_stream_rpc_method_handler(
+                state_server.subscribe_state,
+                request_deserializer=protos.Subscription.FromString,
+                response_serializer=None),
+            'send_commands': grpc.stream_unary_rpc_method_handler(
+                state_server.send_commands,
+                request_deserializer=protos.Command.FromString,
+                response_serializer=protos.CommandsReceived.SerializeToString),
+            'subscribe_lockstep': grpc.unary_stream_rpc_method_handler(
+                state_server.subscribe_lockstep,
+                request_deserializer=protos.Subscription.FromString,
+                response_serializer=None),
+        })])
+
+
+def _shared_state_dtypes(capacity: int) -> Tuple[np.dtype, np.dtype]:
+    """Returns the dtypes of the header and of each slot of the shared memory
+    written by SharedStatePublisher."""
+    header = np.dtype([
+        # The sequence number of the latest state, or 0 if there isn't one.
+        ('latest', np.uint64),
+        ('capacity', np.uint64),
+    ])
+    slot = np.dtype([
+        # Odd while a state is being written to this slot. 2 * the sequence
+        # number of the state in this slot once it's written.
+        ('seq', np.uint64),
+        # See _entity_layout.
+        ('layout', np.uint64),
+        ('length', np.uint64),
+        ('timestamp', np.float64),
+        ('y', PhysicsState.DTYPE, (capacity,)),
+    ])
+    return header, slot
+
+
+def _entity_layout(entity_names: Iterable[str]) -> int:
+    """Identifies which entities a y-vector has, and in which order. Unlike
+    hash(), this is the same in every process."""
+    return zlib.crc32('\0'.join(entity_names).encode())
+
+
+# Names of shared memory this process made. See SharedStateReader.
+_published_shared_memory: set = set()
+
+
+class SharedStatePublisher:
+    """Writes the y-vector of each state to shared memory, so that clients on
+    the same computer can read it without any networking or parsing.
+
+    The shared memory is a ring buffer of SHARED_STATE_SLOTS slots. Every
+    slot is a seqlock: its sequence number is odd while it's being written.
+    Readers check that the sequence number didn't change while they were
+    copying the slot, so they never see half of a state. Writing to a
+    different slot every time means readers almost never have to retry.
+
+    Only the y-vector is shared. Clients still get everything else, like
+    the entity table and craft, from a subscription. See
+    StateClient.subscribe.
+
+    Usage:
+        publisher = SharedStatePublisher(state, shared_state_name())
+        while True:
+            ...
+            publisher.publish(state)
+        publisher.close()
+    """
+
+    def __init__(self, state: PhysicsState, name: str):
+        # Leave room for entities to be added.
+        capacity = 2 * len(state.y0())
+        header_dtype, slot_dtype = _shared_state_dtypes(capacity)
+        size = header_dtype.itemsize + SHARED_STATE_SLOTS * slot_dtype.itemsize
+        try:
+            self._memory = shared_memory.SharedMemory(
+                name, create=True, size=size)
+        except FileExistsError:
+            # Left over from a physics server that crashed.
+            shared_memory.SharedMemory(name).unlink()
+            self._memory = shared_memory.SharedMemory(
+                name, create=True, size=size)
+        _published_shared_memory.add(self._memory.name)
+
+        self._header = np.ndarray(
+            (), dtype=header_dtype, buffer=self._memory.buf)
+        self._slots = np.ndarray(
+            (SHARED_STATE_SLOTS,), dtype=slot_dtype, buffer=self._memory.buf,
+            offset=header_dtype.itemsize)
+        self._header['latest'] = 0
+        self._header['capacity'] = capacity
+        self._slots['seq'] = 0
+        self._seq = 0
+        self._warned_capacity = False
+
+    def publish(self, state: PhysicsState):
+        y = state.y0()
+        if len(y) > self._header['capacity']:
+            # Readers will fall back to their subscriptions.
+            if not self._warned_capacity:
+                log.warning(
+                    f'Not sharing states with {len(state)} entities, there '
+                    'is only room for fewer.')
+                self._warned_capacity = True
+            self._header['latest'] = 0
+            return
+
+        self._seq += 1
+        slot = self._slots[self._seq % SHARED_STATE_SLOTS]
+        slot['seq'] = 2 * self._seq - 1
+        slot['layout'] = _entity_layout(state._entity_names)
+        slot['length'] = len(y)
+        slot['timestamp'] = state.timestamp
+        slot['y'][:len(y)] = y
+        slot['seq'] = 2 * self._seq
+        self._header['latest'] = self._seq
+
+    def close(self):
+        del self._header, self._slots
+        self._memory.close()
+        self._memory.unlink()
+        _published_shared_memory.discard(self._memory.name)
+
+
+class SharedStateReader:
+    """Reads the y-vectors that a SharedStatePublisher on this computer
+    writes. Raises FileNotFoundError if there isn't one."""
+
+    # If the publisher keeps overwriting the slot we're reading, give up.
+    MAX_READ_ATTEMPTS = 10
+
+    def __init__(self, name: str):
+        self._memory = shared_memory.SharedMemory(name)
+        if self._memory.name not in _published_shared_memory:
+            # Otherwise, Python deletes the shared memory when this process
+            # exits, even though the physics server still uses it.
+            resource_tracker.unregister(
+                self._memory._name, 'shared_memory')  # type: ignore
+
+        header_dtype, _ = _shared_state_dtypes(0)
+        capacity = int(np.ndarray(
+            (), dtype=header_dtype, buffer=self._memory.buf)['capacity'])
+        header_dtype, slot_dtype = _shared_state_dtypes(capacity)
+        self._header = np.ndarray(
+            (), dtype=header_dtype, buffer=self._memory.buf)
+        self._slots = np.ndarray(
+            (SHARED_STATE_SLOTS,), dtype=slot_dtype, buffer=self._memory.buf,
+            offset=header_dtype.itemsize)
+        # Views of each field of every slot, which are much faster to read
+        # than fields of a structured array.
+        self._latest = self._header['latest']
+        self._seqs = self._slots['seq']
+        self._layouts = self._slots['layout']
+        self._lengths = self._slots['length']
+        self._timestamps = self._slots['timestamp']
+        self._ys = self._slots['y']
+
+    @property
+    def latest_seq(self) -> int:
+        """The sequence number of the latest state, or 0 if there isn't one.
+        This goes up by one every time a state is published."""
+        return int(self._latest)
+
+    def read(self) -> Optional[Tuple[int, int, float, np.ndarray]]:
+        """Returns the sequence number, entity layout, timestamp, and a copy of
+        the y-vector of the latest state. Returns None if there isn't one, or
+        if it kept changing while we were reading it."""
+        for _ in range(self.MAX_READ_ATTEMPTS):
+            seq = int(self._latest)
+            if seq == 0:
+                return None
+            slot = seq % SHARED_STATE_SLOTS
+            if self._seqs[slot] != 2 * seq:
+                # Already being overwritten by a newer state.
+                continue
+            layout = int(self._layouts[slot])
+            timestamp = float(self._timestamps[slot])
+            y = self._ys[slot, :int(self._lengths[slot])].copy()
+            if self._seqs[slot] == 2 * seq:
+                return seq, layout, timestamp, y
+        return None
+
+    def close(self):
+        del self._header, self._slots, self._latest, self._seqs, \
+            self._layouts, self._lengths, self._timestamps, self._ys
+        self._memory.close()
+
+
+def _is_this_computer(hostname: str) -> bool:
+    return hostname in ['localhost', '127.0.0.1', '::1',
+                        socket.gethostname(), socket.getfqdn()]
+
+
 class StateClient:
     """
     Allows clients to easily communicate to the Physics Server.
@@ -120,14 +1355,56 @@ class StateClient:
         connection = StateClient('localhost')
         while True:
             physics_state = connection.get_state()
+
+    Or, to have the server send states without asking every time:
+        connection = StateClient('localhost')
+        connection.subscribe(max_updates_per_second=1)
+        while True:
+            connection.send_commands(commands)
+            physics_state = connection.pop_state()  # None if nothing new.
+
+    Or, to draw smooth motion in between states from the server:
+        connection = StateClient('localhost')
+        connection.subscribe(max_updates_per_second=1, trajectory=True)
+        while True:
+            physics_state = connection.current_state()
+
+    If the physics server hosts many sessions, pick one with e.g.
+    StateClient(..., 'localhost', session='alpha'). See SessionServer.
     """
 
-    def __init__(self, client: protos.Command.ClientType, hostname: str):
+    def __init__(self, client: protos.Command.ClientType, hostname: str,
+                 session: str = DEFAULT_SESSION, port: int = DEFAULT_PORT):
+        self._hostname = hostname
+        self._port = port
+        # Sent with every RPC, so that a physics server with many sessions
+        # knows which one we mean.
+        self._session = session
+        self._metadata = ((SESSION_METADATA_KEY, session),)
         self.channel = grpc.insecure_channel(
-            f'{hostname}:{DEFAULT_PORT}')
+            f'{hostname}:{port}')
         self.stub = grpc_stubs.StateServerStub(self.channel)
         self.client_type = client
 
+        # Set by subscribe(). The subscription thread gives every state it
+        # gets to self._decoder, and self._outgoing_commands is drained by
+        # the send_commands stream.
+        self._subscription_lock = threading.Lock()
+        self._decoder = PackedStateDecoder()
+        self._new_state = False
+        # When the latest state was received, according to time.monotonic().
+        self._received_time: Optional[float] = None
+        # Set by subscribe(shared_memory=True), if the physics server is on
+        # this computer. The sequence number of the last state we read from
+        # it, and the entity layout of our subscription.
+        self._shared_state: Optional[SharedStateReader] = None
+        self._shared_state_seq = 0
+        self._shared_state_layout: Optional[int] = None
+        self._subscription_error: Optional[grpc.RpcError] = None
+        self._outgoing_commands: Optional[queue.Queue] = None
+        self._command_stream: Optional[grpc.Future] = None
+        self._subscription: Optional[threading.Thread] = None
+
     def get_state(self, commands: List[Request] = None) \
             -> PhysicsState:
 
@@ -139,4 +1416,177 @@ class StateClient:
                 command.client = self.client_type
             commands_iter = iter(commands)
         return PhysicsState(None,
-                            self.stub.get_physical_state(commands_iter))
+                            self.stub.get_physical_state(
+                                commands_iter, metadata=self._metadata))
+
+    def subscribe(self, max_updates_per_second: float = 0,
+                  deltas: bool = True, trajectory: bool = False,
+                  interests: Sequence[Interest] = (),
+                  shared_memory: bool = False):
+        """Starts receiving new states from the server in the background.
+        Use pop_state() to get them, and send_commands() to send commands.
+
+        If deltas is set, the server only sends the parts of each state that
+        changed, which is smaller but means every update has to be decoded.
+
+        If trajectory is set, the server also sends what it has simulated
+        after each state, so that current_state() can move entities along.
+
+        If interests are given, the server only sends the fields of the
+        entities in them, each at its own rate. The other fields are zero,
+        or whatever they were when they were last sent. For example, this gets
+        where Earth is in every state, and all of the Habitat once a minute:
+            connection.subscribe(interests=[
+                Interest(entities=['Earth'], fields=['x', 'y']),
+                Interest(entities=['Habitat'], max_updates_per_second=1/60)])
+
+        If shared_memory is set, and the physics server is on this computer,
+        pop_state() reads every new y-vector straight from the physics
+        server's memory, see SharedStatePublisher. The rest of the state still
+        comes from the subscription, which can then be slow.
+        """
+        assert self._subscription is None
+        if shared_memory and _is_this_computer(self._hostname):
+            try:
+                self._shared_state = SharedStateReader(
+                    shared_state_name(self._session, self._port))
+            except FileNotFoundError:
+                log.info('Physics server is not sharing memory, using '
+                         'only the network.')
+        self._open_command_stream()
+
+        states = self.stub.subscribe_state(protos.Subscription(
+            client=self.client_type,
+            max_updates_per_second=max_updates_per_second,
+            deltas=deltas,
+            trajectory=trajectory,
+            interests=interests), metadata=self._metadata)
+        self._subscription = threading.Thread(
+            target=self._receive_states, args=(states,),
+            name='state subscription', daemon=True)
+        self._subscription.start()
+
+    def subscribe_packed(self, max_updates_per_second: float = 0,
+                         deltas: bool = True, trajectory: bool = False) \
+            -> Iterator[protos.PackedState]:
+        """Like subscribe(), but returns the stream of PackedStates itself,
+        for callers that want to handle every state as soon as it arrives.
+        Give each PackedState to a PackedStateDecoder, in order, to get the
+        states. Cancel the stream to end it.
+
+        Use send_commands() to send commands."""
+        if self._outgoing_commands is None:
+            self._open_command_stream()
+        return self.stub.subscribe_state(protos.Subscription(
+            client=self.client_type,
+            max_updates_per_second=max_updates_per_second,
+            deltas=deltas,
+            trajectory=trajectory), metadata=self._metadata)
+
+    def subscribe_lockstep(self) -> Iterator[protos.LockstepStep]:
+        """Returns the stream of steps of a physics server in lockstep
+        mode, starting with a snapshot of its latest state. Cancel the stream
+        to end it. See lockstep.LockstepMirror, which follows this stream.
+
+        Use send_commands() to send commands, which the server applies at
+        the start of its next step."""
+        if self._outgoing_commands is None:
+            self._open_command_stream()
+        return self.stub.subscribe_lockstep(
+            protos.Subscription(client=self.client_type),
+            metadata=self._metadata)
+
+    def _open_command_stream(self):
+        self._outgoing_commands = queue.Queue()
+        # This stream stays open until close(), and sends commands as soon
+        # as they're put in the queue. None ends the stream.
+        self._command_stream = self.stub.send_commands.future(
+            iter(self._outgoing_commands.get, None), metadata=self._metadata)
+
+    def _receive_states(self, states: Iterator[protos.PackedState]):
+        try:
+            for packed_state in states:
+                with self._subscription_lock:
+                    self._decoder.update(packed_state)
+                    self._new_state = True
+                    self._received_time = time.monotonic()
+                    if packed_state.HasField('entity_table'):
+                        self._shared_state_layout = _entity_layout(
+                            entity.name for entity in
+                            packed_state.entity_table.entities)
+        except grpc.RpcError as err:
+            if err.code() != grpc.StatusCode.CANCELLED:
+                log.error(f'State subscription ended with {err.code()}')
+                with self._subscription_lock:
+                    self._subscription_error = err
+
+    def pop_state(self) -> Optional[PhysicsState]:
+        """Returns the newest state the server sent, or None if the server
+        hasn't sent anything since the last call. Only use after subscribe().
+        """
+        assert self._subscription is not None
+        with self._subscription_lock:
+            if self._subscription_error is not None:
+                raise self._subscription_error
+            shared_state = self._pop_shared_state()
+            if shared_state is not None:
+                return shared_state
+            if not self._new_state:
+                return None
+            self._new_state = False
+            return self._decoder.state()
+
+    def _pop_shared_state(self) -> Optional[PhysicsState]:
+        # Only call this while holding self._subscription_lock.
+        if self._shared_state is None or self._received_time is None or \
+                self._shared_state.latest_seq == self._shared_state_seq:
+            return None
+        shared = self._shared_state.read()
+        if shared is None:
+            return None
+        seq, layout, timestamp, y = shared
+        if layout != self._shared_state_layout or \
+                timestamp < self._decoder.timestamp:
+            # Entities were added or removed, and our subscription hasn't
+            # told us about it yet. Or our subscription is ahead.
+            return None
+
+        self._shared_state_seq = seq
+        self._new_state = False
+        state = self._decoder.state(y)
+        state.timestamp = timestamp
+        return state
+
+    def current_state(self) -> Optional[PhysicsState]:
+        """Returns the newest state the server sent, moved along to the
+        current simtime using the trajectory the server sent with it. Returns
+        None if the server hasn't sent anything yet. Only use after
+        subscribe(trajectory=True).
+
+        Unlike pop_state(), this returns a state every time it's called."""
+        assert self._subscription is not None
+        with self._subscription_lock:
+            if self._subscription_error is not None:
+                raise self._subscription_error
+            if self._received_time is None:
+                return None
+            self._new_state = False
+            return self._decoder.state_at(
+                self._decoder.timestamp +
+                (time.monotonic() - self._received_time) *
+                self._decoder.time_acc)
+
+    def send_commands(self, commands: List[Request]):
+        """Sends commands to the server without waiting for a reply. Only
+        use after subscribe() or subscribe_lockstep()."""
+        assert self._outgoing_commands is not None
+        for command in commands:
+            command.client = self.client_type
+            self._outgoing_commands.put(command)
+
+    def close(self):
+        if self._outgoing_commands is not None:
+            self._outgoing_commands.put(None)
+        if self._shared_state is not None:
+            self._shared_state.close()
+        self.channel.close()
@@ -7,12 +7,11 @@ import string
 import struct
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import numpy
-import scipy
 
-from orbitx.physics import calc
+from orbitx.physics import broad_phase, calc
 from orbitx import common
 from orbitx import network
 from orbitx import orbitx_pb2 as protos
@@ -533,51 +532,49 @@ def _string_to_float(item: str) -> float:
 
 def _separate_landed_entities(orbitx_state: PhysicsState) \
         -> PhysicsState:
-    n = len(orbitx_state)
-    # 2xN of (x, y) positions
-    posns = numpy.column_stack((orbitx_state.X, orbitx_state.Y))
-    # An n*n matrix of _altitudes_ between each entity
-    radii = numpy.array([entity.r for entity in orbitx_state])
-    alt_matrix = (
-            scipy.spatial.distance.cdist(posns, posns) -
-            numpy.array([radii]) - numpy.array([radii]).T)
-    numpy.fill_diagonal(alt_matrix, numpy.inf)
+    # (n, 2) view of (x, y) positions, moving entities changes orbitx_state.
+    posns = orbitx_state.Positions
+    radii = orbitx_state._table.r
+    masses = orbitx_state._table.mass
+    # Only entities that are close to each other can intersect. Moving an
+    # entity apart from one entity can bring it close to another, so the
+    # pairs are found again after every move. The broad phase only sorts
+    # anything again once something has moved out of its box.
+    nearby = broad_phase.SweepAndPrune(radii, lookahead=0)
+    no_velocities = numpy.zeros_like(posns)
+
+    def altitudes() -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        first, second = nearby.pairs(posns, no_velocities)
+        return first, second, (
+            numpy.hypot(posns[first, 0] - posns[second, 0],
+                        posns[first, 1] - posns[second, 1]) -
+            radii[first] - radii[second])
 
     # Find everything that has a very small or negative altitude, and make
     # sure that it has an altitude of at least 1.
+    first, second, alts = altitudes()
     infinite_loop_warning = 0
-    while numpy.min(alt_matrix) < 1:
+    while numpy.min(alts, initial=numpy.inf) < 1:
         infinite_loop_warning += 1
         assert infinite_loop_warning <= len(orbitx_state)
 
-        flattened_index = alt_matrix.argmin()
-        e1_index = flattened_index // n
-        e2_index = flattened_index % n
-        e1 = orbitx_state[e1_index]
-        e2 = orbitx_state[e2_index]
-        alt = numpy.min(alt_matrix)
-        assert abs(numpy.min(alt_matrix)) < 10, (
-            f"{e1.name} and {e2.name} were loaded from the OrbitV savefile, "
-            "but they greatly intersect each other with "
+        closest = alts.argmin()
+        e1_index = first[closest]
+        e2_index = second[closest]
+        alt = alts[closest]
+        assert abs(alt) < 10, (
+            f"{orbitx_state._entity_names[e1_index]} and "
+            f"{orbitx_state._entity_names[e2_index]} were loaded from the "
+            "OrbitV savefile, but they greatly intersect each other with "
             f"altitude={alt}. This probably shouldn't happen!")
 
-        if e1.mass < e2.mass:
-            smaller = e1
-            larger = e2
+        if masses[e1_index] < masses[e2_index]:
+            smaller, larger = e1_index, e2_index
         else:
-            smaller = e2
-            larger = e1
+            smaller, larger = e2_index, e1_index
 
-        norm = smaller.pos - larger.pos
-        norm = norm / numpy.linalg.norm(norm)
-
-        smaller.pos += norm * (alt + 1)
-        orbitx_state[smaller.name] = smaller
-
-        posns = numpy.column_stack((orbitx_state.X, orbitx_state.Y))
-        alt_matrix = (
-                scipy.spatial.distance.cdist(posns, posns) -
-                numpy.array([radii]) - numpy.array([radii]).T)
-        numpy.fill_diagonal(alt_matrix, numpy.inf)
+        norm = posns[smaller] - posns[larger]
+        posns[smaller] += norm / numpy.linalg.norm(norm) * (alt + 1)
+        first, second, alts = altitudes()
 
     return orbitx_state
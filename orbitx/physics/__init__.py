@@ -1,6 +1,8 @@
 """There's a lot of physics-related code, but all you really need are
-- the Physics Engine, physics.PhysicsEngine, and
+- the Physics Engine, physics.PhysicsEngine,
+- physics.simulate, to simulate without any threads or wall-clock time, and
 - miscellaneous calculation functions, physics.calc"""
 from . import engine
 
 PhysicsEngine = engine.PhysicsEngine
+simulate = engine.simulate
@@ -0,0 +1,221 @@
+"""Barnes-Hut gravity, for when there are too many entities for calc.grav_acc.
+
+calc.grav_acc calculates the gravitational pull between every pair of
+entities, which is O(N^2) in both time and memory. That's the fastest way to
+do it for the few dozen planets and moons in our usual savefiles, but it falls
+over with thousands of asteroids.
+
+grav_acc in this module puts all entities into a quadtree. When calculating
+the pull on an entity, any faraway node in the quadtree is treated as a single
+point mass at the node's centre of mass. A node is 'faraway' when
+    node width / distance to node < opening_angle
+so a smaller opening_angle is more accurate but slower, and an opening_angle
+of 0 is the same as calc.grav_acc. Nodes that contain the entity being pulled
+are always opened, so nearby pairs like the Habitat and Earth, or the Earth
+and the Moon, are always calculated exactly.
+
+Only the entities listed in `sources` are put into the quadtree, so any other
+entity is a test particle that is pulled on but doesn't pull on anything. See
+calc.grav_acc_from_sources.
+
+See https://en.wikipedia.org/wiki/Barnes%E2%80%93Hut_simulation for more.
+"""
+
+import math
+
+import numba
+import numpy as np
+
+from orbitx import common
+
+# Above this many entities, PhysicsEngine uses this module instead of
+# calc.grav_acc. Below this, the simplicity of calc.grav_acc wins.
+THRESHOLD = 256
+
+# The default opening angle. 0.5 is the usual choice, and typically has
+# acceleration errors of about a tenth of a percent.
+OPENING_ANGLE = 0.5
+
+# Entities that are closer than (size of the solar system) / 2**MAX_DEPTH get
+# put into the same quadtree leaf, and pull on each other directly.
+MAX_DEPTH = 48
+
+_EMPTY = -1
+_INTERNAL = -2
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def grav_acc(X, Y, M, Fuel, opening_angle, sources):
+    """Same as calc.grav_acc_from_sources, returns an N*2 array of
+    accelerations. To have every entity pull on every other entity, pass
+    np.arange(N) as sources."""
+    N = len(X)
+    M = M + Fuel
+    acc = np.zeros((N, 2))
+    if len(sources) == 0:
+        return acc
+
+    # Each node of the quadtree is a square, centred on (node_x, node_y) with
+    # a half-width of node_half.
+    # node_body is _EMPTY, _INTERNAL, or the index of the first entity in
+    # this leaf. Further entities in the same leaf are found by following
+    # next_body, until it's _EMPTY.
+    capacity = 4 * len(sources) + 16
+    node_children = np.full((capacity, 4), _EMPTY, dtype=np.int64)
+    node_body = np.full(capacity, _EMPTY, dtype=np.int64)
+    node_x = np.empty(capacity)
+    node_y = np.empty(capacity)
+    node_half = np.empty(capacity)
+    next_body = np.full(N, _EMPTY, dtype=np.int64)
+
+    min_x, max_x = X[sources].min(), X[sources].max()
+    min_y, max_y = Y[sources].min(), Y[sources].max()
+    node_x[0] = (min_x + max_x) / 2
+    node_y[0] = (min_y + max_y) / 2
+    node_half[0] = max(max_x - min_x, max_y - min_y, 1.0) / 2 * 1.0001
+    n_nodes = 1
+
+    for i in sources:
+        node = 0
+        depth = 0
+        while True:
+            if n_nodes + 2 >= capacity:
+                # Out of room for new nodes, double our storage.
+                capacity *= 2
+                new_children = np.full((capacity, 4), _EMPTY, dtype=np.int64)
+                new_children[:n_nodes] = node_children[:n_nodes]
+                node_children = new_children
+                new_body = np.full(capacity, _EMPTY, dtype=np.int64)
+                new_body[:n_nodes] = node_body[:n_nodes]
+                node_body = new_body
+                new_x = np.empty(capacity)
+                new_x[:n_nodes] = node_x[:n_nodes]
+                node_x = new_x
+                new_y = np.empty(capacity)
+                new_y[:n_nodes] = node_y[:n_nodes]
+                node_y = new_y
+                new_half = np.empty(capacity)
+                new_half[:n_nodes] = node_half[:n_nodes]
+                node_half = new_half
+
+            if node_body[node] == _EMPTY:
+                node_body[node] = i
+                break
+
+            if node_body[node] >= 0:
+                # This is a leaf with an entity already in it.
+                other = node_body[node]
+                if depth >= MAX_DEPTH or (X[other] == X[i] and
+                                          Y[other] == Y[i]):
+                    # Too close to tell apart, share this leaf.
+                    next_body[i] = next_body[other]
+                    next_body[other] = i
+                    break
+                # Split this leaf, moving its entities into a child.
+                quadrant = ((X[other] >= node_x[node]) +
+                            2 * (Y[other] >= node_y[node]))
+                child = n_nodes
+                n_nodes += 1
+                half = node_half[node] / 2
+                node_half[child] = half
+                node_x[child] = node_x[node] + (
+                    half if quadrant & 1 else -half)
+                node_y[child] = node_y[node] + (
+                    half if quadrant & 2 else -half)
+                node_body[child] = other
+                node_children[node, quadrant] = child
+                node_body[node] = _INTERNAL
+
+            # This is an internal node, descend into the right quadrant.
+            quadrant = (X[i] >= node_x[node]) + 2 * (Y[i] >= node_y[node])
+            child = node_children[node, quadrant]
+            if child == _EMPTY:
+                child = n_nodes
+                n_nodes += 1
+                half = node_half[node] / 2
+                node_half[child] = half
+                node_x[child] = node_x[node] + (
+                    half if quadrant & 1 else -half)
+                node_y[child] = node_y[node] + (
+                    half if quadrant & 2 else -half)
+                node_children[node, quadrant] = child
+            node = child
+            depth += 1
+
+    # Children always have a higher index than their parents, so going
+    # backwards we can sum up masses from the leaves to the root.
+    node_mass = np.zeros(n_nodes)
+    com_x = np.zeros(n_nodes)
+    com_y = np.zeros(n_nodes)
+    for node in range(n_nodes - 1, -1, -1):
+        if node_body[node] >= 0:
+            body = node_body[node]
+            while body != _EMPTY:
+                node_mass[node] += M[body]
+                com_x[node] += M[body] * X[body]
+                com_y[node] += M[body] * Y[body]
+                body = next_body[body]
+        else:
+            for quadrant in range(4):
+                child = node_children[node, quadrant]
+                if child != _EMPTY:
+                    node_mass[node] += node_mass[child]
+                    com_x[node] += com_x[child]
+                    com_y[node] += com_y[child]
+    for node in range(n_nodes):
+        if node_mass[node] > 0:
+            com_x[node] /= node_mass[node]
+            com_y[node] /= node_mass[node]
+        else:
+            com_x[node] = node_x[node]
+            com_y[node] = node_y[node]
+
+    # Walk the tree for each entity.
+    # Each level of the tree adds at most 3 more nodes to the stack.
+    stack = np.empty(4 * (MAX_DEPTH + 2), dtype=np.int64)
+    for i in range(N):
+        ax = 0.0
+        ay = 0.0
+        stack[0] = 0
+        stack_size = 1
+        while stack_size > 0:
+            stack_size -= 1
+            node = stack[stack_size]
+            if node_mass[node] == 0:
+                continue
+
+            if node_body[node] >= 0:
+                # A leaf, calculate the pull of each entity directly.
+                body = node_body[node]
+                while body != _EMPTY:
+                    if body != i:
+                        dx = X[body] - X[i]
+                        dy = Y[body] - Y[i]
+                        dist = math.sqrt(dx * dx + dy * dy)
+                        factor = common.G * M[body] / (dist * dist * dist)
+                        ax += factor * dx
+                        ay += factor * dy
+                    body = next_body[body]
+                continue
+
+            dx = com_x[node] - X[i]
+            dy = com_y[node] - Y[i]
+            dist = math.sqrt(dx * dx + dy * dy)
+            contains_i = (abs(X[i] - node_x[node]) <= node_half[node] and
+                          abs(Y[i] - node_y[node]) <= node_half[node])
+            if not contains_i and 2 * node_half[node] < opening_angle * dist:
+                # Far enough away to treat as a single point mass.
+                factor = common.G * node_mass[node] / (dist * dist * dist)
+                ax += factor * dx
+                ay += factor * dy
+            else:
+                for quadrant in range(4):
+                    child = node_children[node, quadrant]
+                    if child != _EMPTY:
+                        stack[stack_size] = child
+                        stack_size += 1
+
+        acc[i, 0] = ax
+        acc[i, 1] = ay
+
+    return acc
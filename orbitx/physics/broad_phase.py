@@ -0,0 +1,109 @@
+"""A broad phase for collision detection, for when there are too many entities
+to check every pair of them.
+
+CollisionEvent normally calculates the altitude of every entity above every
+other entity, which is O(N^2) every time the event is evaluated. That's the
+fastest way to do it for the few dozen planets and moons in our usual
+savefiles, but it falls over with thousands of pieces of debris.
+
+SweepAndPrune in this module finds the few pairs of entities that are close
+enough to collide soon, and only those pairs get their altitudes calculated.
+Each entity gets a bounding box, which is its radius plus how far it could
+travel in a while at its current speed. Sorting the boxes by their left edges
+and sweeping along x finds every pair of overlapping boxes, which is close to
+O(N) when few of them overlap.
+
+The pairs stay valid until some entity has moved out of its box, so most
+evaluations of CollisionEvent don't sort anything. When the pairs are found
+again, the entities are sorted starting from their last order. Entities
+don't change order much between steps, and sorting an almost-sorted array
+with a stable sort (timsort) is also close to O(N).
+
+See https://en.wikipedia.org/wiki/Sweep_and_prune for more.
+"""
+
+from typing import Tuple
+
+import numpy as np
+
+# Above this many entities, PhysicsEngine uses this module in CollisionEvent.
+# Below this, calculating every altitude wins.
+THRESHOLD = 64
+
+# Every pair of entities that SweepAndPrune.pairs doesn't return has an
+# altitude of at least this many metres.
+CLEARANCE = 1000
+
+
+def overlapping_pairs(order: np.ndarray, posns: np.ndarray,
+                      half_widths: np.ndarray
+                      ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Finds every pair of overlapping squares, centred on posns with
+    half_widths. order is a permutation of entity indices that's hopefully
+    almost sorted by the left edges of the squares.
+
+    Returns (order, first, second), where order is sorted by the left edges
+    of the squares, and squares first[k] and second[k] overlap. Each pair
+    is only returned once."""
+    left = posns[:, 0] - half_widths
+    order = order[np.argsort(left[order], kind='stable')]
+    sorted_left = left[order]
+    sorted_right = posns[order, 0] + half_widths[order]
+
+    # The square at order[k] overlaps, along x, the squares from order[k + 1]
+    # up to but not including order[ends[k]].
+    ends = np.searchsorted(sorted_left, sorted_right, side='right')
+    counts = ends - np.arange(len(order)) - 1
+    sorted_first = np.repeat(np.arange(len(order)), counts)
+    # How far along each run of overlapping squares every pair is.
+    run_offsets = np.arange(len(sorted_first)) - np.repeat(
+        np.cumsum(counts) - counts, counts)
+    first = order[sorted_first]
+    second = order[sorted_first + 1 + run_offsets]
+
+    # The squares must also overlap along y.
+    overlapping = np.abs(posns[first, 1] - posns[second, 1]) <= \
+        half_widths[first] + half_widths[second]
+    return order, first[overlapping], second[overlapping]
+
+
+class SweepAndPrune:
+    """Keeps track of which pairs of entities might be close enough to
+    collide, as the entities move around.
+
+    Example usage:
+    broad_phase = SweepAndPrune(radii, lookahead=100)
+    first, second = broad_phase.pairs(y.Positions, y.Velocities)
+    # Every other pair of entities has an altitude of at least CLEARANCE.
+    """
+
+    def __init__(self, radii: np.ndarray, lookahead: float):
+        # How many seconds each entity's box should last for, at its speed.
+        self._lookahead = lookahead
+        self._radii = radii
+        self._order = np.arange(len(radii))
+        # Where each entity was when the pairs were found, and how far it can
+        # go along x or y from there before the pairs have to be found again.
+        self._anchors = np.full((len(radii), 2), np.nan)
+        self._reaches = np.zeros(len(radii))
+        self._first = np.empty(0, dtype=int)
+        self._second = np.empty(0, dtype=int)
+
+    def pairs(self, posns: np.ndarray, velocities: np.ndarray
+              ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns (first, second), where entities first[k] and second[k]
+        might have an altitude of less than CLEARANCE. Don't change them."""
+        # NaN anchors also don't pass this check.
+        if not np.all(np.abs(posns - self._anchors) <=
+                      self._reaches.reshape(-1, 1)):
+            self._anchors = posns.copy()
+            self._reaches = \
+                np.hypot(velocities[:, 0], velocities[:, 1]) * \
+                self._lookahead + CLEARANCE / 2
+            # Along x or y, the surfaces of two entities whose boxes don't
+            # overlap are more than 2 * (reach1 + reach2) apart. Even after
+            # both go as far as their reach, their altitude is still at least
+            # reach1 + reach2, which is at least CLEARANCE.
+            self._order, self._first, self._second = overlapping_pairs(
+                self._order, posns, self._radii + 2 * self._reaches)
+        return self._first, self._second
@@ -0,0 +1,364 @@
+"""A numba-compiled alternative to PhysicsEngine._derive.
+
+PhysicsEngine._derive is written to be readable. It builds a PhysicsState,
+walks over _EntityViews and calls helpers in calc.py, which is great for
+understanding what's going on but means that at high time accelerations most
+of the simthread's time is spent in Python overhead instead of in math.
+
+This module does the same calculation, but directly on the flat y-vector.
+Everything that doesn't change during a simulation (masses, radii, engine
+capabilities, atmospheres, which entity is the Habitat, etc.) is gathered up
+once into a DeriveConstants, and then the whole derivative is calculated by a
+single nopython numba kernel.
+
+If you change the physics in PhysicsEngine._derive or
+_reconcile_entity_dynamics, you have to change _derive_kernel as well! There's
+a test in test.py that checks that these two paths agree.
+
+Example usage:
+constants = compiled_derive.build_constants(
+    physics_state, np.arange(len(physics_state)))
+if constants is not None:
+    dy = compiled_derive.derive(y_1d, constants)
+"""
+
+import logging
+import math
+from typing import NamedTuple, Optional
+
+import numba
+import numpy as np
+
+from orbitx import common
+from orbitx.data_structures import Navmode, PhysicsState, \
+    _PER_ENTITY_MUTABLE_FIELDS
+from orbitx.physics import barnes_hut, calc
+
+log = logging.getLogger()
+
+# See data_structures._FIELD_ORDERING for the layout of the y-vector.
+assert _PER_ENTITY_MUTABLE_FIELDS == [
+    'x', 'y', 'vx', 'vy', 'heading', 'spin', 'fuel', 'throttle', 'landed_on',
+    'broken'
+], '_derive_kernel hardcodes the layout of the y-vector, please update it!'
+
+# numba treats module-level globals as compile-time constants, so these are
+# free to use inside _derive_kernel.
+_MANUAL = Navmode['Manual'].value
+_CCW_PROGRADE = Navmode['CCW Prograde'].value
+_CW_RETROGRADE = Navmode['CW Retrograde'].value
+_DEPART_REFERENCE = Navmode['Depart Reference'].value
+_APPROACH_TARGET = Navmode['Approach Target'].value
+_PRO_TARG_VELOCITY = Navmode['Pro Targ Velocity'].value
+
+
+class DeriveConstants(NamedTuple):
+    """Everything _derive_kernel needs that doesn't live in the y-vector.
+
+    Per-entity values are arrays indexed by entity index. Entity indices that
+    don't exist are PhysicsState.NO_INDEX."""
+    mass: np.ndarray
+    radius: np.ndarray
+    artificial: np.ndarray
+    thrust: np.ndarray
+    fuel_cons: np.ndarray
+    atmosphere_thickness: np.ndarray
+    atmosphere_scaling: np.ndarray
+    hab_index: int
+    ayse_index: int
+    reference_index: int
+    target_index: int
+    navmode: int
+    drag_profile: float
+    gravity_sources: np.ndarray
+    tree_gravity: bool
+    opening_angle: float
+
+
+def build_constants(state: PhysicsState,
+                    gravity_sources: np.ndarray,
+                    opening_angle: Optional[float] = None
+                    ) -> Optional[DeriveConstants]:
+    """Gathers up the unchanging parts of state for use in derive().
+
+    Only entities with indices in gravity_sources exert gravity, see
+    calc.grav_acc_from_sources. If opening_angle is not None, gravity is
+    calculated with barnes_hut.grav_acc using that opening angle.
+
+    Returns None if the state uses a feature that the compiled kernel doesn't
+    support, in which case PhysicsEngine._derive should be used instead."""
+    n = len(state)
+    names = state._entity_names
+
+    hab_index = state._name_to_index(common.HABITAT) \
+        if common.HABITAT in names else PhysicsState.NO_INDEX
+    ayse_index = state._name_to_index(common.AYSE) \
+        if common.AYSE in names else PhysicsState.NO_INDEX
+
+    if hab_index == PhysicsState.NO_INDEX and \
+            ayse_index != PhysicsState.NO_INDEX:
+        log.info('Not using compiled derive: AYSE exists without a Habitat.')
+        return None
+
+    reference_index = target_index = PhysicsState.NO_INDEX
+    if state.navmode != Navmode['Manual']:
+        if state.reference not in names or state.target not in names:
+            log.info('Not using compiled derive: navmode is set, but the '
+                     'reference or target does not exist.')
+            return None
+        reference_index = state._name_to_index(state.reference)
+        target_index = state._name_to_index(state.target)
+
+    thrust = np.zeros(n)
+    fuel_cons = np.zeros(n)
+    for index, entity in enumerate(state):
+        if entity.artificial and entity.name in common.craft_capabilities:
+            capability = common.craft_capabilities[entity.name]
+            thrust[index] = capability.thrust
+            fuel_cons[index] = capability.fuel_cons
+
+    drag_profile = common.HAB_DRAG_PROFILE
+    if state.parachute_deployed:
+        drag_profile += common.PARACHUTE_DRAG_PROFILE
+
+    # Copies, since the EntityTable's arrays are read-only.
+    table = state._table
+    return DeriveConstants(
+        mass=np.array(table.mass),
+        radius=np.array(table.r),
+        artificial=np.array(table.artificial),
+        thrust=thrust,
+        fuel_cons=fuel_cons,
+        atmosphere_thickness=np.array(table.atmosphere_thickness),
+        atmosphere_scaling=np.array(table.atmosphere_scaling),
+        hab_index=hab_index,
+        ayse_index=ayse_index,
+        reference_index=reference_index,
+        target_index=target_index,
+        navmode=state.navmode.value,
+        drag_profile=drag_profile,
+        gravity_sources=np.asarray(gravity_sources, dtype=np.int64),
+        tree_gravity=opening_angle is not None,
+        opening_angle=opening_angle if opening_angle is not None else 0.0
+    )
+
+
+def derive(y_1d: np.ndarray, constants: DeriveConstants) -> np.ndarray:
+    """Returns the same derivative as PhysicsEngine._derive."""
+    return _derive_kernel(y_1d, *constants)
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def _landing_order(LandedOn):
+    """Returns the index of every landed entity, in the same waves as
+    engine._Landings. A lander comes after its ground, if its ground is
+    itself landed."""
+    n = len(LandedOn)
+    pending = np.empty(n, dtype=np.int64)
+    is_pending = np.zeros(n, dtype=np.bool_)
+    n_pending = 0
+    for i in range(n):
+        if int(LandedOn[i]) != -1:
+            pending[n_pending] = i
+            is_pending[i] = True
+            n_pending += 1
+    pending = pending[:n_pending]
+
+    order = np.empty(n_pending, dtype=np.int64)
+    n_ordered = 0
+    while len(pending) != 0:
+        ready = np.empty(len(pending), dtype=np.bool_)
+        for k in range(len(pending)):
+            ready[k] = not is_pending[int(LandedOn[pending[k]])]
+        if not ready.any():
+            # Entities landed on each other in a circle, glue them all.
+            ready[:] = True
+        for k in range(len(pending)):
+            if ready[k]:
+                order[n_ordered] = pending[k]
+                n_ordered += 1
+                is_pending[pending[k]] = False
+        pending = pending[~ready]
+    return order
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def _derive_kernel(y_1d, mass, radius, artificial, thrust, fuel_cons,
+                   atmosphere_thickness, atmosphere_scaling,
+                   hab_index, ayse_index, reference_index, target_index,
+                   navmode, drag_profile, gravity_sources, tree_gravity,
+                   opening_angle):
+    # Read along with PhysicsEngine._derive, this does the same thing in the
+    # same order.
+    n = len(mass)
+    X = y_1d[0 * n:1 * n]
+    Y = y_1d[1 * n:2 * n]
+    VX = y_1d[2 * n:3 * n]
+    VY = y_1d[3 * n:4 * n]
+    Heading = y_1d[4 * n:5 * n] % (2 * np.pi)
+    Spin = y_1d[5 * n:6 * n]
+    Fuel = y_1d[6 * n:7 * n]
+    Throttle = y_1d[7 * n:8 * n]
+    LandedOn = y_1d[8 * n:9 * n]
+    srb_time = y_1d[-2]
+
+    if tree_gravity:
+        acc = barnes_hut.grav_acc(
+            X, Y, mass, Fuel, opening_angle, gravity_sources)
+    elif len(gravity_sources) < n:
+        acc = calc.grav_acc_from_sources(X, Y, mass, Fuel, gravity_sources)
+    else:
+        acc = calc.grav_acc(X, Y, mass, Fuel)
+    dy = np.zeros(len(y_1d))
+
+    # Which craft is being controlled, see PhysicsState.craft
+    craft = -1
+    if hab_index != -1:
+        craft = hab_index
+        if ayse_index != -1 and int(LandedOn[hab_index]) == ayse_index:
+            craft = ayse_index
+
+    # Engine thrust and fuel consumption
+    for i in range(n):
+        if not artificial[i] or Fuel[i] <= 0 or Throttle[i] <= 0:
+            continue
+        dy[6 * n + i] = -abs(fuel_cons[i] * Throttle[i])
+        total_mass = mass[i] + Fuel[i]
+        if i == ayse_index and int(LandedOn[hab_index]) == ayse_index:
+            total_mass += mass[hab_index] + Fuel[hab_index]
+        eng_acc = thrust[i] * Throttle[i] / total_mass
+        acc[i, 0] += eng_acc * math.cos(Heading[i])
+        acc[i, 1] += eng_acc * math.sin(Heading[i])
+
+    # And SRB thrust
+    srb_usage = 0.0
+    if srb_time >= 0 and hab_index != -1:
+        srb_acc = common.SRB_THRUST / (mass[hab_index] + Fuel[hab_index])
+        acc[hab_index, 0] += srb_acc * math.cos(Heading[hab_index])
+        acc[hab_index, 1] += srb_acc * math.sin(Heading[hab_index])
+        srb_usage = -1.0
+
+    # Drag effects, see calc.relevant_atmosphere and calc.drag
+    if craft != -1:
+        atmosphere = -1
+        closest_distance = np.inf
+        for i in range(n):
+            if atmosphere_thickness[i] == 0 or atmosphere_scaling[i] == 0:
+                continue
+            dist = math.sqrt((X[i] - X[craft]) ** 2 + (Y[i] - Y[craft]) ** 2)
+            if dist < closest_distance:
+                exponential = (-(dist - radius[craft] - radius[i]) / 1000 /
+                               atmosphere_scaling[i])
+                if exponential > -20:
+                    closest_distance = dist
+                    atmosphere = i
+
+        if atmosphere != -1:
+            air_v = calc._rotational_speed_fast(
+                np.array([X[craft], Y[craft]]),
+                np.array([X[atmosphere], Y[atmosphere]]),
+                np.array([VX[atmosphere], VY[atmosphere]]),
+                Spin[atmosphere])
+            wind_x = VX[craft] - air_v[0]
+            wind_y = VY[craft] - air_v[1]
+            wind_squared = wind_x ** 2 + wind_y ** 2
+            if wind_squared >= 0.01:
+                pressure = atmosphere_thickness[atmosphere] * math.exp(
+                    -(closest_distance - radius[craft] - radius[atmosphere]) /
+                    1000 / atmosphere_scaling[atmosphere])
+                wind_mag = math.sqrt(wind_squared)
+                drag_acc = pressure * wind_squared * drag_profile
+                acc[craft, 0] -= drag_acc * wind_x / wind_mag
+                acc[craft, 1] -= drag_acc * wind_y / wind_mag
+
+    # Centripetal acceleration to keep landed entities glued to each other.
+    # Grounds that are themselves landed go first, see engine._Landings.
+    landers = _landing_order(LandedOn)
+    for lander in landers:
+        ground = int(LandedOn[lander])
+        spin_squared = Spin[ground] ** 2
+        acc[lander, 0] = \
+            acc[ground, 0] - (X[lander] - X[ground]) * spin_squared
+        acc[lander, 1] = \
+            acc[ground, 1] - (Y[lander] - Y[ground]) * spin_squared
+
+    # The rest of this function is _reconcile_entity_dynamics. We only need
+    # the resulting velocities and spins, but positions are also fixed up
+    # since later landers use them.
+    new_X = X.copy()
+    new_Y = Y.copy()
+    new_VX = VX.copy()
+    new_VY = VY.copy()
+    new_Spin = Spin.copy()
+
+    # Navmode auto-rotation, see calc.navmode_heading and calc.navmode_spin
+    # There's nothing to rotate if there's no craft.
+    if navmode != _MANUAL and craft != -1:
+        requested_heading = Heading[craft]
+        if navmode == _CCW_PROGRADE or navmode == _CW_RETROGRADE or \
+                navmode == _DEPART_REFERENCE:
+            if reference_index != craft:
+                normal_x = X[craft] - X[reference_index]
+                normal_y = Y[craft] - Y[reference_index]
+                if navmode == _CCW_PROGRADE:
+                    requested_heading = math.atan2(normal_x, -normal_y)
+                elif navmode == _CW_RETROGRADE:
+                    requested_heading = math.atan2(-normal_x, normal_y)
+                else:
+                    requested_heading = math.atan2(normal_y, normal_x)
+        elif target_index != craft:
+            if navmode == _APPROACH_TARGET:
+                requested_heading = math.atan2(
+                    Y[target_index] - Y[craft], X[target_index] - X[craft])
+            elif navmode == _PRO_TARG_VELOCITY:
+                requested_heading = math.atan2(
+                    VY[craft] - VY[target_index], VX[craft] - VX[target_index])
+            else:  # Anti Targ Velocity
+                requested_heading = math.atan2(
+                    VY[target_index] - VY[craft], VX[target_index] - VX[craft])
+
+        ccw_distance = (requested_heading - Heading[craft]) % (2 * np.pi)
+        cw_distance = (Heading[craft] - requested_heading) % (2 * np.pi)
+        if ccw_distance < cw_distance:
+            heading_difference = ccw_distance
+        else:
+            heading_difference = -cw_distance
+        if abs(heading_difference) < common.AUTOPILOT_FINE_CONTROL_RADIUS:
+            new_Spin[craft] = heading_difference
+        else:
+            new_Spin[craft] = \
+                np.sign(heading_difference) * common.AUTOPILOT_SPEED
+
+    # Keep landed entities glued together
+    for lander in landers:
+        ground = int(LandedOn[lander])
+        if ground == ayse_index and lander == hab_index:
+            # Always put the Habitat at the docking port.
+            offset = radius[lander] + radius[ground]
+            new_X[lander] = new_X[ground] - math.cos(Heading[ground]) * offset
+            new_Y[lander] = new_Y[ground] - math.sin(Heading[ground]) * offset
+        else:
+            norm_x = new_X[lander] - new_X[ground]
+            norm_y = new_Y[lander] - new_Y[ground]
+            norm_mag = math.sqrt(norm_x ** 2 + norm_y ** 2)
+            offset = radius[ground] + radius[lander]
+            new_X[lander] = new_X[ground] + norm_x / norm_mag * offset
+            new_Y[lander] = new_Y[ground] + norm_y / norm_mag * offset
+
+        new_Spin[lander] = new_Spin[ground]
+        lander_v = calc._rotational_speed_fast(
+            np.array([new_X[lander], new_Y[lander]]),
+            np.array([new_X[ground], new_Y[ground]]),
+            np.array([new_VX[ground], new_VY[ground]]),
+            new_Spin[ground])
+        new_VX[lander] = lander_v[0]
+        new_VY[lander] = lander_v[1]
+
+    # [VX, VY, AX, AY, Spin, 0, Fuel consumption, 0, 0, 0] + [srb_usage, 0]
+    dy[0 * n:1 * n] = new_VX
+    dy[1 * n:2 * n] = new_VY
+    dy[2 * n:3 * n] = acc[:, 0]
+    dy[3 * n:4 * n] = acc[:, 1]
+    dy[4 * n:5 * n] = new_Spin
+    dy[-2] = srb_usage
+    return dy
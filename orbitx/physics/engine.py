@@ -11,13 +11,15 @@ understanding how all the bits fit together.
 Get in contact with me if you want to add new functionality! I'm more than
 happy to help :)"""
 
+import bisect
 import collections
 import functools
 import logging
 import threading
 import time
 import warnings
-from typing import Callable, List, Optional, Tuple, NamedTuple, Union
+from typing import Callable, Iterable, List, Optional, Tuple, \
+    NamedTuple, Union
 
 import numpy as np
 import scipy.integrate
@@ -25,12 +27,12 @@ import scipy.spatial
 import scipy.special
 from google.protobuf.text_format import MessageToString
 
-from orbitx.physics import calc
+from orbitx.physics import barnes_hut, broad_phase, calc, compiled_derive, \
+    ephemeris, integrators, kepler
 from orbitx import common
 from orbitx.network import Request
-from orbitx.orbitx_pb2 import PhysicalState
 from orbitx.data_structures import protos, Entity, Navmode, PhysicsState, \
-    _FIELD_ORDERING
+    _FIELD_ORDERING, _LANDED_ON
 
 SOLUTION_CACHE_SIZE = 2
 
@@ -48,6 +50,14 @@ class TimeAccChange(NamedTuple):
     start_simtime: float
 
 
+class _Command(NamedTuple):
+    """Something for the simthread to do at a given simtime. Either apply some
+    requests, or replace the whole state if state is not None."""
+    simtime: float
+    requests: List[Request]
+    state: Optional[PhysicsState]
+
+
 class PhysicsEngine:
     """Physics Engine class. Encapsulates simulating physical state.
 
@@ -74,17 +84,59 @@ class PhysicsEngine:
     # into Mars, tweak this downwards.
     MAX_STEP_SIZE = 100
 
-    def __init__(self, physical_state: PhysicsState):
+    # With more entities than this, gravity is approximated with a
+    # Barnes-Hut tree that has this opening angle. See barnes_hut.py.
+    TREE_GRAVITY_THRESHOLD = barnes_hut.THRESHOLD
+    TREE_GRAVITY_OPENING_ANGLE = barnes_hut.OPENING_ANGLE
+
+    # With more entities than this, collisions are only checked between
+    # entities that are close to each other. See broad_phase.py.
+    COLLISION_BROAD_PHASE_THRESHOLD = broad_phase.THRESHOLD
+
+    # Artificial entities lighter than this fraction of the heaviest entity
+    # are test particles: they are pulled on by gravity, but don't pull on
+    # anything themselves. The Habitat is about 1e-25 of the Sun's mass, so
+    # its own gravity is far below any other error in the simulation.
+    TEST_PARTICLE_MASS_RATIO = 1e-9
+
+    def __init__(self, physical_state: PhysicsState,
+                 integrator: str = integrators.RK45,
+                 ephem: Optional[ephemeris.Ephemeris] = None,
+                 simthread: bool = True):
+        # One of integrators.METHODS. If this isn't RK45, the fixed-step
+        # integrator or Kepler propagation is used whenever nothing is
+        # thrusting, and RK45 is used otherwise.
+        assert integrator in integrators.METHODS, integrator
+        self._integrator = integrator
+        # If set, natural bodies are evaluated from this ephemeris instead of
+        # being integrated, whenever possible. See ephemeris.py.
+        self._ephemeris = ephem
+
         # Controls access to self._solutions. If anything changes that is
         # related to self._solutions, this condition variable should be
-        # notified. Currently, that's just if self._solutions or
-        # self._last_simtime changes.
+        # notified. Currently, that's if self._solutions,
+        # self._last_simtime, or self._commands changes.
         self._solutions_cond = threading.Condition()
-        self._solutions: collections.deque
-
+        # Essentially just a cache of ODE solutions.
+        self._solutions: collections.deque = \
+            collections.deque(maxlen=SOLUTION_CACHE_SIZE)
+
+        # Commands for the simthread, and how many have been sent and
+        # applied. get_state() waits until every command has been applied.
+        self._commands: collections.deque = collections.deque()
+        self._commands_sent = 0
+        self._commands_applied = 0
+
+        # If simthread is False, there's no background thread, and
+        # simulation only happens when _simulate is called. See simulate().
+        # Each call to _simulate carries on from where the last one stopped.
+        self._use_simthread = simthread
+        self._simulated_t = 0.0
+        self._simulated_y: Optional[PhysicsState] = None
         self._simthread: Optional[threading.Thread] = None
         self._simthread_exception: Optional[Exception] = None
-        self._last_physical_state: PhysicalState
+        self._stopping_simthread = False
+        self._last_physical_state: PhysicsState
         self._last_monotime: float = time.monotonic()
         self._last_simtime: float
         self._time_acc_changes: collections.deque
@@ -140,93 +192,147 @@ class PhysicsEngine:
                 self._stopping_simthread = True
                 self._solutions_cond.notify_all()
             self._simthread.join()
+            self._simthread = None
 
-    def _start_simthread(self, t0: float, y0: PhysicsState) -> None:
-        if round(y0.time_acc) == 0:
-            # We've paused the simulation. Don't start a new simthread
-            log.info('Pausing simulation')
-            return
-
-        # We don't need to synchronize self._last_simtime or
-        # self._solutions here, because we just stopped the background
-        # simulation thread only a few lines ago.
-        self._last_simtime = t0
-        # This double-ended queue should always have at least one element in
-        # it, and the first element should have a start_simtime less
-        # than self._last_simtime.
-        self._time_acc_changes = collections.deque(
-            [TimeAccChange(time_acc=y0.time_acc,
-                           start_simtime=y0.timestamp)]
-        )
-
-        # Essentially just a cache of ODE solutions.
-        self._solutions = collections.deque(maxlen=SOLUTION_CACHE_SIZE)
-
+    def _start_simthread(self) -> None:
+        # The simthread runs until _stop_simthread is called, and gets
+        # everything it needs to do from self._commands.
+        self._stopping_simthread = False
         self._simthread = threading.Thread(
             target=self._simthread_target,
-            args=(t0, y0),
-            name=f'simthread t={round(t0)} acc={y0.time_acc}',
+            name='simthread',
             daemon=True
         )
-        self._stopping_simthread = False
 
         # Fork self._simthread into the background.
         self._simthread.start()
 
+    def _send_command(self, command: _Command) -> None:
+        # Only call this while holding self._solutions_cond.
+        self._commands.append(command)
+        self._commands_sent += 1
+        self._solutions_cond.notify_all()
+
     def handle_requests(self, requests: List[Request], requested_t=None):
         requested_t = self._simtime(requested_t)
+        requests = [request for request in requests
+                    if request.ident != Request.NOOP]
         if len(requests) == 0:
             return
 
-        if len(requests) and requests[0].ident == Request.TIME_ACC_SET:
-            # Immediately change the time acceleration, don't wait for the
-            # simulation to catch up. This deals with the case where we're at
-            # 100,000x time acc, and the program seems frozen for the user and
-            # they try lowering time acc. We should immediately be able to
-            # restart simulation at a lower time acc without any waiting.
-            if len(self._solutions) == 0:
-                # We haven't even simulated any solutions yet.
-                requested_t = self._last_physical_state.timestamp
-            else:
-                requested_t = min(self._solutions[-1].t_max, requested_t)
-
-        if len(self._solutions) == 0:
-            y0 = PhysicsState(None, self._last_physical_state)
-        else:
+        if any(request.ident == Request.LOAD_SAVEFILE
+               for request in requests):
+            # This replaces the whole state, including the simtime, so
+            # apply these requests here and restart from the new state.
             y0 = self.get_state(requested_t)
+            for request in requests:
+                y0 = _one_request(request, y0)
+            self.set_state(y0)
+            return
 
-        for request in requests:
-            if request.ident == Request.NOOP:
-                # We don't care about these requests
-                continue
-            y0 = _one_request(request, y0)
-            if request.ident == Request.TIME_ACC_SET:
-                assert request.time_acc_set >= 0
-                self._time_acc_changes.append(
-                    TimeAccChange(time_acc=y0.time_acc,
-                                  start_simtime=y0.timestamp)
-                )
-
-        self.set_state(y0)
+        with self._solutions_cond:
+            if requests[0].ident == Request.TIME_ACC_SET:
+                # Immediately change the time acceleration, don't wait for the
+                # simulation to catch up. This deals with the case where we're
+                # at 100,000x time acc, and the program seems frozen for the
+                # user and they try lowering time acc. We should immediately
+                # be able to continue simulation at a lower time acc without
+                # any waiting.
+                if len(self._solutions) == 0:
+                    # We haven't even simulated any solutions yet.
+                    requested_t = self._last_physical_state.timestamp
+                else:
+                    requested_t = min(self._solutions[-1].t_max, requested_t)
+
+            for request in requests:
+                if request.ident == Request.TIME_ACC_SET:
+                    assert request.time_acc_set >= 0
+                    self._time_acc_changes.append(
+                        TimeAccChange(time_acc=request.time_acc_set,
+                                      start_simtime=requested_t)
+                    )
+
+            # The simthread will apply these requests to the state at
+            # requested_t, and continue simulating from there.
+            self._send_command(_Command(
+                simtime=requested_t, requests=requests, state=None))
 
     def set_state(self, physical_state: PhysicsState):
-        self._stop_simthread()
+        # Take a copy, in case the caller keeps changing physical_state.
+        physical_state = PhysicsState(None, physical_state)
 
-        physical_state = _reconcile_entity_dynamics(physical_state)
-        self._artificials = np.where(
-            np.array([
-                entity.artificial
-                for entity in physical_state]) >= 1)[0]
+        with self._solutions_cond:
+            self._last_simtime = physical_state.timestamp
+            # This double-ended queue should always have at least one element
+            # in it, and the first element should have a start_simtime less
+            # than self._last_simtime.
+            self._time_acc_changes = collections.deque(
+                [TimeAccChange(time_acc=physical_state.time_acc,
+                               start_simtime=physical_state.timestamp)]
+            )
+            self._last_physical_state = PhysicsState(None, physical_state)
+
+            # Any commands that haven't been applied yet were for the old
+            # state, so drop them.
+            self._commands_applied += len(self._commands)
+            self._commands.clear()
+            self._send_command(_Command(
+                simtime=physical_state.timestamp, requests=[],
+                state=physical_state))
+
+        if not self._use_simthread:
+            # _simulate will apply this state when it's called.
+            return
 
-        # We keep track of the PhysicalState because our simulation
-        # only simulates things that change like position and velocity,
-        # not things that stay constant like names and mass.
-        # self._last_physical_state contains these constants.
-        self._last_physical_state = physical_state.as_proto()
-        self.R = np.array([entity.r for entity in physical_state])
-        self.M = np.array([entity.mass for entity in physical_state])
+        if self._simthread is None:
+            self._start_simthread()
 
-        self._start_simthread(physical_state.timestamp, physical_state)
+        # Callers expect the engine to be using the new state once this
+        # returns, so wait for the simthread to pick it up.
+        with self._solutions_cond:
+            self._solutions_cond.wait_for(
+                lambda:
+                self._commands_applied == self._commands_sent or
+                self._simthread_exception is not None
+            )
+
+    def _update_constants(self, physical_state: PhysicsState,
+                          entity_table_changed: bool) -> None:
+        """Recalculates everything the simthread needs that isn't in the
+        y-vector. Things like masses and radii only change when the list of
+        entities changes, the rest is cheap to recalculate."""
+        if entity_table_changed:
+            self._artificials = np.where(
+                np.array([
+                    entity.artificial
+                    for entity in physical_state]) >= 1)[0]
+            self.R = np.array([entity.r for entity in physical_state])
+            self.M = np.array([entity.mass for entity in physical_state])
+            # Indices of entities that have gravity, i.e. that aren't test
+            # particles. See calc.grav_acc_from_sources.
+            test_particles = np.zeros(len(physical_state), dtype=bool)
+            if len(physical_state) > 0:
+                test_particles[self._artificials] = True
+                test_particles &= (
+                    self.M < self.TEST_PARTICLE_MASS_RATIO * self.M.max())
+            self._gravity_sources = np.where(~test_particles)[0]
+            # None if we're calculating gravity between every pair of
+            # entities.
+            self._opening_angle: Optional[float] = None
+            if len(physical_state) > self.TREE_GRAVITY_THRESHOLD:
+                self._opening_angle = self.TREE_GRAVITY_OPENING_ANGLE
+            # None if we're checking every pair of entities for collisions.
+            # Otherwise, this keeps track of nearby entities from one chunk
+            # of simulation to the next.
+            self._broad_phase: Optional[broad_phase.SweepAndPrune] = None
+            if len(physical_state) > self.COLLISION_BROAD_PHASE_THRESHOLD:
+                self._broad_phase = broad_phase.SweepAndPrune(
+                    self.R, lookahead=self.MAX_STEP_SIZE)
+
+        # None if we have to use the slower, pure-python self._derive.
+        # This depends on the navmode, parachute, and engine capabilities.
+        self._derive_constants = compiled_derive.build_constants(
+            physical_state, self._gravity_sources, self._opening_angle)
 
     def get_state(self, requested_t=None) -> PhysicsState:
         """Return the latest physical state of the simulation."""
@@ -238,18 +344,21 @@ class PhysicsEngine:
             self._last_simtime = requested_t
             self._solutions_cond.wait_for(
                 # Wait until we're paused, there's a solution, or an exception.
+                # But first, wait for any commands to be applied.
                 lambda:
-                self._last_physical_state.time_acc == 0 or
-                (len(self._solutions) != 0 and
-                 self._solutions[-1].t_max >= requested_t) or
-                self._simthread_exception is not None
+                self._simthread_exception is not None or
+                (self._commands_applied == self._commands_sent and (
+                    self._last_physical_state.time_acc == 0 or
+                    (len(self._solutions) != 0 and
+                     self._solutions[-1].t_max >= requested_t)))
             )
+            last_physical_state = self._last_physical_state
 
             # Check if the simthread crashed
             if self._simthread_exception is not None:
                 raise self._simthread_exception
 
-            if self._last_physical_state.time_acc == 0:
+            if last_physical_state.time_acc == 0:
                 # We're paused, so there are no solutions being generated.
                 # Exit this 'with' block and release our _solutions_cond lock.
                 pass
@@ -263,17 +372,36 @@ class PhysicsEngine:
                     if soln.t_min <= requested_t <= soln.t_max:
                         solution = soln
 
-        if self._last_physical_state.time_acc == 0:
+        if last_physical_state.time_acc == 0:
             # We're paused, so return the only state we have.
-            return PhysicsState(None, self._last_physical_state)
+            return PhysicsState(None, last_physical_state)
         else:
             # We have a solution, return it.
             newest_state = PhysicsState(
-                solution(requested_t), self._last_physical_state
+                solution(requested_t), last_physical_state, copy=True
             )
             newest_state.timestamp = requested_t
             return newest_state
 
+    def get_segments(self, requested_t: float) -> List['_Segment']:
+        """Returns the ODE solutions the simthread has already made, from
+        requested_t onwards. A physics server sends these to its clients, so
+        that they can draw smooth motion without simulating anything.
+
+        This doesn't wait for the simthread, so it might return nothing,
+        e.g. if the simulation is paused."""
+        with self._solutions_cond:
+            if self._commands_applied != self._commands_sent or \
+                    self._last_physical_state.time_acc == 0:
+                return []
+            return [
+                _Segment(t_min=solution.t_min, t_max=solution.t_max,
+                         solution=solution,
+                         template=self._last_physical_state)
+                for solution in self._solutions
+                if solution.t_max >= requested_t
+            ]
+
     class RestartSimulationException(Exception):
         """A request to restart the simulation with new t and y."""
 
@@ -281,12 +409,41 @@ class PhysicsEngine:
             self.t = t
             self.y = y
 
-    def _simthread_target(self, t, y):
+    def _command_ready(self, t: float, y: Optional[PhysicsState]) -> bool:
+        """True if the simthread should apply the next command now, instead
+        of simulating further. Only call this holding self._solutions_cond.
+
+        Commands are applied at their simtime, so if the simulation hasn't
+        reached that simtime yet, we have to keep simulating."""
+        if len(self._commands) == 0:
+            return False
+        command = self._commands[0]
+        return (y is None or round(y.time_acc) == 0 or
+                command.state is not None or command.simtime <= t)
+
+    def _simthread_target(self):
+        t = 0.0
+        y: Optional[PhysicsState] = None
         while True:
             try:
-                self._run_simulation(t, y)
-                if self._stopping_simthread:
-                    return
+                with self._solutions_cond:
+                    # Wait until there's something to do.
+                    self._solutions_cond.wait_for(
+                        lambda:
+                        self._stopping_simthread or
+                        self._command_ready(t, y) or
+                        (y is not None and round(y.time_acc) != 0)
+                    )
+                    if self._stopping_simthread:
+                        return
+                    command = self._commands.popleft() \
+                        if self._command_ready(t, y) else None
+
+                if command is not None:
+                    t, y = self._apply_command(command, t, y)
+                else:
+                    assert y is not None
+                    t, y = self._run_simulation(t, y)
             except PhysicsEngine.RestartSimulationException as e:
                 t = e.t
                 y = e.y
@@ -298,8 +455,115 @@ class PhysicsEngine:
                     self._solutions_cond.notify_all()
                 return
 
+    def _apply_command(self, command: _Command, t: float,
+                       y: Optional[PhysicsState]
+                       ) -> Tuple[float, PhysicsState]:
+        """Applies a command in the simthread, and returns the new t and y
+        that the simulation should continue from."""
+        if command.state is not None:
+            y = command.state
+            entity_table_changed = True
+        else:
+            assert y is not None
+            with self._solutions_cond:
+                solutions = list(self._solutions)
+            if len(solutions) != 0:
+                # Apply the requests to the state at the requested simtime.
+                simtime = min(max(command.simtime, solutions[0].t_min), t)
+                for soln in solutions:
+                    if soln.t_min <= simtime <= soln.t_max:
+                        solution = soln
+                y = PhysicsState(solution(simtime), y, copy=True)
+                y.timestamp = simtime
+            else:
+                # We're paused, or haven't simulated anything since the last
+                # command, so requests apply right where we are.
+                y.timestamp = t
+
+            entity_table_changed = False
+            for request in command.requests:
+                y = _one_request(request, y)
+                if request.ident == Request.ENGINEERING_UPDATE:
+                    # This might add the Module to the list of entities.
+                    entity_table_changed = True
+
+        y = _reconcile_entity_dynamics(y)
+        self._update_constants(y, entity_table_changed)
+
+        # We keep track of the PhysicsState because our simulation
+        # only simulates things that change like position and velocity,
+        # not things that stay constant like names and mass.
+        # self._last_physical_state contains these constants. It's a copy,
+        # since y keeps changing as the simthread simulates.
+        if round(y.time_acc) == 0:
+            log.info('Pausing simulation')
+        last_physical_state = PhysicsState(None, y)
+
+        with self._solutions_cond:
+            # Anything we simulated past this command is now wrong.
+            self._solutions.clear()
+            self._last_physical_state = last_physical_state
+            self._commands_applied += 1
+            self._solutions_cond.notify_all()
+
+        return y.timestamp, y
+
+    def _simulate(self, t_end: float
+                  ) -> Tuple[List['_Segment'], List[Tuple[float, 'Event']]]:
+        """Simulates until t_end in this thread, applying every command on
+        the way, and returns what happened. Only used by simulate() and
+        Lockstep."""
+        assert self._simthread is None
+        t = self._simulated_t
+        y = self._simulated_y
+        segments: List[_Segment] = []
+        # Every event that happened, and when.
+        happened: List[Tuple[float, Event]] = []
+        while True:
+            # Apply every command that's due, starting with the initial state.
+            while len(self._commands) != 0 and (
+                    y is None or self._commands[0].simtime <= t):
+                t, y = self._apply_command(self._commands.popleft(), t, y)
+            assert y is not None
+            if t >= t_end:
+                break
+
+            # Simulate up to the next command, so that it can be applied at
+            # exactly its simtime.
+            t_next = t_end
+            if len(self._commands) != 0:
+                t_next = min(t_next, self._commands[0].simtime)
+
+            if round(y.time_acc) == 0:
+                # We're paused, nothing moves until the next command.
+                segments.append(
+                    _Segment(t, t_next, None, self._last_physical_state))
+                t = t_next
+                continue
+
+            try:
+                ivp_out, events = self._integrate(t, y, t_next)
+                segments.append(_Segment(
+                    t, ivp_out.t[-1], ivp_out.sol, self._last_physical_state))
+                happened.extend(
+                    (event_t[0], event)
+                    for event, event_t in zip(events, ivp_out.t_events)
+                    if len(event_t) != 0)
+                t, y = self._handle_events(ivp_out, events, y)
+            except PhysicsEngine.RestartSimulationException as e:
+                t = e.t
+                y = e.y
+
+        # So that the trajectory can be evaluated at t_end, after any
+        # commands at t_end were applied.
+        y.timestamp = t
+        segments.append(_Segment(t, t, None, PhysicsState(None, y)))
+        self._simulated_t = t
+        self._simulated_y = y
+        return segments, happened
+
     def _derive(self, t: float, y_1d: np.ndarray,
-                pass_through_state: PhysicalState) -> np.ndarray:
+                pass_through_state: PhysicsState) -> np.ndarray:
         """
         y_1d =
          [X, Y, VX, VY, Heading, Spin, Fuel, Throttle, LandedOn, Broken] +
@@ -320,13 +584,22 @@ class PhysicsEngine:
                                                 current_t_of_system,
                                                 current_y_of_system)
         """
-        # Note: we create this y as a PhysicsState for convenience, but if you
-        # set any values of y, the changes will be discarded! The only way they
-        # will be propagated out of this function is by numpy using the return
-        # value of this function as a derivative, as explained above.
+        # Note: we create this y as a PhysicsState for convenience, but it's a
+        # view of y_1d, which belongs to the integrator. Don't set any values
+        # of y! The only way changes should be propagated out of this function
+        # is by numpy using the return value of this function as a derivative,
+        # as explained above.
         # If you want to set values in y, look at _reconcile_entity_dynamics.
         y = PhysicsState(y_1d, pass_through_state)
-        acc_matrix = calc.grav_acc(y.X, y.Y, self.M, y.Fuel)
+        if self._opening_angle is not None:
+            acc_matrix = barnes_hut.grav_acc(
+                y.X, y.Y, self.M, y.Fuel, self._opening_angle,
+                self._gravity_sources)
+        elif len(self._gravity_sources) < y._n:
+            acc_matrix = calc.grav_acc_from_sources(
+                y.X, y.Y, self.M, y.Fuel, self._gravity_sources)
+        else:
+            acc_matrix = calc.grav_acc(y.X, y.Y, self.M, y.Fuel)
         zeros = np.zeros(y._n)
         fuel_cons = np.zeros(y._n)
 
@@ -375,28 +648,83 @@ class PhysicsEngine:
             acc_matrix[craft_index] -= drag_acc
 
         # Centripetal acceleration to keep landed entities glued to each other.
-        landed_on = y.LandedOn
-        for landed_i in landed_on:
-            lander = y[landed_i]
-            ground = y[landed_on[landed_i]]
-
-            centripetal_acc = (lander.pos - ground.pos) * ground.spin ** 2
-            acc_matrix[landed_i] = \
-                acc_matrix[landed_on[landed_i]] - centripetal_acc
+        landings = _Landings(y)
+        landings.accelerate(y, acc_matrix)
 
         # Sets velocity and spin of a couple more entities.
         # If you want to set the acceleration of an entity, do it above and
         # keep that logic in _derive. If you want to set the velocity and spin
         # or any other fields that an Entity has, you should put that logic in
-        # this _reconcile_entity_dynamics helper.
-        y = _reconcile_entity_dynamics(y)
+        # this _reconcile_entity_dynamics helper. It changes y, so give it a
+        # copy of y_1d, but only if there's anything to change.
+        if y.navmode != Navmode['Manual'] or len(landings) != 0:
+            y = _reconcile_entity_dynamics(
+                PhysicsState(y_1d, pass_through_state, copy=True), landings)
 
         return np.concatenate((
             y.VX, y.VY, np.hsplit(acc_matrix, 2), y.Spin,
             zeros, fuel_cons, zeros, zeros, zeros, np.array([srb_usage, 0])
         ), axis=None)
 
-    def _run_simulation(self, t: float, y: PhysicsState) -> None:
+    def _derive_compiled(self, t: float, y_1d: np.ndarray) -> np.ndarray:
+        """Same as self._derive, but much faster. Only call this if
+        self._derive_constants is not None. See compiled_derive.py."""
+        return compiled_derive.derive(y_1d, self._derive_constants)
+
+    def _kepler_coast(self, t_span: List[float], y: PhysicsState,
+                      derive_func: Callable[[float, np.ndarray], np.ndarray],
+                      reduced_system: Optional[ephemeris.ReducedSystem],
+                      events: List['Event']
+                      ) -> Optional[integrators.FixedStepResult]:
+        """Moves all artificial entities along Kepler orbits, if they're
+        coasting. See kepler.py. Events are checked along the orbits as
+        often as the fixed-step integrators would check them.
+
+        Returns the same thing as solve_ivp, or None if the artificial
+        entities have to be numerically integrated."""
+        coast = kepler.Coast.build(t_span[0], y, self._gravity_sources)
+        if coast is None:
+            return None
+
+        natural_solution: Callable[[float], np.ndarray]
+        if reduced_system is not None:
+            # The natural bodies are in the ephemeris, so there's nothing
+            # to integrate at all.
+            natural_solution = functools.partial(
+                reduced_system.expand,
+                reduced_y_1d=reduced_system.reduce(y.y0()))
+        else:
+            # Only integrate the natural bodies. The artificial entities
+            # don't have any gravity, so they can't affect natural bodies.
+            natural_system = ephemeris.ReducedSystem(
+                y, np.setdiff1d(np.arange(len(y)), self._artificials))
+            natural_out = scipy.integrate.solve_ivp(
+                fun=natural_system.derive(derive_func),
+                t_span=t_span,
+                y0=natural_system.reduce(y.y0()),
+                dense_output=True,
+                max_step=self.MAX_STEP_SIZE
+            )
+            if not natural_out.success:
+                raise Exception(natural_out.message)
+            natural_solution = ephemeris.ExpandedSolution(
+                natural_system, natural_out.sol)
+
+        max_step = min(self.MAX_STEP_SIZE, integrators.stable_step_size(
+            y, self._gravity_sources))
+        solution = coast.solution(
+            t_span[0], t_span[1], natural_solution, max_step)
+        if solution is None:
+            return None
+        coast_out = integrators.find_events(
+            solution, t_span, events, max_step,
+            message='Coasted along Kepler orbits.')
+        # Nothing after a collision, for example, is valid.
+        solution.t_max = coast_out.t[-1]
+        return coast_out
+
+    def _run_simulation(self, t: float, y: PhysicsState
+                        ) -> Tuple[float, PhysicsState]:
         # An overview of how time is managed:
         #
         # self._last_simtime is the main thread's latest idea of
@@ -410,37 +738,16 @@ class PhysicsEngine:
         # time that the solution can be evaluated at and still be accurate.
         # The highest such t_max should always be larger than the current
         # simulation time, i.e. self._last_simtime
-        proto_state = y._proto_state
-
-        while not self._stopping_simthread:
-            derive_func = functools.partial(
-                self._derive, pass_through_state=proto_state)
+        #
+        # This returns the latest t and y when the simthread is stopping, or
+        # when there's a command to apply.
 
-            events: List[Event] = [
-                CollisionEvent(y, self.R), HabFuelEvent(y), LiftoffEvent(y),
-                SrbFuelEvent()
-            ]
-            if y.craft is not None:
-                events.append(HighAccEvent(
-                    derive_func,
-                    self._artificials,
-                    TIME_ACC_TO_BOUND[round(y.time_acc)],
-                    y.time_acc,
-                    len(y)))
-
-            ivp_out = scipy.integrate.solve_ivp(
-                fun=derive_func,
-                t_span=[t, t + min(y.time_acc, 10 * self.MAX_STEP_SIZE)],
-                # solve_ivp requires a 1D y0 array
-                y0=y.y0(),
-                events=events,
-                dense_output=True,
-                max_step=self.MAX_STEP_SIZE
-            )
+        while True:
+            with self._solutions_cond:
+                if self._stopping_simthread or self._command_ready(t, y):
+                    return t, y
 
-            if not ivp_out.success:
-                # Integration error
-                raise Exception(ivp_out.message)
+            ivp_out, events = self._integrate(t, y)
 
             # When we create a new solution, let other people know.
             with self._solutions_cond:
@@ -452,72 +759,318 @@ class PhysicsEngine:
                     lambda:
                     len(self._solutions) < SOLUTION_CACHE_SIZE or
                     self._last_simtime > self._solutions[0].t_max or
-                    self._stopping_simthread
+                    self._stopping_simthread or
+                    self._command_ready(t, y)
                 )
-                if self._stopping_simthread:
-                    break
+                if self._stopping_simthread or self._command_ready(t, y):
+                    # This solution is either not needed, or is about to be
+                    # replaced by the result of the command.
+                    return t, y
 
                 # self._solutions contains ODE solutions for the interval
                 # [self._solutions[0].t_min, self._solutions[-1].t_max].
                 self._solutions.append(ivp_out.sol)
                 self._solutions_cond.notify_all()
 
-            y = PhysicsState(ivp_out.y[:, -1], proto_state)
-            t = ivp_out.t[-1]
-
-            if ivp_out.status > 0:
-                log.info(f'Got event: {ivp_out.t_events} at t={t}.')
-                for index, event_t in enumerate(ivp_out.t_events):
-                    if len(event_t) == 0:
-                        # If this event didn't occur, then event_t == []
-                        continue
-                    event = events[index]
-                    if isinstance(event, CollisionEvent):
-                        # Collision, simulation ended. Handled it and continue.
-                        assert len(ivp_out.t_events[0]) == 1
-                        assert len(ivp_out.t) >= 2
-                        y = _collision_decision(t, y, events[0])
-                        y = _reconcile_entity_dynamics(y)
-                    if isinstance(event, HabFuelEvent):
-                        # Something ran out of fuel.
-                        for artificial_index in self._artificials:
-                            artificial = y[artificial_index]
-                            if round(artificial.fuel) != 0:
-                                continue
-                            log.info(f'{artificial.name} ran out of fuel.')
-                            # This craft is out of fuel, the next iteration
-                            # won't consume any fuel. Set throttle to zero.
-                            artificial.throttle = 0
-                            # Set fuel to a negative value, so it doesn't
-                            # trigger the event function.
-                            artificial.fuel = 0
-                    if isinstance(event, LiftoffEvent):
-                        # A craft has a TWR > 1
-                        craft = y.craft_entity()
-                        log.info(
-                            'We have liftoff of the '
-                            f'{craft.name} from {craft.landed_on} at {t}.')
-                        craft.landed_on = ''
-                    if isinstance(event, SrbFuelEvent):
-                        # SRB fuel exhaustion.
-                        log.info('SRB exhausted.')
-                        y.srb_time = common.SRB_EMPTY
-                    if isinstance(event, HighAccEvent):
-                        # The acceleration acting on the craft is high, might
-                        # result in inaccurate results. SLOOWWWW DOWWWWNNNN.
-                        slower_time_acc_index = list(
-                            TIME_ACC_TO_BOUND.keys()
-                        ).index(round(y.time_acc)) - 1
-                        assert slower_time_acc_index >= 0
-                        slower_time_acc = \
-                            common.TIME_ACCS[slower_time_acc_index]
-                        assert slower_time_acc.value > 0
-                        log.info(
-                            f'{y.time_acc} is too fast, '
-                            f'slowing down to {slower_time_acc.value}')
-                        # We should lower the time acc.
-                        y.time_acc = slower_time_acc.value
-                        raise PhysicsEngine.RestartSimulationException(t, y)
+            t, y = self._handle_events(ivp_out, events, y)
+
+    def _integrate(self, t: float, y: PhysicsState,
+                   t_max: Optional[float] = None
+                   ) -> Tuple[integrators.FixedStepResult, List['Event']]:
+        """Simulates one chunk of time starting at t, but not past t_max.
+        Returns the solution and the events that were checked for."""
+        derive_func: Callable[[float, np.ndarray], np.ndarray]
+        if self._derive_constants is not None:
+            derive_func = self._derive_compiled
+        else:
+            derive_func = functools.partial(
+                self._derive, pass_through_state=y)
+
+        # Events and the integrator share decoded y-vectors and derivatives.
+        evaluator = _EventEvaluator(y, derive_func)
+        derive_func = evaluator.derive
+        events: List[Event] = [
+            CollisionEvent(evaluator, self.R, self._broad_phase),
+            HabFuelEvent(evaluator),
+            LiftoffEvent(evaluator), SrbFuelEvent()
+        ]
+        if y.craft is not None:
+            events.append(HighAccEvent(
+                evaluator,
+                self._artificials,
+                TIME_ACC_TO_BOUND[round(y.time_acc)],
+                y.time_acc,
+                len(y)))
+
+        solve_ivp: Callable
+        max_step = self.MAX_STEP_SIZE
+        if self._integrator in integrators.FIXED_STEP_METHODS and \
+                integrators.is_coasting(y):
+            solve_ivp = functools.partial(
+                integrators.solve_fixed_step, method=self._integrator)
+            max_step = min(max_step, integrators.stable_step_size(
+                y, self._gravity_sources))
+        else:
+            solve_ivp = scipy.integrate.solve_ivp
+
+        t_span = [t, t + min(y.time_acc, 10 * self.MAX_STEP_SIZE)]
+        if t_max is not None:
+            t_span[1] = min(t_span[1], t_max)
+        reduced_system: Optional[ephemeris.ReducedSystem] = None
+        if self._ephemeris is not None:
+            reduced_system = ephemeris.ReducedSystem.build(
+                self._ephemeris, t_span[0], t_span[1], y,
+                self._gravity_sources)
+
+        coast_out = None
+        if self._integrator == integrators.KEPLER:
+            coast_out = self._kepler_coast(
+                t_span, y, derive_func, reduced_system, events)
+
+        if coast_out is not None:
+            ivp_out = coast_out
+        elif reduced_system is None:
+            ivp_out = solve_ivp(
+                fun=derive_func,
+                t_span=t_span,
+                # solve_ivp requires a 1D y0 array
+                y0=y.y0(),
+                events=events,
+                dense_output=True,
+                max_step=max_step
+            )
+        else:
+            # Only integrate the artificial entities, and look up where
+            # the planets are in the ephemeris.
+            ivp_out = reduced_system.expand_result(solve_ivp(
+                fun=reduced_system.derive(derive_func),
+                t_span=t_span,
+                y0=reduced_system.reduce(y.y0()),
+                events=[reduced_system.event(event) for event in events],
+                dense_output=True,
+                max_step=max_step
+            ))
+
+        if not ivp_out.success:
+            # Integration error
+            raise Exception(ivp_out.message)
+
+        return ivp_out, events
+
+    def _handle_events(self, ivp_out, events: List['Event'],
+                       template: PhysicsState
+                       ) -> Tuple[float, PhysicsState]:
+        """Returns the t and y at the end of a solution from _integrate,
+        after handling any events that stopped the solution early."""
+        y = PhysicsState(ivp_out.y[:, -1], template, copy=True)
+        t = ivp_out.t[-1]
+
+        if ivp_out.status > 0:
+            log.info(f'Got event: {ivp_out.t_events} at t={t}.')
+            for index, event_t in enumerate(ivp_out.t_events):
+                if len(event_t) == 0:
+                    # If this event didn't occur, then event_t == []
+                    continue
+                event = events[index]
+                if isinstance(event, CollisionEvent):
+                    # Collision, simulation ended. Handled it and continue.
+                    assert len(ivp_out.t_events[0]) == 1
+                    assert len(ivp_out.t) >= 2
+                    y = _collision_decision(t, y, events[0])
+                    y = _reconcile_entity_dynamics(y)
+                if isinstance(event, HabFuelEvent):
+                    # Something ran out of fuel.
+                    for artificial_index in self._artificials:
+                        artificial = y[artificial_index]
+                        if round(artificial.fuel) != 0:
+                            continue
+                        log.info(f'{artificial.name} ran out of fuel.')
+                        # This craft is out of fuel, the next iteration
+                        # won't consume any fuel. Set throttle to zero.
+                        artificial.throttle = 0
+                        # Set fuel to a negative value, so it doesn't
+                        # trigger the event function.
+                        artificial.fuel = 0
+                if isinstance(event, LiftoffEvent):
+                    # A craft has a TWR > 1
+                    craft = y.craft_entity()
+                    log.info(
+                        'We have liftoff of the '
+                        f'{craft.name} from {craft.landed_on} at {t}.')
+                    craft.landed_on = ''
+                if isinstance(event, SrbFuelEvent):
+                    # SRB fuel exhaustion.
+                    log.info('SRB exhausted.')
+                    y.srb_time = common.SRB_EMPTY
+                if isinstance(event, HighAccEvent):
+                    # The acceleration acting on the craft is high, might
+                    # result in inaccurate results. SLOOWWWW DOWWWWNNNN.
+                    slower_time_acc_index = list(
+                        TIME_ACC_TO_BOUND.keys()
+                    ).index(round(y.time_acc)) - 1
+                    assert slower_time_acc_index >= 0
+                    slower_time_acc = \
+                        common.TIME_ACCS[slower_time_acc_index]
+                    assert slower_time_acc.value > 0
+                    log.info(
+                        f'{y.time_acc} is too fast, '
+                        f'slowing down to {slower_time_acc.value}')
+                    # We should lower the time acc.
+                    y.time_acc = slower_time_acc.value
+                    raise PhysicsEngine.RestartSimulationException(t, y)
+
+        return t, y
+
+
+class _Segment(NamedTuple):
+    """Part of a Trajectory between two commands or events. If solution is
+    None, nothing moved during this segment and template is the whole state.
+    Otherwise, solution(t) is the y-vector at t and template has everything
+    that isn't in the y-vector."""
+    t_min: float
+    t_max: float
+    solution: Optional[Callable[[float], np.ndarray]]
+    template: PhysicsState
+
+
+class Trajectory:
+    """Everything that happened in a call to simulate().
+
+    Example usage:
+    trajectory = simulate(state, t_end, sample_times=[t_end - 10, t_end])
+    trajectory.states[0]  # The state 10 seconds before t_end.
+    trajectory(t_end - 5)  # The state at any other time in the simulation.
+    for t, event in trajectory.events:
+        if isinstance(event, CollisionEvent):
+            print(f'Collision between entities {event.pair} at {t}!')
+    """
+
+    def __init__(self, segments: List[_Segment],
+                 events: List[Tuple[float, 'Event']],
+                 sample_times: Iterable[float]):
+        assert len(segments) != 0
+        self._segments = segments
+        self.events = events
+        self._segment_starts = [segment.t_min for segment in segments]
+        self.t_min = segments[0].t_min
+        self.t_max = segments[-1].t_max
+
+        self.t = np.array(sample_times, dtype=PhysicsState.DTYPE)
+        self.states: List[PhysicsState] = [self(t) for t in self.t]
+
+    def __call__(self, t: float) -> PhysicsState:
+        if not self.t_min <= t <= self.t_max:
+            raise ValueError(
+                f'{t} is not between {self.t_min} and {self.t_max}')
+
+        # If a command was applied at t, this is the segment after it.
+        segment = self._segments[
+            bisect.bisect_right(self._segment_starts, t) - 1]
+        if segment.solution is None:
+            state = PhysicsState(None, segment.template)
+        else:
+            state = PhysicsState(
+                segment.solution(t), segment.template, copy=True)
+        state.timestamp = t
+        return state
+
+
+def simulate(state: PhysicsState, t_end: float,
+             sample_times: Iterable[float] = (),
+             requests_at_times: Iterable[Tuple[float, List[Request]]] = (),
+             integrator: str = integrators.RK45,
+             ephem: Optional[ephemeris.Ephemeris] = None) -> Trajectory:
+    """Simulates state until t_end as fast as possible, and returns the
+    resulting Trajectory. Unlike a PhysicsEngine, this doesn't start any
+    threads or look at the wall clock, so it's good for analysing missions
+    and for tests.
+
+    requests_at_times is a list of (simtime, requests) pairs. Each list of
+    requests is applied at its simtime, the same as calling
+    PhysicsEngine.handle_requests(requests, requested_t=simtime).
+    The time acc of the state only changes how big each chunk of simulation
+    is, like it does in a PhysicsEngine. If the state is paused, nothing
+    moves until a request unpauses it.
+
+    Example usage:
+    trajectory = simulate(
+        state, state.timestamp + 60,
+        sample_times=np.linspace(state.timestamp, state.timestamp + 60, 7),
+        requests_at_times=[(state.timestamp + 30, [Request(
+            ident=Request.HAB_THROTTLE_SET, throttle_set=1)])])
+    trajectory.states[-1].craft_entity().fuel  # Less than at the start.
+    """
+    physics_engine = PhysicsEngine(state, integrator, ephem, simthread=False)
+    for simtime, requests in sorted(requests_at_times,
+                                    key=lambda pair: pair[0]):
+        if any(request.ident == Request.LOAD_SAVEFILE
+               for request in requests):
+            # This would jump to a different simtime.
+            raise ValueError('Call simulate() with the loaded state instead.')
+        physics_engine._commands.append(
+            _Command(simtime=simtime, requests=list(requests), state=None))
+    segments, events = physics_engine._simulate(t_end)
+    return Trajectory(segments, events, sample_times)
+
+
+class _EventEvaluator:
+    """Shares work between all the events of one call to _integrate.
+
+    The integrator evaluates every event after every step, one after the
+    other with the same t and y, and again while finding exactly when an
+    event happened. The first event to see a new (t, y) decodes it into a
+    PhysicsState, and the other events reuse that.
+
+    derive() is given to the integrator instead of the derive function, and
+    remembers the last derivative it calculated. The last derivative of a
+    step is usually at exactly the (t, y) that the events are then
+    evaluated at, so HighAccEvent doesn't have to derive it again.
+
+    Example usage:
+    evaluator = _EventEvaluator(y, derive)
+    solve_ivp(evaluator.derive, ..., events=[HabFuelEvent(evaluator), ...])
+    """
+
+    def __init__(self, template: PhysicsState,
+                 derive: Callable[[float, np.ndarray], np.ndarray]):
+        self._template = template
+        self._derive = derive
+        # The state is a view of the last y_1d it was asked for, so it
+        # always has the same contents as that y_1d.
+        self._state_t = np.nan
+        self._state_y_1d: Optional[np.ndarray] = None
+        self._state = template
+        # Like the state, the last derivative is keyed on t and which y_1d
+        # it was for, so nothing is copied on every derive. solve_ivp never
+        # changes a y_1d after deriving it, and solve_fixed_step gives
+        # events copies of y that it doesn't change.
+        self._derivative_t = np.nan
+        self._derivative_y_1d: Optional[np.ndarray] = None
+        self._derivative = np.empty(0)
+
+    def state(self, t: float, y_1d: np.ndarray) -> PhysicsState:
+        """Returns y_1d as a PhysicsState. Don't change it, other events use
+        it too."""
+        if t != self._state_t or y_1d is not self._state_y_1d:
+            self._state = PhysicsState(y_1d, self._template)
+            self._state_t = t
+            self._state_y_1d = y_1d
+        return self._state
+
+    def derive(self, t: float, y_1d: np.ndarray) -> np.ndarray:
+        """Derives y_1d, and remembers the result for derivative()."""
+        self._derivative = self._derive(t, y_1d)
+        self._derivative_t = t
+        self._derivative_y_1d = y_1d
+        return self._derivative
+
+    def derivative(self, t: float, y_1d: np.ndarray) -> np.ndarray:
+        """Returns the derivative of y_1d, only deriving it if derive()
+        wasn't just called with the same t and y. Don't change it, the
+        integrator might be using it too."""
+        if t != self._derivative_t or y_1d is not self._derivative_y_1d:
+            return self.derive(t, y_1d)
+        return self._derivative
 
 
 class Event:
@@ -539,31 +1092,39 @@ class SrbFuelEvent(Event):
 
 
 class HabFuelEvent(Event):
-    def __init__(self, initial_state: PhysicsState):
-        self.initial_state = initial_state
+    def __init__(self, evaluator: _EventEvaluator):
+        self.evaluator = evaluator
 
     def __call__(self, t, y_1d) -> float:
         """Return a 0 only when throttle is nonzero."""
-        y = PhysicsState(y_1d, self.initial_state._proto_state)
-        for index, entity in enumerate(y._proto_state.entities):
-            if entity.artificial and y.Throttle[index] != 0:
+        y = self.evaluator.state(t, y_1d)
+        for index in np.flatnonzero(y._table.artificial):
+            if y.Throttle[index] != 0:
                 return y.Fuel[index]
         return np.inf
 
 
 class CollisionEvent(Event):
-    def __init__(self, initial_state: PhysicsState, radii: np.ndarray):
-        self.initial_state = initial_state
+    def __init__(self, evaluator: _EventEvaluator, radii: np.ndarray,
+                 broad_phase: Optional[broad_phase.SweepAndPrune] = None):
+        self.evaluator = evaluator
         self.radii = radii
+        self.broad_phase = broad_phase
+        # The indices of the entities that collided, once the collision has
+        # been handled. See _collision_decision.
+        self.pair: Optional[Tuple[int, int]] = None
 
     def __call__(self, t, y_1d, return_pair=False
                  ) -> Union[float, Tuple[int, int]]:
         """Returns a scalar, with 0 indicating a collision and a sign change
         indicating a collision has happened."""
-        y = PhysicsState(y_1d, self.initial_state._proto_state)
-        n = len(self.initial_state)
-        # 2xN of (x, y) positions
-        posns = np.column_stack((y.X, y.Y))
+        y = self.evaluator.state(t, y_1d)
+        if self.broad_phase is not None:
+            return self._nearby_altitudes(y, return_pair)
+
+        n = len(y)
+        # Nx2 of (x, y) positions. cdist would copy a view of y anyway.
+        posns = np.ascontiguousarray(y.Positions)
         # An n*n matrix of _altitudes_ between each entity
         alt_matrix = (
                 scipy.spatial.distance.cdist(posns, posns) -
@@ -575,10 +1136,11 @@ class CollisionEvent(Event):
 
         # If there are any entities landed on any other entities, ignore
         # both the landed and the landee entity.
-        landed_on = y.LandedOn
-        for index in landed_on:
-            alt_matrix[index, landed_on[index]] = np.inf
-            alt_matrix[landed_on[index], index] = np.inf
+        landed_on = y.Fields[_FIELD_ORDERING[_LANDED_ON]]
+        landers = np.flatnonzero(landed_on != PhysicsState.NO_INDEX)
+        grounds = landed_on[landers].astype(int)
+        alt_matrix[landers, grounds] = np.inf
+        alt_matrix[grounds, landers] = np.inf
 
         if return_pair:
             # Returns the actual pair of indicies instead of a scalar.
@@ -592,15 +1154,43 @@ class CollisionEvent(Event):
             # solve_ivp invocation, return scalar
             return np.min(alt_matrix)
 
+    def _nearby_altitudes(self, y: PhysicsState, return_pair: bool
+                          ) -> Union[float, Tuple[int, int]]:
+        """Like __call__, but only calculates the altitudes of pairs of
+        entities that the broad phase says are nearby. Every other pair is
+        at least broad_phase.CLEARANCE apart, so this returns at most that,
+        which is still positive."""
+        assert self.broad_phase is not None
+        first, second = self.broad_phase.pairs(y.Positions, y.Velocities)
+        posns = y.Positions
+        altitudes = (
+            np.hypot(posns[first, 0] - posns[second, 0],
+                     posns[first, 1] - posns[second, 1]) -
+            self.radii[first] - self.radii[second])
+
+        # Ignore entities landed on each other, like above.
+        landed_on = y.Fields[_FIELD_ORDERING[_LANDED_ON]]
+        altitudes[(landed_on[first] == second) |
+                  (landed_on[second] == first)] = np.inf
+
+        if return_pair:
+            if len(altitudes) == 0:
+                # Nothing is nearby. Like argmin of a matrix of only inf.
+                return 0, 0
+            closest = altitudes.argmin()
+            return first[closest], second[closest]
+        else:
+            return np.min(altitudes, initial=broad_phase.CLEARANCE)
+
 
 class LiftoffEvent(Event):
-    def __init__(self, initial_state: PhysicsState):
-        self.initial_state = initial_state
+    def __init__(self, evaluator: _EventEvaluator):
+        self.evaluator = evaluator
 
     def __call__(self, t, y_1d) -> float:
         """Return 0 when the craft is landed but thrusting enough to lift off,
         and a positive value otherwise."""
-        y = PhysicsState(y_1d, self.initial_state._proto_state)
+        y = self.evaluator.state(t, y_1d)
         if y.craft is None:
             # There is no craft, return early.
             return np.inf
@@ -631,10 +1221,10 @@ class LiftoffEvent(Event):
 
 class HighAccEvent(Event):
     def __init__(
-            self, derive: Callable[[float, np.ndarray], np.ndarray],
+            self, evaluator: _EventEvaluator,
             artificials: List[int], acc_bound: float, current_acc: float,
             n_entities: int):
-        self.derive = derive
+        self.evaluator = evaluator
         self.artificials = artificials
         self.acc_bound = acc_bound
         self.current_acc = round(current_acc)
@@ -647,7 +1237,7 @@ class HighAccEvent(Event):
         if self.current_acc == 1:
             # If we can't lower the time acc, don't bother doing any work.
             return np.inf
-        derive_result = self.derive(t, y_1d)
+        derive_result = self.evaluator.derivative(t, y_1d)
         max_acc_mag = 0.0005  # A small nonzero value.
         for artif_index in self.artificials:
             accel = (derive_result[self.ax_offset] + artif_index,
@@ -658,33 +1248,93 @@ class HighAccEvent(Event):
         return max(self.acc_bound - acc_mag, 0)
 
 
-def _reconcile_entity_dynamics(y: PhysicsState) -> PhysicsState:
+class _Landings:
+    """Every entity that's landed on another, as index arrays of (lander,
+    ground) pairs, to keep landed entities glued to what they're landed on
+    without going through them one at a time.
+
+    The Habitat docked with the AYSE is glued to the AYSE's docking port,
+    anything else is glued to the surface of its ground. If a ground is
+    itself landed, e.g. the Habitat docked with an AYSE that's landed, its
+    landers are in a later wave of pairs, so that the ground has already
+    moved by the time they are glued to it.
+
+    Example usage:
+    landings = _Landings(y)
+    landings.glue(y)
+    """
+
+    def __init__(self, y: PhysicsState):
+        landed_on = y.Fields[_FIELD_ORDERING[_LANDED_ON]]
+        landers = np.flatnonzero(landed_on != PhysicsState.NO_INDEX)
+        grounds = landed_on[landers].astype(int)
+        hab_index = y._table.index.get(common.HABITAT, PhysicsState.NO_INDEX)
+        ayse_index = y._table.index.get(common.AYSE, PhysicsState.NO_INDEX)
+        docked = (landers == hab_index) & (grounds == ayse_index)
+        self._n_pairs = len(landers)
+
+        # (landers, grounds, docked) of each wave.
+        self.waves: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        while len(landers) != 0:
+            ready = ~np.isin(grounds, landers)
+            if not ready.any():
+                # Entities landed on each other in a circle, glue them all.
+                ready[:] = True
+            self.waves.append((landers[ready], grounds[ready], docked[ready]))
+            landers, grounds, docked = \
+                landers[~ready], grounds[~ready], docked[~ready]
+
+    def __len__(self):
+        """How many entities are landed."""
+        return self._n_pairs
+
+    def glue(self, y: PhysicsState):
+        """Moves every lander to its ground, and sets its velocity and spin
+        to move and spin along with its ground."""
+        positions = y.Positions
+        for landers, grounds, docked in self.waves:
+            norm = positions[landers] - positions[grounds]
+            unit_norm = norm / np.linalg.norm(norm, axis=1).reshape(-1, 1)
+            # The docking port is at the back of the AYSE.
+            unit_norm[docked] = -np.column_stack((
+                np.cos(y.Heading[grounds[docked]]),
+                np.sin(y.Heading[grounds[docked]])))
+
+            norm = unit_norm * (
+                y._table.r[landers] + y._table.r[grounds]).reshape(-1, 1)
+            positions[landers] = positions[grounds] + norm
+            y.Spin[landers] = y.Spin[grounds]
+            # The same as calc.rotational_speed, for every lander.
+            tangent = np.column_stack((-norm[:, 1], norm[:, 0]))
+            y.Velocities[landers] = y.Velocities[grounds] + \
+                tangent * y.Spin[grounds].reshape(-1, 1)
+
+    def accelerate(self, y: PhysicsState, acc_matrix: np.ndarray):
+        """Sets the acceleration of every lander in the (n, 2) acc_matrix to
+        the acceleration of its ground, plus the centripetal acceleration
+        that keeps it on the spinning ground."""
+        positions = y.Positions
+        for landers, grounds, _ in self.waves:
+            centripetal_acc = (positions[landers] - positions[grounds]) * \
+                (y.Spin[grounds] ** 2).reshape(-1, 1)
+            acc_matrix[landers] = acc_matrix[grounds] - centripetal_acc
+
+
+def _reconcile_entity_dynamics(y: PhysicsState,
+                               landings: Optional[_Landings] = None
+                               ) -> PhysicsState:
     """Idempotent helper that sets velocities and spins of some entities.
-    This is in its own function because it has a couple calling points."""
-    # Navmode auto-rotation
-    if y.navmode != Navmode['Manual']:
+    This is in its own function because it has a couple calling points.
+    Pass landings if they're already worked out for y."""
+    # Navmode auto-rotation, if there's a craft to rotate
+    if y.navmode != Navmode['Manual'] and y.craft is not None:
         craft = y.craft_entity()
         craft.spin = calc.navmode_spin(y)
 
     # Keep landed entities glued together
-    landed_on = y.LandedOn
-    for index in landed_on:
-        # If we're landed on something, make sure we move in lockstep.
-        lander = y[index]
-        ground = y[landed_on[index]]
-
-        if ground.name == common.AYSE and lander.name == common.HABITAT:
-            # Always put the Habitat at the docking port.
-            lander.pos = (
-                    ground.pos -
-                    calc.heading_vector(ground.heading) * (lander.r + ground.r))
-        else:
-            norm = lander.pos - ground.pos
-            unit_norm = norm / calc.fastnorm(norm)
-            lander.pos = ground.pos + unit_norm * (ground.r + lander.r)
-
-        lander.spin = ground.spin
-        lander.v = calc.rotational_speed(lander, ground)
+    if landings is None:
+        landings = _Landings(y)
+    landings.glue(y)
 
     return y
 
@@ -692,6 +1342,7 @@ def _reconcile_entity_dynamics(y: PhysicsState) -> PhysicsState:
 def _collision_decision(t, y, altitude_event):
     e1_index, e2_index = altitude_event(
         t, y.y0(), return_pair=True)
+    altitude_event.pair = (int(e1_index), int(e2_index))
     e1 = y[e1_index]
     e2 = y[e2_index]
 
@@ -0,0 +1,308 @@
+"""Precomputed trajectories of planets and moons, so they don't have to be
+simulated at runtime.
+
+Natural bodies never thrust, and since user-controlled craft are test
+particles (see PhysicsEngine.TEST_PARTICLE_MASS_RATIO), nothing the user does
+can change where the planets go. So we can integrate the planets once, ahead
+of time, and then only integrate the few craft at runtime. Instead of a
+y-vector of 35 entities * 10 fields, solve_ivp only sees a couple of craft,
+and isn't forced into small steps by fast moons like Phobos.
+
+An ephemeris is stored like a JPL SPK kernel. Time is split into equal
+segments, and in each segment the X, Y, VX, VY, and Heading of every natural
+body is a Chebyshev polynomial. The coefficients live in a .npy file that is
+memory-mapped, so even a many-year ephemeris loads instantly. Next to it is a
+.json file with the names of the bodies and the start time of the ephemeris.
+
+Example usage:
+ephemeris.build(state, duration=86400 * 365, path=Path('OCESS.npy'))
+ephem = ephemeris.Ephemeris(Path('OCESS.npy'))
+physics_engine = PhysicsEngine(state, ephem=ephem)
+"""
+
+import argparse
+import json
+import logging
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import numpy as np
+import scipy.integrate
+
+from orbitx import common
+from orbitx.data_structures import PhysicsState, _FIELD_ORDERING, \
+    _PER_ENTITY_MUTABLE_FIELDS
+from orbitx.physics import calc, integrators
+
+log = logging.getLogger()
+
+# The fields of each natural body stored in an ephemeris. These are also the
+# first fields of the y-vector, see data_structures._FIELD_ORDERING.
+EPHEMERIS_FIELDS = ['x', 'y', 'vx', 'vy', 'heading']
+assert EPHEMERIS_FIELDS == _PER_ENTITY_MUTABLE_FIELDS[:len(EPHEMERIS_FIELDS)]
+
+# Phobos goes around Mars in about 8 hours. Covering a quarter of that with
+# a degree-16 polynomial is accurate to well under a metre.
+DEFAULT_SEGMENT_DURATION = 2 * 3600
+DEFAULT_DEGREE = 16
+
+# If a natural body is further than this from where the ephemeris says it
+# should be, the ephemeris is probably for a different savefile. Then we
+# won't use the ephemeris.
+MAX_POSITION_ERROR = 1000
+
+
+def add_argument(argument_parser: argparse.ArgumentParser):
+    """Adds an --ephemeris argument, for programs that simulate. Pass its
+    value to common.ephemeris_file, if it's not empty."""
+    argument_parser.add_argument(
+        '--ephemeris', type=str, default='',
+        help=(
+            'Name of an ephemeris made by the Build Ephemeris program, '
+            f'relative to {common.ephemeris_file(".")}. If given, planets and '
+            'moons are looked up in the ephemeris instead of being '
+            'simulated.')
+    )
+
+
+class Ephemeris:
+    """A read-only, memory-mapped ephemeris written by build()."""
+
+    def __init__(self, path: Path):
+        with open(path.with_suffix('.json'), 'r') as metadata_file:
+            metadata = json.load(metadata_file)
+        self.names: List[str] = metadata['names']
+        self.t_start: float = metadata['t_start']
+        self.segment_duration: float = metadata['segment_duration']
+
+        # Indexed by [segment, chebyshev coefficient, field, body].
+        self._coefficients = np.load(path, mmap_mode='r')
+        n_segments = self._coefficients.shape[0]
+        self.t_end = self.t_start + n_segments * self.segment_duration
+
+    def covers(self, t_start: float, t_end: float) -> bool:
+        return self.t_start <= t_start and t_end <= self.t_end
+
+    def __call__(self, t: float) -> np.ndarray:
+        """Returns a len(EPHEMERIS_FIELDS) * len(self.names) array, e.g.
+        ephem(t)[0] is the X position of every body at time t."""
+        segment = int((t - self.t_start) // self.segment_duration)
+        segment = min(max(segment, 0), self._coefficients.shape[0] - 1)
+        segment_start = self.t_start + segment * self.segment_duration
+        # Chebyshev polynomials are defined over [-1, 1].
+        x = 2 * (t - segment_start) / self.segment_duration - 1
+        return np.polynomial.chebyshev.chebval(
+            x, self._coefficients[segment])
+
+
+def build(state: PhysicsState, duration: float, path: Path,
+          segment_duration: float = DEFAULT_SEGMENT_DURATION,
+          degree: int = DEFAULT_DEGREE) -> None:
+    """Integrates the natural bodies in state for duration seconds, and
+    writes the resulting ephemeris to path (a .npy) and a .json next to it."""
+    natural = np.array(
+        [not entity.artificial for entity in state], dtype=bool)
+    names = [entity.name for entity in state if not entity.artificial]
+    n = len(names)
+    assert n > 0, 'There are no natural bodies in this state'
+    assert not any(natural[lander] for lander in state.LandedOn), \
+        'Natural bodies landed on other bodies are not supported'
+    M = np.array([entity.mass for entity in state])[natural]
+    Spin = state.Spin[natural]
+
+    def derive(t: float, y_1d: np.ndarray) -> np.ndarray:
+        X, Y, VX, VY = y_1d[:4 * n].reshape(4, n)
+        acc = calc.grav_acc(X, Y, M, np.zeros(n))
+        return np.concatenate((VX, VY, acc[:, 0], acc[:, 1], Spin))
+
+    y0 = np.concatenate([
+        state.X[natural], state.Y[natural], state.VX[natural],
+        state.VY[natural], state.Heading[natural]
+    ]).astype(PhysicsState.DTYPE)
+    n_segments = max(1, int(np.ceil(duration / segment_duration)))
+    t_start = state.timestamp
+    log.info(f'Integrating {n} bodies for {duration} seconds.')
+    ivp_out = scipy.integrate.solve_ivp(
+        derive, [t_start, t_start + n_segments * segment_duration], y0,
+        method='DOP853', rtol=1e-12, atol=1e-6, dense_output=True)
+    if not ivp_out.success:
+        raise Exception(ivp_out.message)
+
+    # Fit each segment by sampling it at the Chebyshev nodes.
+    nodes = np.cos(np.pi * (np.arange(degree + 1) + 0.5) / (degree + 1))
+    coefficients = np.lib.format.open_memmap(
+        path, mode='w+', dtype=PhysicsState.DTYPE,
+        shape=(n_segments, degree + 1, len(EPHEMERIS_FIELDS), n))
+    for segment in range(n_segments):
+        segment_start = t_start + segment * segment_duration
+        ts = segment_start + (nodes + 1) / 2 * segment_duration
+        samples = ivp_out.sol(ts).T
+        coefficients[segment] = np.polynomial.chebyshev.chebfit(
+            nodes, samples, degree).reshape(
+                degree + 1, len(EPHEMERIS_FIELDS), n)
+    coefficients.flush()
+    del coefficients
+
+    with open(path.with_suffix('.json'), 'w') as metadata_file:
+        json.dump({
+            'names': names,
+            't_start': t_start,
+            'segment_duration': segment_duration
+        }, metadata_file, indent=2)
+    log.info(f'Wrote {n_segments} segments of ephemeris to {path}.')
+
+
+class ReducedSystem:
+    """Converts between full y-vectors and y-vectors of only some entities,
+    usually the artificial entities, so that solve_ivp only has to integrate
+    those entities.
+
+    The reduced y-vector has the same layout as a full y-vector, just with
+    fewer entities. That way functions like integrators.solve_fixed_step
+    work on it unchanged.
+
+    Use ReducedSystem.build to check if the ephemeris can be used."""
+
+    def __init__(self, y: PhysicsState, integrated: np.ndarray,
+                 ephem: Optional[Ephemeris] = None):
+        # Only the entities with indices in integrated are in the reduced
+        # y-vector. If ephem is set, natural bodies are looked up in it.
+        # Anything else stays where it is in y.
+        self._ephem = ephem
+        n = len(y)
+        naturals = np.array(
+            [index for index, entity in enumerate(y)
+             if not entity.artificial], dtype=int)
+
+        # Where each element of the reduced y-vector goes in the full one.
+        self._reduced_indices = np.concatenate([
+            field_index * n + integrated
+            for field_index in range(len(_PER_ENTITY_MUTABLE_FIELDS))
+        ] + [np.arange(n * len(_PER_ENTITY_MUTABLE_FIELDS), len(y.y0()))])
+        if ephem is not None:
+            # Where each row of self._ephem(t) goes in the full y-vector.
+            self._ephemeris_indices = np.array([
+                _FIELD_ORDERING[field] * n + naturals
+                for field in EPHEMERIS_FIELDS
+            ])
+            self._ephemeris_columns = np.array(
+                [ephem.names.index(y[index].name) for index in naturals],
+                dtype=int)
+        # Everything else, like the spin of planets, stays constant.
+        self._template = y.y0()
+        # The last expanded y-vector, and the t and reduced y-vector it was
+        # for. Events reuse it, so that every event and the derivative
+        # function see the same full y-vector, and the engine's
+        # _EventEvaluator can share its work between them. Like there, this
+        # is keyed on which reduced y-vector it was, without copying it.
+        self._expanded_t = np.nan
+        self._expanded_reduced_y_1d: Optional[np.ndarray] = None
+        self._expanded_y_1d = self._template
+
+    @staticmethod
+    def build(ephem: Ephemeris, t_start: float, t_end: float,
+              y: PhysicsState, gravity_sources: np.ndarray
+              ) -> Optional['ReducedSystem']:
+        """Returns a ReducedSystem if ephem can be used to simulate y from
+        t_start to t_end, otherwise None."""
+        if not ephem.covers(t_start, t_end):
+            return None
+        for index, entity in enumerate(y):
+            if entity.artificial:
+                if index in gravity_sources:
+                    # This artificial entity would pull the planets around.
+                    return None
+                continue
+            if entity.name not in ephem.names or index in y.LandedOn:
+                return None
+
+        artificials = np.array(
+            [index for index, entity in enumerate(y) if entity.artificial],
+            dtype=int)
+        system = ReducedSystem(y, artificials, ephem)
+        expected = system.expand(t_start, system.reduce(y.y0()))
+        position_error = np.max(np.abs(
+            expected[system._ephemeris_indices[:2]] -
+            y.y0()[system._ephemeris_indices[:2]]))
+        if position_error > MAX_POSITION_ERROR:
+            log.debug(
+                f'Not using ephemeris, it is off by {position_error} m.')
+            return None
+        return system
+
+    def reduce(self, y_1d: np.ndarray) -> np.ndarray:
+        return y_1d[self._reduced_indices]
+
+    def expand(self, t: float, reduced_y_1d: np.ndarray) -> np.ndarray:
+        y_1d = self._template.copy()
+        if self._ephem is not None:
+            y_1d[self._ephemeris_indices] = \
+                self._ephem(t)[:, self._ephemeris_columns]
+        y_1d[self._reduced_indices] = reduced_y_1d
+        return y_1d
+
+    def _remember_expanded(self, t: float, reduced_y_1d: np.ndarray
+                           ) -> np.ndarray:
+        self._expanded_y_1d = self.expand(t, reduced_y_1d)
+        self._expanded_t = t
+        self._expanded_reduced_y_1d = reduced_y_1d
+        return self._expanded_y_1d
+
+    def _last_expanded(self, t: float, reduced_y_1d: np.ndarray
+                       ) -> np.ndarray:
+        if t != self._expanded_t or \
+                reduced_y_1d is not self._expanded_reduced_y_1d:
+            return self._remember_expanded(t, reduced_y_1d)
+        return self._expanded_y_1d
+
+    def derive(self, derive_func: Callable[[float, np.ndarray], np.ndarray]
+               ) -> Callable[[float, np.ndarray], np.ndarray]:
+        """Turns a derivative function of full y-vectors into one of reduced
+        y-vectors."""
+        def reduced_derive(t: float, reduced_y_1d: np.ndarray) -> np.ndarray:
+            # Always expanded again, the fixed-step integrators change
+            # reduced_y_1d in place between derivatives.
+            return derive_func(t, self._remember_expanded(t, reduced_y_1d))[
+                self._reduced_indices]
+        return reduced_derive
+
+    def event(self, event: Callable[[float, np.ndarray], float]
+              ) -> Callable[[float, np.ndarray], float]:
+        """Turns an event function of full y-vectors into one of reduced
+        y-vectors, keeping its terminal and direction attributes."""
+        def reduced_event(t: float, reduced_y_1d: np.ndarray) -> float:
+            return event(t, self._last_expanded(t, reduced_y_1d))
+        reduced_event.terminal = getattr(  # type: ignore
+            event, 'terminal', False)
+        reduced_event.direction = getattr(  # type: ignore
+            event, 'direction', 0)
+        return reduced_event
+
+    def expand_result(self, ivp_out) -> integrators.FixedStepResult:
+        """Turns the result of solve_ivp on reduced y-vectors into one with
+        full y-vectors."""
+        return integrators.FixedStepResult(
+            t=ivp_out.t,
+            y=np.column_stack([
+                self.expand(t, reduced_y_1d)
+                for t, reduced_y_1d in zip(ivp_out.t, ivp_out.y.T)]),
+            sol=ExpandedSolution(self, ivp_out.sol),
+            t_events=ivp_out.t_events,
+            status=ivp_out.status,
+            message=ivp_out.message,
+            success=ivp_out.success
+        )
+
+
+class ExpandedSolution:
+    """Dense output of a ReducedSystem integration, that returns full
+    y-vectors. Quacks like a scipy.integrate.OdeSolution."""
+
+    def __init__(self, system: ReducedSystem, reduced_sol):
+        self._system = system
+        self._reduced_sol = reduced_sol
+        self.t_min = reduced_sol.t_min
+        self.t_max = reduced_sol.t_max
+
+    def __call__(self, t: float) -> np.ndarray:
+        return self._system.expand(t, self._reduced_sol(t))
@@ -0,0 +1,347 @@
+"""Fixed-step symplectic integrators, usable in place of solve_ivp.
+
+scipy.integrate.solve_ivp defaults to RK45, an adaptive method that is
+accurate over short spans but slowly gains or loses orbital energy. At
+100,000x time acc this drift adds up, and RK45 also spends a lot of
+derivative evaluations on error estimation.
+
+This module implements kick-drift-kick leapfrog and its 4th-order Yoshida
+composition. Velocities are 'kicked' by the accelerations returned by the
+derivative function, and everything else (positions, headings, fuel) is
+'drifted' by its rate. For bodies that aren't landed on anything, the drift
+rate of their position is exactly their current velocity, which is what makes
+this scheme symplectic for gravity.
+
+solve_fixed_step has the same signature and return value as solve_ivp (at
+least the parts of it that PhysicsEngine uses), so it can be used as a drop-in
+replacement. It also supports solve_ivp-style event functions, and produces
+a cubic Hermite dense output that can be put in PhysicsEngine._solutions.
+
+Example usage:
+ivp_out = integrators.solve_fixed_step(
+    fun=derive, t_span=[t, t + 1000], y0=y.y0(), events=[...],
+    max_step=100, method=integrators.YOSHIDA4)
+state_at_t = ivp_out.sol(t + 500)
+"""
+
+import argparse
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.optimize
+import scipy.spatial
+
+from orbitx import common
+from orbitx.data_structures import PhysicsState, _FIELD_ORDERING, \
+    _PER_ENTITY_MUTABLE_FIELDS
+from orbitx.physics import calc
+
+# Names of the available integrators, e.g. for use on the command line.
+RK45 = 'RK45'
+LEAPFROG = 'Leapfrog'
+YOSHIDA4 = 'Yoshida4'
+# Not really an integrator, see kepler.py. Coasts are propagated
+# analytically where possible, and integrated with RK45 otherwise.
+KEPLER = 'Kepler'
+
+FIXED_STEP_METHODS = [LEAPFROG, YOSHIDA4]
+METHODS = [RK45] + FIXED_STEP_METHODS + [KEPLER]
+
+
+def add_argument(argument_parser: argparse.ArgumentParser):
+    """Adds an --integrator argument, for programs that simulate."""
+    argument_parser.add_argument(
+        '--integrator', choices=METHODS, default=RK45,
+        help=(
+            'The numerical integrator to use. The fixed-step symplectic '
+            'integrators are used only during unpowered coasts, where they '
+            'are faster and conserve energy better than the default RK45. '
+            'Kepler moves coasting spacecraft along exact two-body orbits.')
+    )
+
+
+# Each fixed-step method is a composition of leapfrog steps, with these
+# weights. See
+# https://en.wikipedia.org/wiki/Leapfrog_integration#Yoshida_algorithms
+_CBRT_2 = 2 ** (1 / 3)
+_COMPOSITION_WEIGHTS = {
+    LEAPFROG: [1.0],
+    YOSHIDA4: [1 / (2 - _CBRT_2), -_CBRT_2 / (2 - _CBRT_2), 1 / (2 - _CBRT_2)]
+}
+
+# A fixed step can't react to close approaches the way an adaptive step can.
+# So the step size is at most this fraction of the shortest free-fall time
+# between any two entities, which is short enough that a collision won't be
+# stepped over.
+DYNAMICAL_TIME_FRACTION = 0.1
+
+
+def is_coasting(y: PhysicsState) -> bool:
+    """Returns True if nothing is thrusting or being dragged by an atmosphere,
+    i.e. all motion is ballistic.
+
+    The fixed-step methods work for any state, but they only conserve energy
+    when all forces depend only on position. Drag also gets huge if a step
+    overshoots into a planet, which an adaptive step size would avoid."""
+    thrusting = np.any((y.Throttle > 0) & (y.Fuel > 0))
+    srbs_burning = y.srb_time >= 0
+    in_atmosphere = \
+        y.craft is not None and calc.relevant_atmosphere(y) is not None
+    return not thrusting and not srbs_burning and not in_atmosphere
+
+
+def stable_step_size(y: PhysicsState,
+                     gravity_sources: Optional[np.ndarray] = None) -> float:
+    """The largest step size that resolves every pair of orbiting entities.
+
+    This is DYNAMICAL_TIME_FRACTION of the smallest sqrt(r^3 / G(m1 + m2)),
+    ignoring pairs of entities that are landed on each other. If
+    gravity_sources is given, only pairs with at least one of those entities
+    are checked, since nothing else pulls on anything (see
+    calc.grav_acc_from_sources). That's O(len(gravity_sources) * N) instead
+    of O(N^2)."""
+    n = len(y)
+    if n < 2:
+        return np.inf
+    if gravity_sources is None:
+        gravity_sources = np.arange(n)
+    masses = y._table.mass + y.Fuel
+    posns = np.ascontiguousarray(y.Positions)
+    # Every entity is a row, every gravity source is a column.
+    dist_matrix = scipy.spatial.distance.cdist(posns, posns[gravity_sources])
+    mu_matrix = common.G * (
+        masses.reshape(-1, 1) + masses[gravity_sources].reshape(1, -1))
+    dist_matrix[gravity_sources, np.arange(len(gravity_sources))] = np.inf
+
+    columns = np.full(n, -1)
+    columns[gravity_sources] = np.arange(len(gravity_sources))
+    landed_on = y.Fields[_FIELD_ORDERING['landed_on']].astype(int)
+    landers = np.flatnonzero(landed_on != PhysicsState.NO_INDEX)
+    grounds = landed_on[landers]
+    for rows, others in [(landers, grounds), (grounds, landers)]:
+        is_source = columns[others] != -1
+        dist_matrix[rows[is_source], columns[others[is_source]]] = np.inf
+
+    with np.errstate(divide='ignore'):
+        dynamical_times = np.sqrt(dist_matrix ** 3 / mu_matrix)
+    return DYNAMICAL_TIME_FRACTION * np.min(dynamical_times, initial=np.inf)
+
+
+class HermiteSolution:
+    """Dense output of a fixed-step integration.
+
+    Quacks like the scipy.integrate.OdeSolution returned by solve_ivp, i.e. it
+    has t_min and t_max attributes and can be called with a time."""
+
+    def __init__(self, ts: np.ndarray, ys: np.ndarray, dys: np.ndarray):
+        # ts is a k-array of step boundaries, ys and dys are k*m arrays of
+        # the y-vector and its derivative at each of those steps.
+        assert len(ts) >= 2
+        self.ts = ts
+        self.ys = ys
+        self.dys = dys
+        self.t_min = ts[0]
+        self.t_max = ts[-1]
+
+    def __call__(self, t: float) -> np.ndarray:
+        """Evaluates the cubic Hermite interpolant of the step containing t."""
+        step = np.searchsorted(self.ts, t, side='right') - 1
+        step = min(max(step, 0), len(self.ts) - 2)
+
+        t0 = self.ts[step]
+        h = self.ts[step + 1] - t0
+        if h == 0:
+            return self.ys[step + 1]
+        s = (t - t0) / h
+        h00 = (1 + 2 * s) * (1 - s) ** 2
+        h10 = s * (1 - s) ** 2
+        h01 = s ** 2 * (3 - 2 * s)
+        h11 = s ** 2 * (s - 1)
+        return (h00 * self.ys[step] + h10 * h * self.dys[step] +
+                h01 * self.ys[step + 1] + h11 * h * self.dys[step + 1])
+
+
+class FixedStepResult(NamedTuple):
+    """Same fields as the result of solve_ivp, that PhysicsEngine uses."""
+    t: np.ndarray
+    y: np.ndarray
+    # A HermiteSolution, or anything else that quacks like an OdeSolution.
+    sol: Callable[[float], np.ndarray]
+    t_events: List[np.ndarray]
+    status: int
+    message: str
+    success: bool
+
+
+def _step_events(events: Sequence[Callable[[float, np.ndarray], float]],
+                 g: List[float], g_new: List[float], t_prev: float, t: float,
+                 sol: Callable[[float], np.ndarray]
+                 ) -> Tuple[List[Tuple[float, int]], Optional[float]]:
+    """Finds when events happened during the step from t_prev to t, the
+    same way solve_ivp does. g and g_new are the values of the events at
+    t_prev and t, and sol(t) is the y-vector at any time in the step.
+
+    Returns a list of (time, event index) for each event that happened, and
+    the time of the first terminal event, or None. Events after the first
+    terminal event didn't happen."""
+    roots = []
+    for index, event in enumerate(events):
+        direction = getattr(event, 'direction', 0)
+        up = g[index] <= 0 <= g_new[index]
+        down = g[index] >= 0 >= g_new[index]
+        if (direction > 0 and up) or (direction < 0 and down) or \
+                (direction == 0 and (up or down)):
+            root = scipy.optimize.brentq(
+                lambda t_root: event(t_root, sol(t_root)),
+                t_prev, t, xtol=4 * np.finfo(float).eps,
+                rtol=4 * np.finfo(float).eps)
+            roots.append((root, index))
+
+    terminal_roots = sorted(
+        root for root in roots
+        if getattr(events[root[1]], 'terminal', False))
+    if not terminal_roots:
+        return roots, None
+    t_stop = terminal_roots[0][0]
+    return [(root, index) for root, index in roots if root <= t_stop], t_stop
+
+
+def find_events(sol: Callable[[float], np.ndarray], t_span: Sequence[float],
+                events: Sequence[Callable[[float, np.ndarray], float]],
+                max_step: float, message: str) -> FixedStepResult:
+    """Checks for events along sol, a dense output that's already known from
+    t_span[0] to t_span[1], e.g. from an analytic propagation. Events are
+    checked every max_step at most, like solve_fixed_step does.
+
+    Returns what solve_ivp would, if it had made sol. The result stops at
+    the first terminal event."""
+    t_start, t_end = t_span
+    n_steps = max(1, int(np.ceil((t_end - t_start) / max_step)))
+    ts = np.linspace(t_start, t_end, n_steps + 1)
+    g = [event(t_start, sol(t_start)) for event in events]
+    t_events: List[List[float]] = [[] for _ in events]
+    t_stop: Optional[float] = None
+
+    if events:
+        for t_prev, t in zip(ts[:-1], ts[1:]):
+            y = sol(t)
+            g_new = [event(t, y) for event in events]
+            roots, t_stop = _step_events(events, g, g_new, t_prev, t, sol)
+            g = g_new
+            for root, index in roots:
+                t_events[index].append(root)
+            if t_stop is not None:
+                break
+
+    t_last = t_end if t_stop is None else t_stop
+    return FixedStepResult(
+        t=np.array([t_start, t_last]),
+        y=np.column_stack([sol(t_start), sol(t_last)]),
+        sol=sol,
+        t_events=[np.array(event_ts) for event_ts in t_events],
+        status=0 if t_stop is None else 1,
+        message='A termination event occurred.' if t_stop is not None
+        else message,
+        success=True
+    )
+
+
+def solve_fixed_step(fun: Callable[[float, np.ndarray], np.ndarray],
+                     t_span: Sequence[float],
+                     y0: np.ndarray,
+                     events: Sequence[Callable[[float, np.ndarray], float]],
+                     max_step: float,
+                     method: str = YOSHIDA4,
+                     dense_output: bool = True) -> FixedStepResult:
+    """Integrates fun from t_span[0] to t_span[1] in equally-sized steps.
+
+    The step size is as large as possible without exceeding max_step.
+    dense_output is accepted for compatibility with solve_ivp, the dense
+    output is always generated."""
+    weights = _COMPOSITION_WEIGHTS[method]
+    t_start, t_end = t_span
+    n_steps = max(1, int(np.ceil((t_end - t_start) / max_step)))
+    h = (t_end - t_start) / n_steps
+
+    y = np.array(y0, dtype=PhysicsState.DTYPE)
+    n = (len(y) - PhysicsState.N_SINGULAR_ELEMENTS) // \
+        len(_PER_ENTITY_MUTABLE_FIELDS)
+
+    # Velocities get kicked.
+    kick = slice(_FIELD_ORDERING['vx'] * n, (_FIELD_ORDERING['vy'] + 1) * n)
+    drift = np.ones(len(y), dtype=bool)
+    drift[kick] = False
+
+    # Positions of entities that aren't landed drift with their velocity.
+    # Landed entities have their velocity set by the derivative function, so
+    # their positions drift with the derivative like everything else.
+    free = np.where(
+        y[_FIELD_ORDERING['landed_on'] * n:
+          (_FIELD_ORDERING['landed_on'] + 1) * n] == PhysicsState.NO_INDEX)[0]
+    free_positions = np.concatenate((
+        _FIELD_ORDERING['x'] * n + free, _FIELD_ORDERING['y'] * n + free))
+    free_velocities = np.concatenate((
+        _FIELD_ORDERING['vx'] * n + free, _FIELD_ORDERING['vy'] * n + free))
+
+    def position_rates(y: np.ndarray, dy: np.ndarray) -> np.ndarray:
+        rates = dy.copy()
+        rates[free_positions] = y[free_velocities]
+        return rates
+
+    t = t_start
+    dy = fun(t, y)
+    ts = [t]
+    ys = [y.copy()]
+    dys = [position_rates(y, dy)]
+    # Events are given the copies in ys, which never change, since y
+    # changes in place after it's derived. See engine._EventEvaluator.
+    g = [event(t, ys[-1]) for event in events]
+    t_events: List[List[float]] = [[] for _ in events]
+    status = 0
+
+    for step in range(n_steps):
+        for weight in weights:
+            y[kick] += weight * h / 2 * dy[kick]
+            y[drift] += weight * h * position_rates(y, dy)[drift]
+            dy = fun(t, y)
+            y[kick] += weight * h / 2 * dy[kick]
+        # Land exactly on t_end, like solve_ivp does.
+        t = t_end if step == n_steps - 1 else t_start + (step + 1) * h
+
+        ts.append(t)
+        ys.append(y.copy())
+        dys.append(position_rates(y, dy))
+        if not events:
+            continue
+
+        # Check for events, the same way solve_ivp does.
+        g_new = [event(t, ys[-1]) for event in events]
+        step_sol = HermiteSolution(
+            np.array(ts[-2:]), np.array(ys[-2:]), np.array(dys[-2:]))
+        roots, t_stop = _step_events(events, g, g_new, ts[-2], t, step_sol)
+        g = g_new
+        for root, index in roots:
+            t_events[index].append(root)
+
+        if t_stop is not None:
+            y = step_sol(t_stop)
+            dy = fun(t_stop, y)
+            ts[-1] = t_stop
+            ys[-1] = y
+            dys[-1] = position_rates(y, dy)
+            if t_stop == ts[-2] and len(ts) > 2:
+                # The event happened right at the start of this step.
+                del ts[-2], ys[-2], dys[-2]
+            status = 1
+            break
+
+    return FixedStepResult(
+        t=np.array(ts),
+        y=np.array(ys).T,
+        sol=HermiteSolution(np.array(ts), np.array(ys), np.array(dys)),
+        t_events=[np.array(event_ts) for event_ts in t_events],
+        status=status,
+        message=('A termination event occurred.' if status == 1 else
+                 'The solver successfully reached the end of the interval.'),
+        success=True
+    )
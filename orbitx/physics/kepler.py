@@ -0,0 +1,308 @@
+"""Analytic two-body propagation of coasting spacecraft.
+
+When nothing is thrusting and the craft is out of any atmosphere, the only
+thing acting on a spacecraft is gravity. Usually one body (the Earth in low
+orbit, the Sun in interplanetary space) completely dominates, and the craft
+follows a Kepler orbit around that body. We can calculate where the craft is
+on that orbit at any time directly, by solving Kepler's equation, instead of
+taking thousands of RK45 steps.
+
+Coast.build checks if this is a good enough approximation. Each free-flying
+artificial entity needs a 'primary' body whose pull is much bigger than the
+tidal pull of everything else (which is how we define the sphere of
+influence), and an orbit that doesn't dip into the primary's atmosphere.
+Artificial entities that are landed on something just move along with it.
+
+Planets and moons still move however they move, Coast just needs a function
+that says where they are. This is fastest with an ephemeris (see
+ephemeris.py), since then nothing at all has to be integrated.
+
+Example usage:
+coast = kepler.Coast.build(t, y, gravity_sources)
+if coast is not None:
+    solution = coast.solution(t, t + 1000, natural_solution, max_step=100)
+    if solution is not None:
+        y_1d = solution(t + 500)
+"""
+
+import math
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from orbitx import common
+from orbitx.data_structures import Navmode, PhysicsState, _FIELD_ORDERING
+from orbitx.physics import integrators
+
+# The craft is in the sphere of influence of its primary when the tidal pull
+# of every other body, relative to the pull of the primary, is less than
+# this. For a craft in low earth orbit, the Moon and Sun are about 1e-7.
+MAX_PERTURBATION = 1e-4
+
+# Orbits this close to parabolic are left to numerical integration, since
+# neither the elliptic nor hyperbolic Kepler's equation works well there.
+MIN_PARABOLIC_DISTANCE = 1e-6
+
+_MAX_ITERATIONS = 64
+
+
+class KeplerOrbit:
+    """The position and velocity of a test particle relative to a point mass
+    with gravitational parameter mu, some time after it was at r0 and v0.
+
+    Uses the difference form of Kepler's equation with Lagrange's f and g
+    coefficients, see chapter 4.5 of Vallado's Fundamentals of Astrodynamics
+    and Applications. This works for circular orbits too, where the argument
+    of periapsis isn't defined."""
+
+    def __init__(self, r0: np.ndarray, v0: np.ndarray, mu: float):
+        self.r0 = r0
+        self.v0 = v0
+        self.mu = mu
+        self._r0_mag = math.sqrt(np.dot(r0, r0))
+        self.a = 1 / (2 / self._r0_mag - np.dot(v0, v0) / mu)
+        # e * cos(E0) and e * sin(E0), where E0 is the initial eccentric
+        # anomaly. For hyperbolas, these are e * cosh(H0) and e * sinh(H0).
+        self._e_cos = 1 - self._r0_mag / self.a
+        self._e_sin = np.dot(r0, v0) / math.sqrt(mu * abs(self.a))
+        self.mean_motion = math.sqrt(mu / abs(self.a) ** 3)
+        if self.a > 0:
+            self.eccentricity = math.sqrt(self._e_cos ** 2 + self._e_sin ** 2)
+        else:
+            self.eccentricity = math.sqrt(self._e_cos ** 2 - self._e_sin ** 2)
+
+    def periapsis(self) -> float:
+        """Distance from the centre of the primary at closest approach."""
+        return self.a * (1 - self.eccentricity)
+
+    def __call__(self, dt: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the relative position and velocity, dt seconds later."""
+        if self.a > 0:
+            f, g, fdot, gdot = self._elliptic_coefficients(dt)
+        else:
+            f, g, fdot, gdot = self._hyperbolic_coefficients(dt)
+        return f * self.r0 + g * self.v0, fdot * self.r0 + gdot * self.v0
+
+    def _elliptic_coefficients(self, dt: float):
+        # Solve dM = dE - e cos(E0) sin(dE) + e sin(E0) (1 - cos(dE)) for dE.
+        # Every whole orbit adds 2pi to both sides, so only solve for the
+        # remainder. The solution is within 2e of dM.
+        a, e_cos, e_sin = self.a, self._e_cos, self._e_sin
+        dM = math.fmod(self.mean_motion * dt, 2 * math.pi)
+        low, high = dM - 2 * self.eccentricity, dM + 2 * self.eccentricity
+        dE = dM
+        for _ in range(_MAX_ITERATIONS):
+            sin_dE, cos_dE = math.sin(dE), math.cos(dE)
+            residual = dE - e_cos * sin_dE + e_sin * (1 - cos_dE) - dM
+            slope = 1 - e_cos * cos_dE + e_sin * sin_dE
+            new_dE = min(max(dE - residual / slope, low), high)
+            if abs(new_dE - dE) < 1e-15 * max(1, abs(dE)):
+                dE = new_dE
+                break
+            dE = new_dE
+
+        sin_dE, cos_dE = math.sin(dE), math.cos(dE)
+        r = a * (1 - e_cos * cos_dE + e_sin * sin_dE)
+        f = 1 - a / self._r0_mag * (1 - cos_dE)
+        # This is dt - (dE - sin(dE)) / n, rearranged so that it doesn't
+        # lose precision after many orbits.
+        g = ((self._r0_mag / a) * sin_dE +
+             e_sin * (1 - cos_dE)) / self.mean_motion
+        fdot = -math.sqrt(self.mu * a) * sin_dE / (r * self._r0_mag)
+        gdot = 1 - a / r * (1 - cos_dE)
+        return f, g, fdot, gdot
+
+    def _hyperbolic_coefficients(self, dt: float):
+        # Solve M = e sinh(H) - H for H, starting from the usual guess.
+        a, e_cos, e_sin = self.a, self._e_cos, self._e_sin
+        e = self.eccentricity
+        H0 = math.asinh(e_sin / e)
+        M = (e_sin - H0) + self.mean_motion * dt
+        H = math.asinh(M / e)
+        for _ in range(_MAX_ITERATIONS):
+            step = (e * math.sinh(H) - H - M) / (e * math.cosh(H) - 1)
+            H -= step
+            if abs(step) < 1e-15 * max(1, abs(H)):
+                break
+        dH = H - H0
+
+        sinh_dH, cosh_dH = math.sinh(dH), math.cosh(dH)
+        r = a * (1 - e_cos * cosh_dH - e_sin * sinh_dH)
+        f = 1 - a / self._r0_mag * (1 - cosh_dH)
+        g = (-(self._r0_mag / a) * sinh_dH +
+             e_sin * (cosh_dH - 1)) / self.mean_motion
+        fdot = -math.sqrt(-self.mu * a) * sinh_dH / (r * self._r0_mag)
+        gdot = 1 - a / r * (1 - cosh_dH)
+        return f, g, fdot, gdot
+
+
+def _primary(y_1d: np.ndarray, n: int, index: int, M: np.ndarray,
+             gravity_sources: np.ndarray) -> Tuple[int, float]:
+    """Returns the index of the body that pulls hardest on entity index,
+    and how big the tidal pull of all other bodies is relative to it."""
+    X = y_1d[_FIELD_ORDERING['x'] * n:(_FIELD_ORDERING['x'] + 1) * n]
+    Y = y_1d[_FIELD_ORDERING['y'] * n:(_FIELD_ORDERING['y'] + 1) * n]
+    sources = gravity_sources[gravity_sources != index]
+    displacements = np.column_stack(
+        (X[sources] - X[index], Y[sources] - Y[index]))
+    distances = np.linalg.norm(displacements, axis=1)
+    accs = (common.G * M[sources] / distances ** 3).reshape(-1, 1) * \
+        displacements
+    strongest = np.argmax(np.linalg.norm(accs, axis=1))
+    primary = sources[strongest]
+
+    # The tidal pull is how differently the other bodies pull on this entity
+    # and on its primary.
+    others = np.delete(sources, strongest)
+    primary_displacements = np.column_stack(
+        (X[others] - X[primary], Y[others] - Y[primary]))
+    primary_accs = (
+        common.G * M[others] /
+        np.linalg.norm(primary_displacements, axis=1) ** 3
+    ).reshape(-1, 1) * primary_displacements
+    tidal_acc = np.delete(accs, strongest, axis=0).sum(axis=0) - \
+        primary_accs.sum(axis=0)
+    return primary, (np.linalg.norm(tidal_acc) /
+                     np.linalg.norm(accs[strongest]))
+
+
+class Coast:
+    """How every artificial entity in a state moves during a coast.
+
+    Free-flying entities follow a KeplerOrbit around their primary. Landed
+    entities rotate rigidly along with whatever they're landed on."""
+
+    def __init__(self, t: float, y: PhysicsState, M: np.ndarray,
+                 gravity_sources: np.ndarray,
+                 orbits: Dict[int, Tuple[int, KeplerOrbit]]):
+        self._y0 = y.y0()
+        self._t0 = t
+        self._n = len(y)
+        self._M = M
+        self._gravity_sources = gravity_sources
+        self._orbits = orbits
+        self._landers = {
+            lander: ground for lander, ground in y.LandedOn.items()
+            if y[lander].artificial
+        }
+
+    @staticmethod
+    def build(t: float, y: PhysicsState, gravity_sources: np.ndarray
+              ) -> Optional['Coast']:
+        """Returns a Coast if every artificial entity in y (which is the
+        state at time t) can be propagated analytically, otherwise None."""
+        if y.navmode != Navmode['Manual'] or not integrators.is_coasting(y):
+            return None
+
+        y_1d = y.y0()
+        M = np.array([entity.mass for entity in y]) + y.Fuel
+        landed_on = y.LandedOn
+        orbits: Dict[int, Tuple[int, KeplerOrbit]] = {}
+        for index, entity in enumerate(y):
+            if not entity.artificial:
+                continue
+            if index in gravity_sources:
+                # This artificial entity pulls other entities around.
+                return None
+            if index in landed_on:
+                if landed_on[index] in landed_on:
+                    # We don't handle landers that are landed on landers.
+                    return None
+                continue
+
+            primary_index, perturbation = _primary(
+                y_1d, len(y), index, M, gravity_sources)
+            if perturbation > MAX_PERTURBATION:
+                return None
+            primary = y[primary_index]
+            orbit = KeplerOrbit(
+                entity.pos - primary.pos, entity.v - primary.v,
+                common.G * M[primary_index])
+            if abs(orbit.eccentricity - 1) < MIN_PARABOLIC_DISTANCE:
+                return None
+
+            # Don't coast through the primary, or its atmosphere.
+            safe_distance = primary.r + entity.r
+            if primary.atmosphere_thickness != 0 and \
+                    primary.atmosphere_scaling != 0:
+                # See calc.relevant_atmosphere for this cutoff.
+                safe_distance += 20 * 1000 * primary.atmosphere_scaling
+            heading_outwards = \
+                orbit.a < 0 and np.dot(orbit.r0, orbit.v0) >= 0
+            if orbit.periapsis() < safe_distance and not heading_outwards:
+                return None
+
+            orbits[index] = (primary_index, orbit)
+
+        return Coast(t, y, M, gravity_sources, orbits)
+
+    def solution(self, t_start: float, t_end: float,
+                 natural_solution: Callable[[float], np.ndarray],
+                 max_step: float) -> Optional['CoastSolution']:
+        """Returns the dense output of this coast from t_start to t_end.
+
+        natural_solution(t) returns a y-vector in which the natural bodies are
+        correct at time t. Returns None if some entity would leave the
+        sphere of influence of its primary by t_end, checking at least every
+        max_step seconds."""
+        solution = CoastSolution(self, t_start, t_end, natural_solution)
+        n_checks = max(1, int(np.ceil((t_end - t_start) / max_step)))
+        for t in np.linspace(t_start, t_end, n_checks + 1)[1:]:
+            y_1d = solution(t)
+            for index, (primary_index, _) in self._orbits.items():
+                new_primary_index, perturbation = _primary(
+                    y_1d, self._n, index, self._M, self._gravity_sources)
+                if new_primary_index != primary_index or \
+                        perturbation > MAX_PERTURBATION:
+                    return None
+        return solution
+
+
+class CoastSolution:
+    """Dense output of a Coast. Quacks like a scipy.integrate.OdeSolution."""
+
+    def __init__(self, coast: Coast, t_min: float, t_max: float,
+                 natural_solution: Callable[[float], np.ndarray]):
+        self._coast = coast
+        self._natural_solution = natural_solution
+        self.t_min = t_min
+        self.t_max = t_max
+
+    def __call__(self, t: float) -> np.ndarray:
+        coast = self._coast
+        n = coast._n
+        y0 = coast._y0
+        dt = t - coast._t0
+        y_1d = np.array(self._natural_solution(t), dtype=PhysicsState.DTYPE)
+
+        x, y = _FIELD_ORDERING['x'] * n, _FIELD_ORDERING['y'] * n
+        vx, vy = _FIELD_ORDERING['vx'] * n, _FIELD_ORDERING['vy'] * n
+        heading = _FIELD_ORDERING['heading'] * n
+        spin = _FIELD_ORDERING['spin'] * n
+
+        for index, (primary, orbit) in coast._orbits.items():
+            r, v = orbit(dt)
+            y_1d[x + index] = y_1d[x + primary] + r[0]
+            y_1d[y + index] = y_1d[y + primary] + r[1]
+            y_1d[vx + index] = y_1d[vx + primary] + v[0]
+            y_1d[vy + index] = y_1d[vy + primary] + v[1]
+            y_1d[heading + index] = y0[heading + index] + y0[spin + index] * dt
+
+        for lander, ground in coast._landers.items():
+            # Rotate the lander around its ground, since it's stuck to it.
+            ground_spin = y0[spin + ground]
+            angle = ground_spin * dt
+            offset_x = y0[x + lander] - y0[x + ground]
+            offset_y = y0[y + lander] - y0[y + ground]
+            offset_x, offset_y = (
+                offset_x * math.cos(angle) - offset_y * math.sin(angle),
+                offset_x * math.sin(angle) + offset_y * math.cos(angle))
+            y_1d[x + lander] = y_1d[x + ground] + offset_x
+            y_1d[y + lander] = y_1d[y + ground] + offset_y
+            # See calc.rotational_speed
+            y_1d[vx + lander] = y_1d[vx + ground] - ground_spin * offset_y
+            y_1d[vy + lander] = y_1d[vy + ground] + ground_spin * offset_x
+            y_1d[heading + lander] = \
+                y0[heading + lander] + y0[spin + lander] * dt
+
+        return y_1d
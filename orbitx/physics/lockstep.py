@@ -0,0 +1,217 @@
+"""Deterministic simulation in fixed steps, so that clients can follow a
+physics server by simulating along with it, instead of being sent states.
+
+Normally the simthread of a PhysicsEngine simulates as far ahead as the wall
+clock says, in however many pieces it gets around to, and commands land
+wherever the simulation happens to be. Two computers simulating the same
+savefile end up with slightly different states.
+
+In lockstep mode, the simulation only moves in steps. Every step, the
+commands of that step are applied at the simtime the step starts at, and
+then the simulation goes time_acc * STEP_DURATION seconds further. Nothing
+depends on the wall clock, so any computer that starts from the same state
+and applies the same commands at the same steps gets bit-for-bit the same
+states. A physics server in lockstep mode only has to send each step's
+commands to its clients, no matter how many entities there are.
+
+Every HASH_INTERVAL steps the server also sends a hash of its state. If a
+client's state has a different hash, e.g. because its CPU rounds
+differently, it gets a new snapshot of the server's state.
+
+Example usage, on the physics server:
+lockstep = Lockstep(state)
+while True:
+    state = lockstep.advance(commands)
+
+And on a client:
+mirror = LockstepMirror(network.StateClient(...))
+while True:
+    state = mirror.state()
+"""
+
+import hashlib
+import logging
+import threading
+from typing import Iterable, Optional
+
+import grpc
+
+from orbitx import network
+from orbitx.data_structures import PhysicsState
+from orbitx.network import Request
+from orbitx.physics import engine, ephemeris, integrators
+
+log = logging.getLogger()
+
+# How many seconds of real time each step lasts, at 1x time acc.
+STEP_DURATION = 0.1
+
+# How many steps between state hashes.
+HASH_INTERVAL = 10
+
+
+def state_hash(state: PhysicsState) -> int:
+    """Returns a 64-bit hash of everything in state that the simulation can
+    change. Unlike hash(), this is the same in every process."""
+    digest = hashlib.blake2b(state.y0().tobytes(), digest_size=8)
+    digest.update('\0'.join([
+        state.craft or '', state.reference or '', state.target or '',
+        repr(state.timestamp), str(state.navmode),
+        str(state.parachute_deployed)
+    ]).encode())
+    return int.from_bytes(digest.digest(), 'little')
+
+
+class Lockstep:
+    """Simulates a state one step at a time, deterministically."""
+
+    def __init__(self, state: PhysicsState, step: int = 0,
+                 integrator: str = integrators.RK45,
+                 ephem: Optional[ephemeris.Ephemeris] = None):
+        # The state after this step.
+        self.step = step
+        self._integrator = integrator
+        self._ephemeris = ephem
+        self._restart(state)
+
+    def _restart(self, state: PhysicsState):
+        self._engine = engine.PhysicsEngine(
+            state, self._integrator, self._ephemeris, simthread=False)
+        # This applies the state, and doesn't simulate anything.
+        self._engine._simulate(state.timestamp)
+
+    @property
+    def state(self) -> PhysicsState:
+        y = self._engine._simulated_y
+        assert y is not None
+        return PhysicsState(None, y)
+
+    def state_hash(self) -> int:
+        assert self._engine._simulated_y is not None
+        return state_hash(self._engine._simulated_y)
+
+    def advance(self, requests: Iterable[Request]) -> PhysicsState:
+        """Applies requests, simulates one step, and returns the new state.
+
+        Loading a savefile replaces the whole state and doesn't simulate
+        anything. The savefile might not be the same on every computer, so
+        the physics server sends the loaded state as a snapshot."""
+        requests = [request for request in requests
+                    if request.ident != Request.NOOP]
+        self.step += 1
+
+        if any(request.ident == Request.LOAD_SAVEFILE
+               for request in requests):
+            state = self.state
+            for request in requests:
+                state = engine._one_request(request, state)
+            self._restart(state)
+            return self.state
+
+        t = self._engine._simulated_t
+        if len(requests) != 0:
+            self._engine._commands.append(engine._Command(
+                simtime=t, requests=requests, state=None))
+            self._engine._simulate(t)
+
+        y = self._engine._simulated_y
+        assert y is not None
+        if round(y.time_acc) != 0:
+            self._engine._simulate(t + y.time_acc * STEP_DURATION)
+        return self.state
+
+    def step_message(self, requests: Iterable[Request],
+                     snapshot: bool = False) -> network.protos.LockstepStep:
+        """Returns the LockstepStep that tells clients about the step that
+        was just simulated, with requests applied at the start of it."""
+        message = network.protos.LockstepStep(
+            step=self.step, commands=requests)
+        if snapshot:
+            # Clients don't have to simulate anything to get this state, so
+            # there's nothing to check.
+            message.snapshot.CopyFrom(self.state.as_proto())
+        elif self.step % HASH_INTERVAL == 0:
+            message.state_hash = self.state_hash()
+            message.has_state_hash = True
+        return message
+
+
+class LockstepMirror:
+    """Follows a physics server in lockstep mode, by simulating every step
+    in a background thread as soon as the server sends its commands.
+
+    If the state here ever has a different hash than the server's, this
+    subscribes again to get a new snapshot. self.resyncs counts how many
+    times that happened."""
+
+    def __init__(self, connection: network.StateClient,
+                 integrator: str = integrators.RK45,
+                 ephem: Optional[ephemeris.Ephemeris] = None):
+        self._connection = connection
+        self._integrator = integrator
+        self._ephemeris = ephem
+        self._lock = threading.Lock()
+        self._lockstep: Optional[Lockstep] = None
+        self._state: Optional[PhysicsState] = None
+        self._error: Optional[grpc.RpcError] = None
+        self._closing = False
+        self._steps: Optional[grpc.Call] = None
+        self.resyncs = 0
+
+        self._thread = threading.Thread(
+            target=self._follow, name='lockstep mirror', daemon=True)
+        self._thread.start()
+
+    def state(self) -> Optional[PhysicsState]:
+        """Returns the state after the latest step, or None if the server
+        hasn't sent anything yet."""
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            return self._state
+
+    def close(self):
+        self._closing = True
+        if self._steps is not None:
+            self._steps.cancel()
+
+    def _follow(self):
+        while not self._closing:
+            self._steps = self._connection.subscribe_lockstep()
+            try:
+                for message in self._steps:
+                    if not self._apply(message):
+                        log.warning(
+                            f'Out of sync with the physics server at step '
+                            f'{message.step}, getting a new snapshot.')
+                        self.resyncs += 1
+                        self._steps.cancel()
+                        break
+                else:
+                    return
+            except grpc.RpcError as err:
+                if err.code() == grpc.StatusCode.CANCELLED:
+                    continue
+                log.error(f'Lockstep subscription ended with {err.code()}')
+                with self._lock:
+                    self._error = err
+                return
+
+    def _apply(self, message: network.protos.LockstepStep) -> bool:
+        """Simulates the step in message, and returns False if the result
+        doesn't match the physics server."""
+        if message.HasField('snapshot'):
+            self._lockstep = Lockstep(
+                PhysicsState(None, message.snapshot), message.step,
+                self._integrator, self._ephemeris)
+            state = self._lockstep.state
+        else:
+            assert self._lockstep is not None
+            assert message.step == self._lockstep.step + 1, \
+                (message.step, self._lockstep.step)
+            state = self._lockstep.advance(message.commands)
+
+        with self._lock:
+            self._state = state
+        return (not message.has_state_hash or
+                message.state_hash == self._lockstep.state_hash())
@@ -13,12 +13,15 @@ class Program(NamedTuple):
     argparser: argparse.ArgumentParser
 
 
+from . import build_ephemeris  # noqa: E402
 from . import compat  # noqa: E402
+from . import ensemble  # noqa: E402
 from . import flight_training  # noqa: E402
 from . import hab_flight  # noqa: E402
 from . import mc_flight  # noqa: E402
 from . import physics_server  # noqa: E402
 from . import mist  # noqa: E402
+from . import relay  # noqa: E402
 
 # A list of all defined programs, for convenience in other code.
 LISTING: List[Program] = [module.program for module in [  # type: ignore
@@ -28,4 +31,7 @@ LISTING: List[Program] = [module.program for module in [  # type: ignore
     mc_flight,
     compat,
     mist,
+    relay,
+    build_ephemeris,
+    ensemble,
 ]]
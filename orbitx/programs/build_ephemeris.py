@@ -0,0 +1,70 @@
+import argparse
+import logging
+import os
+from pathlib import Path
+
+from orbitx import common
+from orbitx import programs
+from orbitx.physics import ephemeris
+
+log = logging.getLogger()
+
+name = "Build Ephemeris"
+
+description = (
+    "Simulate the planets and moons in a savefile ahead of time, and save "
+    "their trajectories to an ephemeris file."
+    "<br />Give this ephemeris to a Physics Server or Flight Training, and "
+    "they will only have to simulate spacecraft, which is much faster."
+)
+
+argument_parser = argparse.ArgumentParser(
+    'buildephemeris',
+    description=description.replace('<br />', '\n'))
+argument_parser.add_argument(
+    'loadfile', type=str, nargs='?', default='OCESS.json',
+    help=(
+        f'Name of the savefile to load, relative to {common.savefile(".")}. '
+        'Should be a .json savefile written by OrbitX. '
+        'Can also read OrbitV .RND savefiles.')
+)
+argument_parser.add_argument(
+    '--days', type=float, default=365,
+    help='How many days after the savefile the ephemeris should cover.'
+)
+argument_parser.add_argument(
+    '--segment-duration', type=float,
+    default=ephemeris.DEFAULT_SEGMENT_DURATION,
+    help=(
+        'Length in seconds of each piece of the ephemeris. Shorter pieces are '
+        'more accurate, but make the ephemeris file bigger.')
+)
+
+
+def main(args: argparse.Namespace):
+    loadfile: Path
+    if os.path.isabs(args.loadfile):
+        loadfile = Path(args.loadfile)
+    else:
+        # Take paths relative to 'data/saves/'
+        loadfile = common.savefile(args.loadfile)
+
+    # Written to data/ephemerides/, e.g. OCESS.json -> OCESS.npy
+    output = common.ephemeris_file(loadfile.stem + '.npy')
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    ephemeris.build(
+        common.load_savefile(loadfile),
+        duration=args.days * 24 * 60 * 60,
+        path=output,
+        segment_duration=args.segment_duration)
+    log.info(
+        f'Run the Physics Server with "--ephemeris {output.name}" to use it.')
+
+
+program = programs.Program(
+    name=name,
+    description=description,
+    main=main,
+    argparser=argument_parser
+)
@@ -6,11 +6,13 @@ Communicates to orbitx with GRPC, and to orbit using orbit_communication.py.
 
 import argparse
 import logging
+import time
 from datetime import datetime
 from pathlib import Path
 
 import grpc
 
+from orbitx import common
 from orbitx import network
 from orbitx import orbitv_file_interface
 from orbitx import programs
@@ -40,11 +42,15 @@ argument_parser.add_argument(
     "--physics-server", default="localhost",
     help="network name of the physics server"
 )
+argument_parser.add_argument(
+    "--session", default=network.DEFAULT_SESSION,
+    help="name of the session on the physics server, if it has many"
+)
 
 
 def main(args: argparse.Namespace):
     orbitx_connection = network.StateClient(
-        network.Request.COMPAT, args.physics_server)
+        network.Request.COMPAT, args.physics_server, args.session)
     log.info(f'Connecting to OrbitX Physics Server: {args.physics_server}')
 
     intermediary = orbitv_file_interface.OrbitVIntermediary(
@@ -52,7 +58,7 @@ def main(args: argparse.Namespace):
 
     try:
         # Make sure we have a connection before continuing.
-        orbitx_connection.get_state(
+        state = orbitx_connection.get_state(
             [network.Request(ident=network.Request.NOOP)])
     except grpc.RpcError as err:
         log.error(f'Could not connect to Physics Server: {err.code()}')
@@ -64,6 +70,13 @@ def main(args: argparse.Namespace):
     last_orbitsse_modified_time = 0.0
     last_orbitsse_read_datetime = datetime.fromtimestamp(0)
 
+    # OrbitV only knows about the entities in its STARSr file, so that's all
+    # we need the physics server to send us. If the physics server is on
+    # this computer, we read states from its memory instead.
+    orbitx_connection.subscribe(
+        interests=[network.Interest(entities=intermediary.orbitv_names)],
+        shared_memory=True)
+
     try:
         while True:
             orbitsse_modified_time = intermediary.orbitsse.stat().st_mtime
@@ -75,10 +88,16 @@ def main(args: argparse.Namespace):
                 last_orbitsse_read_datetime = datetime.now()
                 update = intermediary.read_engineering_update()
 
-            state = orbitx_connection.get_state([update])
-            intermediary.write_state(state)
+            if update.ident != network.Request.NOOP:
+                orbitx_connection.send_commands([update])
+
+            new_state = orbitx_connection.pop_state()
+            if new_state is not None:
+                state = new_state
+                intermediary.write_state(state)
             gui.update(
                 update, state._entity_names, last_orbitsse_read_datetime)
+            time.sleep(1 / common.FRAMERATE)
     except grpc.RpcError as err:
         log.error(
             f'Got response code {err.code()} from orbitx, shutting down')
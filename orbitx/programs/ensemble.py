@@ -0,0 +1,248 @@
+import argparse
+import concurrent.futures
+import logging
+import os
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+from orbitx import common
+from orbitx import physics
+from orbitx import programs
+from orbitx.data_structures import PhysicsState, _FIELD_ORDERING
+from orbitx.physics import calc, ephemeris, integrators
+from orbitx.physics.engine import CollisionEvent, HabFuelEvent
+import orbitx.orbitx_pb2 as protos
+
+log = logging.getLogger()
+
+name = "Ensemble"
+
+description = (
+    "Simulate many slightly different copies of a savefile at once, to find "
+    "out how likely a mission is to land, crash, or run out of fuel."
+    "<br />Each run starts with a randomly jittered craft velocity and "
+    "engine thrust. The outcome of every run is saved to a NumPy .npz file."
+)
+
+argument_parser = argparse.ArgumentParser(
+    'ensemble',
+    description=description.replace('<br />', '\n'))
+argument_parser.add_argument(
+    'loadfile', type=str, nargs='?', default='earth-flyby.json',
+    help=(
+        f'Name of the savefile to load, relative to {common.savefile(".")}. '
+        'Should be a .json savefile written by OrbitX. '
+        'Can also read OrbitV .RND savefiles.')
+)
+argument_parser.add_argument(
+    '--runs', type=int, default=100,
+    help='How many copies of the savefile to simulate.'
+)
+argument_parser.add_argument(
+    '--hours', type=float, default=24,
+    help='How many hours after the savefile each run should simulate.'
+)
+argument_parser.add_argument(
+    '--velocity-jitter', type=float, default=1,
+    help=(
+        'Standard deviation, in m/s, of the random change to the velocity of '
+        'the craft in each run.')
+)
+argument_parser.add_argument(
+    '--thrust-jitter', type=float, default=0.01,
+    help=(
+        'Standard deviation of the random change to engine thrust in each '
+        'run, as a fraction of normal thrust.')
+)
+argument_parser.add_argument(
+    '--seed', type=int, default=0,
+    help='Runs are the same every time the same seed is used.'
+)
+argument_parser.add_argument(
+    '--workers', type=int, default=os.cpu_count() or 1,
+    help='How many processes to simulate runs in. Defaults to one per core.'
+)
+integrators.add_argument(argument_parser)
+ephemeris.add_argument(argument_parser)
+
+# What happened in each run. Times are NaN and indices are -1 if the thing
+# never happened. Indices are into the 'names' array of the output file.
+# Orbit elements are of the craft around the reference at the end of the run.
+OUTCOME_DTYPE = np.dtype([
+    ('velocity_jitter', np.float64, (2,)),
+    ('thrust_scale', np.float64),
+    ('collision_time', np.float64),
+    ('collided_with', np.int32),
+    ('fuel_exhaustion_time', np.float64),
+    ('landed_on', np.int32),
+    ('broken', np.bool_),
+    ('semimajor_axis', np.float64),
+    ('eccentricity', np.float64),
+    ('periapsis', np.float64),
+    ('apoapsis', np.float64),
+])
+
+# Set in each worker process by _init_worker.
+_initial_states: np.ndarray
+_initial_states_memory: shared_memory.SharedMemory
+_template: protos.PhysicalState
+_t_end: float
+_integrator: str
+_ephem: Optional[ephemeris.Ephemeris]
+
+
+def _init_worker(memory_name: str, shape: Tuple[int, int],
+                 template: bytes, t_end: float, integrator: str,
+                 ephemeris_path: Optional[Path]):
+    global _initial_states, _initial_states_memory, _template, _t_end, \
+        _integrator, _ephem
+    # Every worker reads initial y-vectors straight out of the main process'
+    # memory, instead of each run being pickled and sent to a worker.
+    _initial_states_memory = shared_memory.SharedMemory(memory_name)
+    _initial_states = np.ndarray(
+        shape, dtype=PhysicsState.DTYPE, buffer=_initial_states_memory.buf)
+    _template = protos.PhysicalState.FromString(template)
+    _t_end = t_end
+    _integrator = integrator
+    _ephem = None
+    if ephemeris_path is not None:
+        _ephem = ephemeris.Ephemeris(ephemeris_path)
+
+
+def _run(run: int, thrust_scale: float) -> np.ndarray:
+    """Simulates one run in a worker process, and returns its outcome."""
+    state = PhysicsState(_initial_states[run].copy(), _template)
+    craft = state._entity_names.index(state.craft)
+
+    # Engine performance isn't part of the state, so change it for this
+    # process while this run is simulating.
+    original_capabilities = dict(common.craft_capabilities)
+    for craft_name, capabilities in original_capabilities.items():
+        common.craft_capabilities[craft_name] = capabilities._replace(
+            thrust=capabilities.thrust * thrust_scale)
+    try:
+        trajectory = physics.simulate(
+            state, _t_end, integrator=_integrator, ephem=_ephem)
+    finally:
+        common.craft_capabilities.update(original_capabilities)
+
+    outcome = np.zeros(1, dtype=OUTCOME_DTYPE)[0]
+    outcome['thrust_scale'] = thrust_scale
+    outcome['collision_time'] = np.nan
+    outcome['collided_with'] = PhysicsState.NO_INDEX
+    outcome['fuel_exhaustion_time'] = np.nan
+    for t, event in trajectory.events:
+        # The pair is worked out just before the collision is handled. After
+        # that, the craft might be landed on what it collided with.
+        if isinstance(event, CollisionEvent) and event.pair is not None and \
+                craft in event.pair and np.isnan(outcome['collision_time']):
+            outcome['collision_time'] = t
+            outcome['collided_with'] = \
+                event.pair[1] if event.pair[0] == craft else event.pair[0]
+        if isinstance(event, HabFuelEvent) and \
+                np.isnan(outcome['fuel_exhaustion_time']):
+            outcome['fuel_exhaustion_time'] = t
+
+    final = trajectory(trajectory.t_max)
+    outcome['landed_on'] = final.LandedOn.get(craft, PhysicsState.NO_INDEX)
+    outcome['broken'] = final[craft].broken
+    if final.reference == final.craft:
+        outcome['semimajor_axis'] = outcome['eccentricity'] = np.nan
+        outcome['periapsis'] = outcome['apoapsis'] = np.nan
+    else:
+        craft_entity = final.craft_entity()
+        reference = final.reference_entity()
+        outcome['semimajor_axis'] = \
+            calc.semimajor_axis(craft_entity, reference)
+        outcome['eccentricity'] = calc.fastnorm(
+            calc.eccentricity(craft_entity, reference))
+        outcome['periapsis'] = calc.periapsis(craft_entity, reference)
+        outcome['apoapsis'] = calc.apoapsis(craft_entity, reference)
+    return outcome
+
+
+def main(args: argparse.Namespace):
+    loadfile: Path
+    if os.path.isabs(args.loadfile):
+        loadfile = Path(args.loadfile)
+    else:
+        # Take paths relative to 'data/saves/'
+        loadfile = common.savefile(args.loadfile)
+
+    ephemeris_path = None
+    if args.ephemeris:
+        ephemeris_path = common.ephemeris_file(args.ephemeris)
+
+    # Written to data/ensembles/, e.g. OCESS.json -> OCESS.npz
+    output = common.ensemble_file(loadfile.stem + '.npz')
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    state = common.load_savefile(loadfile)
+    assert state.craft is not None, 'There is no craft to jitter'
+    craft = state._entity_names.index(state.craft)
+    # Run as fast as the flight programs can. This still slows down when
+    # accelerating hard, see HighAccEvent.
+    state.time_acc = common.TIME_ACCS[-1].value
+    n = len(state)
+
+    rng = np.random.default_rng(args.seed)
+    velocity_jitter = rng.normal(0, args.velocity_jitter, (args.runs, 2))
+    thrust_scales = np.maximum(
+        rng.normal(1, args.thrust_jitter, args.runs), 0)
+
+    initial_states_memory = shared_memory.SharedMemory(
+        create=True,
+        size=args.runs * len(state.y0()) * PhysicsState.DTYPE().itemsize)
+    initial_states = np.ndarray(
+        (args.runs, len(state.y0())), dtype=PhysicsState.DTYPE,
+        buffer=initial_states_memory.buf)
+    try:
+        initial_states[:] = state.y0()
+        initial_states[:, _FIELD_ORDERING['vx'] * n + craft] += \
+            velocity_jitter[:, 0]
+        initial_states[:, _FIELD_ORDERING['vy'] * n + craft] += \
+            velocity_jitter[:, 1]
+
+        log.info(
+            f'Simulating {args.runs} runs of {loadfile.name} in '
+            f'{args.workers} processes.')
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.workers,
+                initializer=_init_worker,
+                initargs=(initial_states_memory.name, initial_states.shape,
+                          state.as_proto().SerializeToString(),
+                          state.timestamp + args.hours * 60 * 60,
+                          args.integrator, ephemeris_path)) as executor:
+            outcomes = np.array(list(executor.map(
+                _run, range(args.runs), thrust_scales,
+                chunksize=max(1, args.runs // (args.workers * 4)))),
+                dtype=OUTCOME_DTYPE)
+    finally:
+        # The shared memory can't be closed while it's still referenced.
+        del initial_states
+        initial_states_memory.close()
+        initial_states_memory.unlink()
+
+    outcomes['velocity_jitter'] = velocity_jitter
+    np.savez_compressed(
+        output, outcomes=outcomes,
+        names=np.array([entity.name for entity in state]))
+
+    log.info(
+        f'{np.count_nonzero(~np.isnan(outcomes["collision_time"]))} runs '
+        f'collided, {np.count_nonzero(outcomes["landed_on"] >= 0)} ended '
+        f'landed, {np.count_nonzero(outcomes["broken"])} broke the craft, '
+        f'and {np.count_nonzero(~np.isnan(outcomes["fuel_exhaustion_time"]))} '
+        'ran out of fuel.')
+    log.info(f'Wrote outcomes of every run to {output}.')
+
+
+program = programs.Program(
+    name=name,
+    description=description,
+    main=main,
+    argparser=argument_parser
+)
@@ -7,6 +7,7 @@ from pathlib import Path
 from orbitx import common
 from orbitx import physics
 from orbitx import programs
+from orbitx.physics import ephemeris, integrators
 from orbitx.graphics import flight_gui
 
 log = logging.getLogger()
@@ -28,6 +29,8 @@ argument_parser.add_argument(
         'Should be a .json savefile written by OrbitX. '
         'Can also read OrbitV .RND savefiles.')
 )
+integrators.add_argument(argument_parser)
+ephemeris.add_argument(argument_parser)
 
 
 def main(args: argparse.Namespace):
@@ -38,7 +41,12 @@ def main(args: argparse.Namespace):
         # Take paths relative to 'data/saves/'
         loadfile = common.savefile(args.loadfile)
 
-    physics_engine = physics.PhysicsEngine(common.load_savefile(loadfile))
+    ephem = None
+    if args.ephemeris:
+        ephem = ephemeris.Ephemeris(common.ephemeris_file(args.ephemeris))
+
+    physics_engine = physics.PhysicsEngine(
+        common.load_savefile(loadfile), args.integrator, ephem)
     initial_state = physics_engine.get_state()
 
     gui = flight_gui.FlightGui(
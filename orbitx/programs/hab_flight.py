@@ -1,11 +1,9 @@
 import argparse
 import atexit
 import logging
-import time
 
 from orbitx import common
 from orbitx import network
-from orbitx import physics
 from orbitx import programs
 from orbitx.graphics import flight_gui
 from orbitx.network import Request
@@ -26,15 +24,25 @@ argument_parser.add_argument(
         'Network name of the computer where the physics server is running. If '
         'the physics server is running on the same machine, put "localhost".')
 )
+argument_parser.add_argument(
+    '--session', type=str, default=network.DEFAULT_SESSION,
+    help=(
+        'Name of the session to connect to, if the physics server hosts more '
+        'than one. By default, connects to the first session.')
+)
 
 
 def main(args: argparse.Namespace):
     log.info(f'Connecting to physics server {args.physics_server}.')
-    time_of_next_network_update = 0.0
     lead_server_connection = network.StateClient(
-        Request.HAB_FLIGHT, args.physics_server)
+        Request.HAB_FLIGHT, args.physics_server, args.session)
     state = lead_server_connection.get_state()
-    physics_engine = physics.PhysicsEngine(state)
+    # The physics server will send us a new state this often, and as soon as
+    # it has simulated any commands we send it. In between, we draw the
+    # trajectory it sends along with each state.
+    lead_server_connection.subscribe(
+        max_updates_per_second=1 / common.TIME_BETWEEN_NETWORK_UPDATES,
+        trajectory=True)
 
     gui = flight_gui.FlightGui(state, title=name, running_as_mirror=False)
     atexit.register(gui.shutdown)
@@ -43,30 +51,13 @@ def main(args: argparse.Namespace):
         gui.draw(state)
 
         user_commands = gui.pop_commands()
-        current_time = time.monotonic()
+        if user_commands:
+            lead_server_connection.send_commands(user_commands)
 
-        # If there are user commands or we've gone a while since our last
-        # contact with the physics server, request an update.
-        if user_commands or current_time > time_of_next_network_update:
-            # Our state is stale, get the latest update
-            # TODO: what if this fails? Do anything smarter than an exception?
-            state = lead_server_connection.get_state(user_commands)
-            physics_engine.set_state(state)
-            if len(user_commands) == 0:
-                time_of_next_network_update = (
-                        current_time + common.TIME_BETWEEN_NETWORK_UPDATES
-                )
-            else:
-                # If we sent a user command, still ask for an update soon so
-                # the user input can be reflected in hab flight's GUI as soon
-                # as possible.
-                # Magic number alert! The constant we add should be enough that
-                # the physics server has had enough time to simulate the effect
-                # of our input, but we should minimize the constant to minimize
-                # input lag.
-                time_of_next_network_update = current_time + 0.15
-        else:
-            state = physics_engine.get_state()
+        # TODO: what if this fails? Do anything smarter than an exception?
+        current_state = lead_server_connection.current_state()
+        if current_state is not None:
+            state = current_state
 
         gui.rate(common.FRAMERATE)
 
@@ -1,7 +1,7 @@
 import argparse
 import atexit
 import logging
-import time
+from typing import Optional
 
 from orbitx import common
 from orbitx import network
@@ -27,17 +27,26 @@ argument_parser.add_argument(
         'Network name of the computer where the physics server is running. If '
         'the physics server is running on the same machine, put "localhost".')
 )
+argument_parser.add_argument(
+    '--session', type=str, default=network.DEFAULT_SESSION,
+    help=(
+        'Name of the session to connect to, if the physics server hosts more '
+        'than one. By default, connects to the first session.')
+)
 
 
 def main(args: argparse.Namespace):
-    time_of_last_network_update = 0.0
     networking = True  # Whether data is requested over the network
 
     log.info(f'Connecting to physics server {args.physics_server}.')
     lead_server_connection = network.StateClient(
-        Request.MC_FLIGHT, args.physics_server)
+        Request.MC_FLIGHT, args.physics_server, args.session)
     state = lead_server_connection.get_state()
-    physics_engine = physics.PhysicsEngine(state)
+    # Only used to simulate locally when we're not networking.
+    physics_engine: Optional[physics.PhysicsEngine] = None
+    lead_server_connection.subscribe(
+        max_updates_per_second=1 / common.TIME_BETWEEN_NETWORK_UPDATES,
+        trajectory=True)
 
     gui = flight_gui.FlightGui(state, title=name, running_as_mirror=True)
     atexit.register(gui.shutdown)
@@ -51,19 +60,22 @@ def main(args: argparse.Namespace):
                 ' networking with the physics server at ' +
                 args.physics_server)
 
-        if (networking and
-                time.monotonic() - time_of_last_network_update >
-                common.TIME_BETWEEN_NETWORK_UPDATES):
-            # Our state is stale, get the latest update
-            # TODO: what if this fails? Set networking to False?
-            state = lead_server_connection.get_state()
-            physics_engine.set_state(state)
-            time_of_last_network_update = time.monotonic()
+        # TODO: what if this fails? Set networking to False?
+        if networking:
+            # Follow along the trajectory the server sent us.
+            current_state = lead_server_connection.current_state()
+            if current_state is not None:
+                state = current_state
         else:
+            if physics_engine is None:
+                physics_engine = physics.PhysicsEngine(state)
+            elif old_networking:
+                # Carry on simulating from the last state we got.
+                physics_engine.set_state(state)
             state = physics_engine.get_state()
 
         gui.draw(state)
-        if not networking:
+        if not networking and physics_engine is not None:
             # When we're not networking, allow user input.
             physics_engine.handle_requests(gui.pop_commands())
         gui.rate(common.FRAMERATE)
@@ -28,22 +28,33 @@ argument_parser.add_argument(
     "--physics-server", default="localhost",
     help="network name of the physics server"
 )
+argument_parser.add_argument(
+    "--session", default=network.DEFAULT_SESSION,
+    help="name of the session on the physics server, if it has many"
+)
 
 
 def main(args: argparse.Namespace):
     orbitx_connection = network.StateClient(
-        network.Request.MIST, args.physics_server)
+        network.Request.MIST, args.physics_server, args.session)
     log.info(f'Connecting to OrbitX Physics Server: {args.physics_server}')
 
     random.seed()
 
     try:
+        # All we look at is where Earth is.
+        orbitx_connection.subscribe(
+            max_updates_per_second=1,
+            interests=[network.Interest(entities=['Earth'],
+                                        fields=['x', 'y'])])
         while True:
+            time.sleep(1)
+            state = orbitx_connection.pop_state()
+            if state is None:
+                continue
             print(random.choice(['ASTRONAUT STATUS: DYING',
                                  'astronaut status: okay']))
-            print(orbitx_connection.get_state(
-                [network.Request(ident=network.Request.NOOP)])['Earth'].pos)
-            time.sleep(1)
+            print(state['Earth'].pos)
     except grpc.RpcError as err:
         log.error(
             f'Got response code {err.code()} from orbitx, shutting down')
@@ -1,21 +1,26 @@
 import argparse
-import concurrent.futures
 import atexit
 import logging
 import os
+import math
+import time
 from pathlib import Path
-
-import grpc
+from typing import Optional
 
 from orbitx import common
 from orbitx import network
 from orbitx import physics
 from orbitx import programs
+from orbitx import sessions
+from orbitx.physics import ephemeris, integrators, lockstep
 from orbitx.graphics.server_gui import ServerGui
-import orbitx.orbitx_pb2_grpc as grpc_stubs
 
 log = logging.getLogger()
 
+# How often connected clients are forgotten, so that clients that have
+# disconnected disappear from the GUI.
+CLIENT_LIST_REFRESH_INTERVAL = 15
+
 name = "Physics Server"
 
 description = (
@@ -37,33 +42,94 @@ argument_parser.add_argument(
         'Should be a .json savefile written by OrbitX. '
         'Can also read OrbitV .RND savefiles.')
 )
+integrators.add_argument(argument_parser)
+ephemeris.add_argument(argument_parser)
+argument_parser.add_argument(
+    '--publish-rate', type=float, default=30,
+    help=(
+        'How many times a second to send the latest state to clients. States '
+        'with newly-sent commands simulated are sent immediately.')
+)
+argument_parser.add_argument(
+    '--lockstep', action='store_true', default=False,
+    help=(
+        'Simulate in fixed steps, and send clients only the commands of each '
+        'step. Clients that subscribe in lockstep simulate every step '
+        'themselves, getting exactly the same state. Other clients are sent '
+        'states as usual.')
+)
+argument_parser.add_argument(
+    '--session', type=str, action='append', default=[],
+    metavar='NAME=LOADFILE',
+    help=(
+        'Host a session called NAME, simulating LOADFILE. Give this more than '
+        'once to host many sessions, each simulated in its own process. '
+        'Clients pick a session with their own --session argument. Sessions '
+        'without clients are paused and saved to '
+        f'{common.session_file(".")}. There is no server GUI with sessions.')
+)
+argument_parser.add_argument(
+    '--idle-timeout', type=float, default=sessions.IDLE_TIMEOUT,
+    help=(
+        'How many seconds a session can go without clients before it is '
+        'paused. Only used with --session.')
+)
+
+
+def _loadfile_path(loadfile: str) -> Path:
+    if os.path.isabs(loadfile):
+        return Path(loadfile)
+    else:
+        # Take paths relative to 'data/saves/'
+        return common.savefile(loadfile)
 
 
 def main(args: argparse.Namespace):
     # Before you make changes to this function, keep in mind that this function
     # starts a GRPC server that runs in a separate thread!
-    state_server = network.StateServer()
+    ephemeris_path = None
+    ephem = None
+    if args.ephemeris:
+        ephemeris_path = common.ephemeris_file(args.ephemeris)
+        ephem = ephemeris.Ephemeris(ephemeris_path)
 
-    loadfile: Path
-    if os.path.isabs(args.loadfile):
-        loadfile = Path(args.loadfile)
-    else:
-        # Take paths relative to 'data/saves/'
-        loadfile = common.savefile(args.loadfile)
+    if args.session:
+        if args.lockstep:
+            argument_parser.error(
+                '--lockstep and --session can not be used together.')
+        loadfiles = {}
+        for session in args.session:
+            session_name, _, loadfile = session.partition('=')
+            if session_name in loadfiles or not loadfile:
+                argument_parser.error(f'Bad --session {session}')
+            loadfiles[session_name] = _loadfile_path(loadfile)
+        sessions.serve(
+            loadfiles, args.integrator, ephemeris_path, args.publish_rate,
+            args.idle_timeout)
+        return
 
-    physics_engine = physics.PhysicsEngine(common.load_savefile(loadfile))
-    initial_state = physics_engine.get_state()
+    state_server = network.AsyncStateServer()
+    loadfile = _loadfile_path(args.loadfile)
 
-    TICKS_BETWEEN_CLIENT_LIST_REFRESHES = 150
-    ticks_until_next_client_list_refresh = 0
+    if args.lockstep:
+        simulation = lockstep.Lockstep(
+            common.load_savefile(loadfile), integrator=args.integrator,
+            ephem=ephem)
+        initial_state = simulation.state
+    else:
+        physics_engine = physics.PhysicsEngine(
+            common.load_savefile(loadfile), args.integrator, ephem)
+        initial_state = physics_engine.get_state()
 
-    server = grpc.server(
-        concurrent.futures.ThreadPoolExecutor(max_workers=4))
-    atexit.register(lambda: server.stop(grace=2))
-    grpc_stubs.add_StateServerServicer_to_server(state_server, server)
-    server.add_insecure_port(f'[::]:{network.DEFAULT_PORT}')
+    atexit.register(lambda: state_server.stop(grace=2))
     state_server.notify_state_change(initial_state.as_proto())
-    server.start()  # This doesn't block!
+    state_server.start()  # This doesn't block!
+
+    # Clients on this computer can read states from here instead.
+    shared_state_publisher = network.SharedStatePublisher(
+        initial_state, network.shared_state_name())
+    atexit.register(shared_state_publisher.close)
+    shared_state_publisher.publish(initial_state)
 
     gui = ServerGui()
 
@@ -73,24 +139,131 @@ def main(args: argparse.Namespace):
         if args.profile:
             common.start_profiling()
 
-        while True:
-            # If we have any commands, process them immediately so input lag
-            # is minimized.
-            commands = state_server.pop_commands() + gui.pop_commands()
+        if args.lockstep:
+            _run_lockstep(
+                simulation, state_server, shared_state_publisher, gui)
+        else:
+            serve(physics_engine, state_server, shared_state_publisher,
+                  args.publish_rate, gui)
+    finally:
+        state_server.stop(grace=1)
+
+
+def serve(physics_engine: physics.PhysicsEngine,
+          state_server: network.StateServer,
+          shared_state_publisher: network.SharedStatePublisher,
+          publish_rate: float, gui: Optional[ServerGui]):
+    """Gives physics_engine the commands clients send, and sends clients
+    its states, forever. Also used by the worker process of each session,
+    see sessions.py, which has no GUI."""
+    # Each of these happens on its own schedule. In between, we sleep
+    # until one of them is due, or until a client sends a command.
+    next_publish_time = time.monotonic()
+    next_gui_time = next_publish_time if gui is not None else math.inf
+    next_client_list_refresh_time = \
+        next_publish_time + CLIENT_LIST_REFRESH_INTERVAL
+    # The longest time, since the last client list refresh, between the
+    # server receiving a command and publishing a state with it simulated.
+    max_command_latency = 0.0
+    state = physics_engine.get_state()
+
+    while True:
+        state_server.wait_for_commands(timeout=max(0, min(
+            next_publish_time, next_gui_time,
+            next_client_list_refresh_time) - time.monotonic()))
+        now = time.monotonic()
+
+        # If we have any commands, process them immediately so input lag
+        # is minimized.
+        timed_commands = state_server.pop_timed_commands()
+        commands = [command for _, command in timed_commands]
+        if gui is not None and now >= next_gui_time:
+            commands += gui.pop_commands()
+        if commands:
             physics_engine.handle_requests(commands)
 
+        if commands or now >= next_publish_time:
+            next_publish_time = max(
+                next_publish_time + 1 / publish_rate, now)
             state = physics_engine.get_state()
-            state_server.notify_state_change(state.as_proto())
+            shared_state_publisher.publish(state)
+            state_server.notify_state_change(
+                state.as_proto(),
+                physics_engine.get_segments(state.timestamp))
+            if timed_commands:
+                max_command_latency = max(
+                    max_command_latency,
+                    time.monotonic() - timed_commands[0][0])
 
-            if ticks_until_next_client_list_refresh == 0:
-                ticks_until_next_client_list_refresh = \
-                    TICKS_BETWEEN_CLIENT_LIST_REFRESHES
-                state_server.refresh_client_list()
-            ticks_until_next_client_list_refresh -= 1
+        if now >= next_client_list_refresh_time:
+            next_client_list_refresh_time = \
+                now + CLIENT_LIST_REFRESH_INTERVAL
+            state_server.refresh_client_list()
+            log.debug(
+                'Longest time to publish a command: '
+                f'{max_command_latency * 1000:.1f} ms')
+            max_command_latency = 0.0
 
-            gui.update(state, state_server.addr_to_connected_clients.values())
-    finally:
-        server.stop(grace=1)
+        if gui is not None and now >= next_gui_time:
+            next_gui_time = max(
+                next_gui_time + 1 / ServerGui.UPDATES_PER_SECOND, now)
+            gui.update(
+                state, state_server.addr_to_connected_clients.values())
+
+
+def _run_lockstep(simulation: lockstep.Lockstep,
+                  state_server: network.StateServer,
+                  shared_state_publisher: network.SharedStatePublisher,
+                  gui: Optional[ServerGui]):
+    """Simulates a step every lockstep.STEP_DURATION seconds, with whatever
+    commands arrived since the last step, and sends each step to clients.
+    A step is taken early if a client sends a command, like serve does."""
+    state = simulation.state
+    state_server.notify_lockstep_step(
+        simulation.step_message([], snapshot=True), state.as_proto())
+
+    next_step_time = time.monotonic() + lockstep.STEP_DURATION
+    next_client_list_refresh_time = \
+        next_step_time + CLIENT_LIST_REFRESH_INTERVAL
+
+    while True:
+        # Taking a step early uses up the turn of the next step, so the
+        # simulation is never more than one step ahead of real time.
+        time.sleep(max(
+            0, next_step_time - lockstep.STEP_DURATION - time.monotonic()))
+        state_server.wait_for_commands(
+            timeout=max(0, next_step_time - time.monotonic()))
+        # If a step takes too long, the simulation runs slower than real
+        # time. Clients are slowed down the same way, so they stay in sync.
+        next_step_time = max(
+            next_step_time + lockstep.STEP_DURATION, time.monotonic())
+
+        commands = state_server.pop_commands()
+        if gui is not None:
+            commands += gui.pop_commands()
+        commands = [command for command in commands
+                    if command.ident != network.Request.NOOP]
+        state = simulation.advance(commands)
+        loaded_savefile = any(
+            command.ident == network.Request.LOAD_SAVEFILE
+            for command in commands)
+
+        state_proto = state.as_proto()
+        state_server.notify_lockstep_step(
+            simulation.step_message(commands, snapshot=loaded_savefile),
+            state_proto)
+        shared_state_publisher.publish(state)
+        state_server.notify_state_change(state_proto)
+
+        if time.monotonic() >= next_client_list_refresh_time:
+            next_client_list_refresh_time = \
+                time.monotonic() + CLIENT_LIST_REFRESH_INTERVAL
+            state_server.refresh_client_list()
+
+        # The GUI updates at the same rate as steps happen.
+        if gui is not None:
+            gui.update(
+                state, state_server.addr_to_connected_clients.values())
 
 
 program = programs.Program(
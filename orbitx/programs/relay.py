@@ -0,0 +1,136 @@
+import argparse
+import atexit
+import logging
+import threading
+import time
+from typing import Iterator
+
+import grpc
+
+from orbitx import network
+from orbitx import programs
+from orbitx.network import Request
+from orbitx.programs import physics_server
+
+log = logging.getLogger()
+
+name = "Relay"
+
+description = (
+    "Connect to a running Physics Server, and serve its state to any number "
+    "of clients, as if this were the Physics Server."
+    "<br />Commands from clients are sent on to the Physics Server. Run "
+    "relays on other computers to take audience traffic off the computer "
+    "running the Physics Server."
+)
+
+argument_parser = argparse.ArgumentParser(
+    'relay', description=description.replace('<br />', '\n'))
+argument_parser.add_argument(
+    'physics_server', type=str, nargs='?', default='localhost',
+    help=(
+        'Network name of the computer where the physics server, or another '
+        'relay, is running.')
+)
+argument_parser.add_argument(
+    '--session', type=str, default=network.DEFAULT_SESSION,
+    help=(
+        'Name of the session to relay, if the physics server hosts more '
+        'than one. By default, relays the first session.')
+)
+argument_parser.add_argument(
+    '--upstream-port', type=int, default=network.DEFAULT_PORT,
+    help='Port the physics server is listening on.'
+)
+argument_parser.add_argument(
+    '--port', type=int, default=network.DEFAULT_PORT,
+    help=(
+        'Port to serve clients on. Change this to run a relay on the same '
+        'computer as the physics server.')
+)
+argument_parser.add_argument(
+    '--publish-rate', type=float, default=30,
+    help=(
+        'How many times a second to get the latest state from the physics '
+        'server. States with newly-sent commands simulated are sent '
+        'immediately.')
+)
+
+
+def relay_states(packed_states: Iterator[network.protos.PackedState],
+                 downstream: network.StateServer,
+                 shared_state_publisher: network.SharedStatePublisher):
+    """Gives every state from an upstream subscription to downstream
+    clients, along with its trajectory, until the subscription ends or is
+    cancelled."""
+    decoder = network.PackedStateDecoder()
+    next_client_list_refresh_time = \
+        time.monotonic() + physics_server.CLIENT_LIST_REFRESH_INTERVAL
+
+    try:
+        for packed_state in packed_states:
+            decoder.update(packed_state)
+            state = decoder.state()
+            shared_state_publisher.publish(state)
+            # The trajectory is already fitted, so downstream clients get
+            # exactly the same trajectory as upstream clients.
+            downstream.notify_state_change(
+                state.as_proto(), list(packed_state.trajectory))
+
+            if time.monotonic() >= next_client_list_refresh_time:
+                next_client_list_refresh_time = time.monotonic() + \
+                    physics_server.CLIENT_LIST_REFRESH_INTERVAL
+                log.info(
+                    f'Relaying to {len(downstream.addr_to_connected_clients)} '
+                    'clients.')
+                downstream.refresh_client_list()
+    except grpc.RpcError as err:
+        # Cancelling the subscription is how to stop relaying.
+        if err.code() != grpc.StatusCode.CANCELLED:
+            raise
+
+
+def forward_commands(downstream: network.StateServer,
+                     upstream: network.StateClient):
+    """Sends every command from downstream clients upstream, forever."""
+    while True:
+        if downstream.wait_for_commands(timeout=None):
+            upstream.send_commands(downstream.pop_commands())
+
+
+def main(args: argparse.Namespace):
+    log.info(f'Connecting to physics server {args.physics_server}.')
+    upstream = network.StateClient(
+        Request.RELAY, args.physics_server, args.session, args.upstream_port)
+    state = upstream.get_state()
+
+    downstream = network.AsyncStateServer()
+    atexit.register(lambda: downstream.stop(grace=2))
+    downstream.notify_state_change(state.as_proto())
+    downstream.start(args.port)  # This doesn't block!
+
+    # Clients on this computer can read states from here instead.
+    shared_state_publisher = network.SharedStatePublisher(
+        state, network.shared_state_name(port=args.port))
+    atexit.register(shared_state_publisher.close)
+
+    threading.Thread(
+        target=forward_commands, args=(downstream, upstream),
+        name='command forwarder', daemon=True).start()
+
+    try:
+        relay_states(
+            upstream.subscribe_packed(
+                max_updates_per_second=args.publish_rate, trajectory=True),
+            downstream, shared_state_publisher)
+    finally:
+        upstream.close()
+        downstream.stop(grace=1)
+
+
+program = programs.Program(
+    name=name,
+    description=description,
+    main=main,
+    argparser=argument_parser
+)
@@ -0,0 +1,328 @@
+"""Hosting many simulations, called sessions, in one physics server.
+
+Each session has its own PhysicsEngine, in its own worker process, so
+sessions don't fight each other for the GIL. The main process only serves
+clients, with a network.SessionServer, and relays commands and states
+between each session's AsyncStateServer and its worker process.
+
+A worker process only runs while its session has clients. Once a session
+has had no clients for a while, its worker process saves the state to
+data/sessions/ and exits. When a client comes back, a new worker process
+loads that savefile and carries on from there. So a physics server can
+host many more sessions than it has cores, as long as most are idle.
+
+Example usage:
+sessions.serve({'alpha': common.savefile('OCESS.json'),
+                'beta': common.savefile('OCESS.json')},
+               integrators.RK45, None, publish_rate=30,
+               idle_timeout=sessions.IDLE_TIMEOUT)
+"""
+
+import logging
+import multiprocessing
+import threading
+import time
+from multiprocessing.connection import Connection
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from orbitx import common
+from orbitx import logs
+from orbitx import network
+from orbitx import orbitx_pb2 as protos
+from orbitx.physics import ephemeris
+
+log = logging.getLogger()
+
+# How many seconds a session can go without clients before it's paused.
+IDLE_TIMEOUT = 5 * 60
+
+# How often the main process checks if any session should be paused or
+# resumed.
+SESSION_CHECK_INTERVAL = 1
+
+# Worker processes are started fresh, instead of forked from a main process
+# that has GRPC threads running.
+_spawn_context = multiprocessing.get_context('spawn')
+
+
+class _SessionPaused(Exception):
+    """Raised in a worker process when the main process pauses it."""
+
+
+class _PipeStateServer:
+    """Quacks like the parts of a StateServer that physics_server.serve
+    uses, for a worker process. Commands come from, and states go to, the
+    session's AsyncStateServer in the main process, through a pipe."""
+
+    def __init__(self, connection: Connection):
+        self._connection = connection
+        self._commands: List[Tuple[float, protos.Command]] = []
+        # The main process's popped_command_seq() of the last commands
+        # received, and of the last commands popped. States are sent back
+        # with the latter, so that the main process knows which commands
+        # they have simulated.
+        self._received_command_seq = 0
+        self._popped_command_seq = 0
+        # Each segment of trajectory is only fitted once, see
+        # StateServer._latest_snapshot.
+        self._fitted_trajectory: List[
+            Tuple[network._DenseOutput, bytes]] = []
+        # Clients are listed by the main process.
+        self.addr_to_connected_clients: Dict = {}
+
+    def _receive(self):
+        message = self._connection.recv()
+        if message is None:
+            raise _SessionPaused()
+        commands, self._received_command_seq = message
+        self._commands.extend(
+            (received_time, protos.Command.FromString(command))
+            for received_time, command in commands)
+
+    def wait_for_commands(self, timeout: Optional[float]) -> bool:
+        if len(self._commands) == 0 and self._connection.poll(timeout):
+            self._receive()
+        return len(self._commands) != 0
+
+    def pop_timed_commands(self) -> List[Tuple[float, protos.Command]]:
+        while self._connection.poll():
+            self._receive()
+        commands, self._commands = self._commands, []
+        self._popped_command_seq = self._received_command_seq
+        return commands
+
+    def popped_command_seq(self) -> int:
+        return self._popped_command_seq
+
+    def notify_state_change(
+            self, physical_state_copy: protos.PhysicalState,
+            trajectory: Sequence[network._DenseOutput] = ()):
+        already_fitted = {
+            id(segment.solution): fitted
+            for segment, fitted in self._fitted_trajectory}
+        self._fitted_trajectory = [
+            (segment, already_fitted[id(segment.solution)]
+             if id(segment.solution) in already_fitted
+             else network._fit_segment(segment).SerializeToString())
+            for segment in trajectory
+        ]
+        self._connection.send((
+            physical_state_copy.SerializeToString(),
+            [fitted for _, fitted in self._fitted_trajectory],
+            self._popped_command_seq))
+
+    def refresh_client_list(self):
+        pass
+
+
+def _run_worker(name: str, savefile: Path, integrator: str,
+                ephemeris_path: Optional[Path], publish_rate: float,
+                connection: Connection):
+    """The main function of a session's worker process. Simulates savefile
+    until the main process pauses the session, then saves the state to
+    common.session_file."""
+    # physics_server imports this module.
+    from orbitx import physics
+    from orbitx.programs import physics_server
+
+    logs.make_program_logfile(f'session-{name}')
+    # Otherwise numba logs every step of compiling every function, which
+    # every new worker process does.
+    logging.getLogger('numba').setLevel(logging.INFO)
+    ephem = None
+    if ephemeris_path is not None:
+        ephem = ephemeris.Ephemeris(ephemeris_path)
+    physics_engine = physics.PhysicsEngine(
+        common.load_savefile(savefile), integrator, ephem)
+    state = physics_engine.get_state()
+    shared_state_publisher = network.SharedStatePublisher(
+        state, network.shared_state_name(name))
+
+    state_server = _PipeStateServer(connection)
+    try:
+        physics_server.serve(
+            physics_engine, state_server,  # type: ignore[arg-type]
+            shared_state_publisher, publish_rate, gui=None)
+    except _SessionPaused:
+        state = physics_engine.get_state()
+        spill_file = common.session_file(f'{name}.json')
+        spill_file.parent.mkdir(parents=True, exist_ok=True)
+        common.write_savefile(state, spill_file)
+        # Clients of the paused session get exactly the state it was
+        # paused at.
+        connection.send((
+            state.as_proto().SerializeToString(), [],
+            state_server.popped_command_seq()))
+    finally:
+        shared_state_publisher.close()
+        connection.close()
+
+
+class Session:
+    """One of the sessions of a physics server, in the main process.
+
+    A session starts paused, and only has a worker process once resume()
+    is called. Until then, clients get the state it was paused at."""
+
+    def __init__(self, name: str, loadfile: Path,
+                 state_server: network.AsyncStateServer, integrator: str,
+                 ephemeris_path: Optional[Path], publish_rate: float):
+        self.name = name
+        self.state_server = state_server
+        # Whatever the next worker process should start from.
+        self._savefile = loadfile
+        self._integrator = integrator
+        self._ephemeris_path = ephemeris_path
+        self._publish_rate = publish_rate
+
+        self._process: Optional[multiprocessing.process.BaseProcess] = None
+        self._connection: Optional[Connection] = None
+        self._pausing = False
+        self._forwarder: Optional[threading.Thread] = None
+        self._receiver: Optional[threading.Thread] = None
+
+        state_server.notify_state_change(
+            common.load_savefile(loadfile).as_proto())
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None
+
+    def crashed(self) -> bool:
+        """Returns True if the worker process exited without being paused.
+        The session can be resumed from where it was last paused."""
+        return (self._process is not None and not self._pausing and
+                not self._process.is_alive())
+
+    def resume(self):
+        """Starts a worker process from where the session was paused."""
+        assert self._process is None
+        log.info(f'Resuming session {self.name} from {self._savefile}.')
+        self._connection, worker_connection = _spawn_context.Pipe()
+        self._process = _spawn_context.Process(
+            target=_run_worker,
+            args=(self.name, self._savefile, self._integrator,
+                  self._ephemeris_path, self._publish_rate,
+                  worker_connection),
+            name=f'session {self.name}', daemon=True)
+        self._process.start()
+        # So that the receiver sees the end of the pipe when the worker
+        # process exits.
+        worker_connection.close()
+
+        self._pausing = False
+        self._forwarder = threading.Thread(
+            target=self._forward_commands, name=f'{self.name} commands',
+            daemon=True)
+        self._receiver = threading.Thread(
+            target=self._receive_states, name=f'{self.name} states',
+            daemon=True)
+        self._forwarder.start()
+        self._receiver.start()
+
+    def pause(self):
+        """Stops the worker process, which saves the state to disk first."""
+        assert self._process is not None and self._connection is not None
+        assert self._forwarder is not None and self._receiver is not None
+        log.info(f'Pausing session {self.name}.')
+        self._pausing = True
+        # Only one thread can send on the pipe at a time.
+        self._forwarder.join()
+        try:
+            self._connection.send(None)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self._process.join()
+        self._receiver.join()
+        self._connection.close()
+        if self._process.exitcode == 0:
+            self._savefile = common.session_file(f'{self.name}.json')
+        self._process = None
+
+    def _forward_commands(self):
+        assert self._connection is not None
+        while not self._pausing:
+            if not self.state_server.wait_for_commands(
+                    timeout=network.SUBSCRIPTION_CHECK_INTERVAL):
+                continue
+            commands = [
+                (received_time, command.SerializeToString())
+                for received_time, command
+                in self.state_server.pop_timed_commands()]
+            try:
+                # The worker process sends this back with the first state
+                # that has these commands simulated.
+                self._connection.send(
+                    (commands, self.state_server.popped_command_seq()))
+            except (BrokenPipeError, ConnectionResetError):
+                return
+
+    def _receive_states(self):
+        assert self._connection is not None
+        try:
+            while True:
+                state, trajectory, simulated_command_seq = \
+                    self._connection.recv()
+                self.state_server.notify_state_change(
+                    protos.PhysicalState.FromString(state),
+                    [protos.TrajectorySegment.FromString(segment)
+                     for segment in trajectory],
+                    simulated_command_seq)
+        except (EOFError, ConnectionResetError):
+            pass
+
+
+def _check_sessions(session_server: network.SessionServer,
+                    sessions: Sequence[Session], idle_timeout: float,
+                    last_rpc_times: Dict[str, float]):
+    """Pauses the sessions that have been idle for idle_timeout seconds,
+    and resumes the paused sessions that have had a client since the last
+    check. last_rpc_times is when the last RPC of each session had finished
+    at the last check, and is updated."""
+    for session in sessions:
+        if session.crashed():
+            log.error(f'Session {session.name} crashed.')
+            session.pause()
+
+        idle_time = session_server.idle_time(session.name)
+        # A unary RPC like get_state can start and finish between checks,
+        # so idle_time() is never 0 for it.
+        last_rpc_time = session_server.last_rpc_time(session.name)
+        had_client = (idle_time == 0 or
+                      last_rpc_time != last_rpc_times[session.name])
+        last_rpc_times[session.name] = last_rpc_time
+        if session.running and idle_time >= idle_timeout:
+            session.pause()
+        elif not session.running and (
+                had_client or
+                session.state_server.wait_for_commands(timeout=0)):
+            session.resume()
+
+
+def serve(loadfiles: Dict[str, Path], integrator: str,
+          ephemeris_path: Optional[Path], publish_rate: float,
+          idle_timeout: float, port: int = network.DEFAULT_PORT):
+    """Hosts a session for each (name, loadfile) in loadfiles, forever.
+    Sessions run while they have clients, and are paused after idle_timeout
+    seconds without any."""
+    session_server = network.SessionServer()
+    sessions = [
+        Session(name, loadfile, session_server.add_session(name),
+                integrator, ephemeris_path, publish_rate)
+        for name, loadfile in loadfiles.items()]
+    session_server.start(port)
+    log.info(f'Hosting sessions {", ".join(loadfiles)}.')
+    last_rpc_times = {session.name: session_server.last_rpc_time(session.name)
+                      for session in sessions}
+
+    try:
+        while True:
+            time.sleep(SESSION_CHECK_INTERVAL)
+            _check_sessions(
+                session_server, sessions, idle_timeout, last_rpc_times)
+    finally:
+        for session in sessions:
+            if session.running:
+                session.pause()
+        session_server.stop(grace=1)
@@ -1,18 +1,32 @@
 #!/usr/bin/env python3
+import concurrent.futures
 import logging
 import sys
+import tempfile
+import threading
+import time
 import unittest
+from multiprocessing import shared_memory
+from pathlib import Path
 
+import grpc
 import numpy as np
+import scipy.integrate
+import scipy.spatial
 
 import orbitx.orbitx_pb2 as protos
 
-from orbitx.physics import calc
+from orbitx.physics import barnes_hut, broad_phase, calc, ephemeris, \
+    integrators, kepler, lockstep
 from orbitx import common
 from orbitx import logs
 from orbitx import network
+from orbitx import orbitv_file_interface
 from orbitx import physics
-from orbitx.data_structures import _EntityView, Entity, PhysicsState
+from orbitx import sessions
+from orbitx.programs import ensemble, relay
+from orbitx.data_structures import _EntityView, Entity, Navmode, \
+    PhysicsState, _FIELD_ORDERING
 
 log = logging.getLogger()
 
@@ -20,9 +34,10 @@ log = logging.getLogger()
 class PhysicsEngine:
     """Ensures that the simthread is always shut down on test exit/failure."""
 
-    def __init__(self, savefile):
+    def __init__(self, savefile, integrator=integrators.RK45, ephem=None):
         self.physics_engine = physics.PhysicsEngine(
-            common.load_savefile(common.savefile(savefile)))
+            common.load_savefile(common.savefile(savefile)), integrator,
+            ephem)
 
     def __enter__(self):
         return self.physics_engine
@@ -91,8 +106,8 @@ class PhysicsEngineTestCase(unittest.TestCase):
             # Note that dy.X is actually the velocity at 0,
             # and dy.VX is acceleration.
             dy = PhysicsState(
-                physics_engine._derive(0, y0.y0(), y0._proto_state),
-                y0._proto_state)
+                physics_engine._derive(0, y0.y0(), y0),
+                y0)
             self.assertEqual(len(dy.X), 2)
             self.assertAlmostEqual(dy.X[0], y0.VX[0])
             self.assertAlmostEqual(dy.Y[0], y0.VY[0])
@@ -179,8 +194,8 @@ class PhysicsEngineTestCase(unittest.TestCase):
             # Test that every single entity has the correct accelerations.
             y0 = physics_state
             dy = PhysicsState(
-                physics_engine._derive(0, y0.y0(), y0._proto_state),
-                physics_state._proto_state)
+                physics_engine._derive(0, y0.y0(), y0),
+                physics_state)
             self.assertEqual(len(dy.X), 3)
 
             self.assertAlmostEqual(dy.X[0], y0.VX[0])
@@ -262,6 +277,577 @@ class PhysicsEngineTestCase(unittest.TestCase):
                 final['Earth'].r + final['Habitat'].r,
                 delta=1)
 
+    def test_landings(self):
+        """Test that every landed and docked entity is glued to its ground
+        at once, even the Habitat docked with a landed AYSE."""
+        angles = np.linspace(0, 2 * np.pi, 10, endpoint=False)
+        state = PhysicsState(None, protos.PhysicalState(entities=[
+            protos.Entity(name=common.HABITAT, r=10, x=5, y=5,
+                          landed_on=common.AYSE, artificial=True),
+            protos.Entity(name=common.AYSE, r=100, y=2000, heading=1,
+                          landed_on='Earth', artificial=True),
+            protos.Entity(name='Earth', r=1000, mass=1e20, vx=5, spin=0.1),
+        ] + [
+            protos.Entity(name=f'Probe {index}', r=1,
+                          x=np.cos(angle), y=np.sin(angle),
+                          landed_on='Earth', artificial=True)
+            for index, angle in enumerate(angles)
+        ]))
+        landings = physics.engine._Landings(state)
+        self.assertEqual(len(landings), 12)
+        landings.glue(state)
+
+        earth = state['Earth']
+        ayse = state[common.AYSE]
+        hab = state[common.HABITAT]
+        np.testing.assert_allclose(ayse.pos, [0, 1100])
+        np.testing.assert_allclose(
+            hab.pos, ayse.pos - calc.heading_vector(1) * 110)
+        for lander, ground in [(ayse, earth), (hab, ayse)] + [
+                (state[f'Probe {index}'], earth) for index in range(10)]:
+            self.assertAlmostEqual(
+                calc.fastnorm(lander.pos - ground.pos), lander.r + ground.r)
+            np.testing.assert_allclose(
+                lander.v, calc.rotational_speed(lander, ground))
+            self.assertEqual(lander.spin, ground.spin)
+
+        # Landers accelerate with their ground, plus centripetal acceleration.
+        acc_matrix = np.zeros((len(state), 2))
+        acc_matrix[2] = [1, 2]
+        landings.accelerate(state, acc_matrix)
+        np.testing.assert_allclose(
+            acc_matrix[1], [1, 2] - (ayse.pos - earth.pos) * 0.1 ** 2)
+        np.testing.assert_allclose(
+            acc_matrix[0], acc_matrix[1] - (hab.pos - ayse.pos) * 0.1 ** 2)
+
+    def test_event_evaluator(self):
+        """Test that events share one decode of each y-vector, and that
+        derivatives are only calculated once for each (t, y)."""
+        state = common.load_savefile(common.savefile('OCESS.json'))
+        derivatives = []
+
+        def derive(t, y_1d):
+            derivatives.append(t)
+            return np.zeros_like(y_1d)
+
+        evaluator = physics.engine._EventEvaluator(state, derive)
+        collision = physics.engine.CollisionEvent(
+            evaluator, np.array([entity.r for entity in state]))
+        liftoff = physics.engine.LiftoffEvent(evaluator)
+        y_1d = state.y0().copy()
+
+        collision(0, y_1d)
+        decoded = evaluator.state(0, y_1d)
+        liftoff(0, y_1d)
+        self.assertIs(evaluator.state(0, y_1d), decoded)
+        self.assertIsNot(evaluator.state(1, y_1d), decoded)
+
+        evaluator.derive(0, y_1d)
+        evaluator.derivative(0, y_1d)
+        self.assertEqual(derivatives, [0])
+        # Derivatives are remembered for one y-vector, not its contents,
+        # so that y-vectors don't have to be copied.
+        y_copy = y_1d.copy()
+        evaluator.derivative(0, y_copy)
+        self.assertEqual(derivatives, [0, 0])
+        evaluator.derivative(1, y_copy)
+        self.assertEqual(derivatives, [0, 0, 1])
+
+        # The fixed-step integrators change y in place after deriving it,
+        # so events must be given y-vectors that never change afterwards.
+        seen = []
+
+        def event(t, y_1d):
+            seen.append((y_1d, y_1d.copy()))
+            return 1
+
+        state[common.HABITAT].vx = 1000
+        integrators.solve_fixed_step(
+            lambda t, y_1d: np.ones_like(y_1d), [0, 2], state.y0(), [event],
+            max_step=1)
+        self.assertEqual(len(seen), 3)
+        for y_seen, contents in seen:
+            np.testing.assert_array_equal(y_seen, contents)
+
+    def test_compiled_derive(self):
+        """Test that the compiled derive agrees with the python derive."""
+        def check_state(physics_engine, state: PhysicsState):
+            physics_engine.set_state(state)
+            self.assertIsNotNone(physics_engine._derive_constants)
+            expected = physics_engine._derive(
+                state.timestamp, state.y0(), state)
+            actual = physics_engine._derive_compiled(
+                state.timestamp, state.y0())
+            np.testing.assert_allclose(actual, expected, rtol=1e-9)
+
+        with PhysicsEngine('AYSE.json') as physics_engine:
+            # The Habitat is docked to AYSE, which is thrusting.
+            state = physics_engine.get_state(physics_engine._last_simtime)
+            state[common.AYSE].throttle = 0.5
+            check_state(physics_engine, state)
+
+            # AYSE is landed, so the Habitat's ground is itself landed. The
+            # Habitat comes first in the y-vector, but it's glued second.
+            state[common.AYSE].landed_on = common.EARTH
+            check_state(physics_engine, state)
+            state[common.AYSE].landed_on = ''
+
+            # Autopilot is on, and the Habitat is floating around.
+            state[common.HABITAT].landed_on = ''
+            for navmode in list(Navmode)[1:]:
+                state.navmode = navmode
+                check_state(physics_engine, state)
+
+            # Barnes-Hut gravity is used for large numbers of entities.
+            physics_engine.TREE_GRAVITY_THRESHOLD = 0
+            check_state(physics_engine, state)
+            self.assertIsNotNone(physics_engine._opening_angle)
+
+        with PhysicsEngine('tests/atmosphere.json') as physics_engine:
+            # The Habitat is in the atmosphere, burning SRBs and engines.
+            state = physics_engine.get_state(0)
+            hab = state.craft_entity()
+            hab.vy += 10
+            hab.throttle = 1
+            state.srb_time = common.SRB_BURNTIME
+            state.parachute_deployed = True
+            check_state(physics_engine, state)
+
+        with PhysicsEngine('tests/gui-test.json') as physics_engine:
+            # Autopilot is on, but there's no Habitat for it to rotate.
+            state = physics_engine.get_state(0)
+            state.navmode = Navmode['CCW Prograde']
+            state.reference = common.EARTH
+            state.target = 'ISS'
+            check_state(physics_engine, state)
+            n = len(state)
+            np.testing.assert_array_equal(
+                physics_engine._derive_compiled(
+                    state.timestamp, state.y0())[4 * n:5 * n],
+                state.Spin)
+
+    def test_fixed_step_integrators(self):
+        """Test that fixed-step integrators conserve energy on long coasts."""
+        def orbital_energy(iss, earth):
+            return (calc.speed(iss, earth) ** 2 / 2 -
+                    common.G * earth.mass / calc.distance(iss, earth))
+
+        savestate = common.load_savefile(
+            common.savefile('tests/gui-test.json'))
+        initial_t = savestate.timestamp
+        for integrator, tolerance in [(integrators.LEAPFROG, 1e-4),
+                                      (integrators.YOSHIDA4, 1e-7)]:
+            with PhysicsEngine('tests/gui-test.json', integrator) \
+                    as physics_engine:
+                initial = physics_engine.get_state(initial_t)
+                physics_engine.handle_requests(
+                    [network.Request(ident=network.Request.TIME_ACC_SET,
+                                     time_acc_set=common.TIME_ACCS[-1].value)],
+                    requested_t=initial_t)
+                # This is about twenty orbits of the ISS.
+                final = physics_engine.get_state(initial_t + 100_000)
+
+                initial_energy = orbital_energy(initial[0], initial[1])
+                self.assertAlmostEqual(
+                    orbital_energy(final[0], final[1]), initial_energy,
+                    delta=tolerance * abs(initial_energy))
+                self.assertAlmostEqual(
+                    calc.semimajor_axis(final[0], final[1]),
+                    calc.semimajor_axis(initial[0], initial[1]),
+                    delta=1000)
+
+    def test_tree_gravity(self):
+        """Test that Barnes-Hut gravity agrees with exact gravity."""
+        state = common.load_savefile(common.savefile('OCESS.json'))
+        # Add an asteroid belt between Mars and Jupiter.
+        n_asteroids = 2000
+        rng = np.random.default_rng(seed=0)
+        radii = rng.uniform(3e11, 5e11, n_asteroids)
+        angles = rng.uniform(0, 2 * np.pi, n_asteroids)
+        X = np.concatenate((state.X, radii * np.cos(angles)))
+        Y = np.concatenate((state.Y, radii * np.sin(angles)))
+        M = np.concatenate((
+            [entity.mass for entity in state],
+            10 ** rng.uniform(12, 20, n_asteroids)))
+        Fuel = np.concatenate((state.Fuel, np.zeros(n_asteroids)))
+
+        exact = calc.grav_acc(X, Y, M, Fuel)
+        # An opening angle of 0 means nothing is approximated.
+        np.testing.assert_allclose(
+            barnes_hut.grav_acc(X, Y, M, Fuel, 0, np.arange(len(X))), exact,
+            rtol=1e-9)
+
+        approx = barnes_hut.grav_acc(
+            X, Y, M, Fuel, barnes_hut.OPENING_ANGLE, np.arange(len(X)))
+        errors = (np.linalg.norm(approx - exact, axis=1) /
+                  np.linalg.norm(exact, axis=1))
+        self.assertLess(np.median(errors), 0.01)
+        # Entities with close neighbours are still accurate.
+        for name in [common.HABITAT, common.EARTH, 'Moon']:
+            self.assertLess(errors[state._name_to_index(name)], 1e-6)
+
+    def test_collision_broad_phase(self):
+        """Test that the collision broad phase finds every close pair."""
+        rng = np.random.default_rng(seed=0)
+        n = 2000
+        posns = rng.uniform(-1e6, 1e6, (n, 2))
+        half_widths = 10 ** rng.uniform(2, 4, n)
+        order, first, second = broad_phase.overlapping_pairs(
+            rng.permutation(n), posns, half_widths)
+        np.testing.assert_array_equal(np.diff(
+            (posns[:, 0] - half_widths)[order]) >= 0, True)
+        gaps = np.abs(posns[:, np.newaxis] - posns[np.newaxis, :]) - \
+            half_widths[:, np.newaxis, np.newaxis] - \
+            half_widths[np.newaxis, :, np.newaxis]
+        expected = {
+            (i, j) for i, j in zip(*np.nonzero(np.all(gaps <= 0, axis=2)))
+            if i < j}
+        self.assertEqual(
+            {(min(i, j), max(i, j)) for i, j in zip(first, second)},
+            expected)
+        self.assertEqual(len(first), len(expected))
+
+        # Pairs are only found again once something has moved far enough.
+        radii = rng.uniform(0, 100, n)
+        velocities = rng.uniform(-10, 10, (n, 2))
+        nearby = broad_phase.SweepAndPrune(radii, lookahead=10)
+        pairs = nearby.pairs(posns, velocities)
+        self.assertIs(nearby.pairs(posns + 1, velocities)[0], pairs[0])
+        for _ in range(5):
+            posns += velocities * 20
+            first, second = nearby.pairs(posns, velocities)
+            altitudes = scipy.spatial.distance.cdist(posns, posns) - \
+                radii[:, np.newaxis] - radii[np.newaxis, :]
+            altitudes[first, second] = np.inf
+            altitudes[second, first] = np.inf
+            np.fill_diagonal(altitudes, np.inf)
+            self.assertGreaterEqual(altitudes.min(), broad_phase.CLEARANCE)
+
+        # Collisions still happen with the broad phase, see
+        # test_simple_collision.
+        with PhysicsEngine('tests/simple-collision.json') as physics_engine:
+            physics_engine.COLLISION_BROAD_PHASE_THRESHOLD = 0
+            physics_engine.set_state(physics_engine.get_state(0))
+            self.assertIsNotNone(physics_engine._broad_phase)
+            approach = physics_engine.get_state(41)
+            bounced = physics_engine.get_state(43)
+            self.assertTrue(approach[2].vx > 0)
+            self.assertTrue(bounced[2].vx < 0)
+
+        # With nothing nearby, there's no pair to return, but CollisionEvent
+        # still returns a pair like it does without the broad phase.
+        state = common.load_savefile(
+            common.savefile('tests/simple-collision.json'))
+        state[2].x = -5000
+        evaluator = physics.engine._EventEvaluator(state, None)
+        radii = np.array([entity.r for entity in state])
+        collision = physics.engine.CollisionEvent(
+            evaluator, radii, broad_phase.SweepAndPrune(radii, lookahead=0))
+        self.assertEqual(collision(0, state.y0()), broad_phase.CLEARANCE)
+        self.assertEqual(collision(0, state.y0(), return_pair=True), (0, 0))
+
+    def test_orbitv_separation(self):
+        """Test that entities loaded from OrbitV are moved apart, even when
+        moving one apart pushes it into another."""
+        state = common.load_savefile(
+            common.savefile('tests/simple-collision.json'))
+        # collision_b intersects collision_a, and once it's moved away from
+        # collision_a, it intersects the confounding entity.
+        state[2].x = -80.5
+        confounding = state[1]
+        confounding.pos = np.array([-122.5, 0])
+        confounding.r = 10
+        confounding.mass = 1
+        state[1] = confounding
+
+        state = orbitv_file_interface._separate_landed_entities(state)
+        posns = state.Positions
+        radii = np.array([entity.r for entity in state])
+        altitudes = scipy.spatial.distance.cdist(posns, posns) - \
+            radii[:, np.newaxis] - radii[np.newaxis, :]
+        np.fill_diagonal(altitudes, np.inf)
+        self.assertGreaterEqual(altitudes.min(), 1)
+        self.assertLess(state[1].x, -122.5)
+
+    def test_test_particles(self):
+        """Test that light artificial entities don't have any gravity."""
+        with PhysicsEngine('OCESS.json') as physics_engine:
+            state = physics_engine.get_state()
+            sources = physics_engine._gravity_sources
+        # The Habitat and AYSE are much too light to have any gravity.
+        self.assertNotIn(state._name_to_index(common.HABITAT), sources)
+        self.assertNotIn(state._name_to_index(common.AYSE), sources)
+        self.assertIn(state._name_to_index(common.EARTH), sources)
+
+        X, Y, Fuel = state.X, state.Y, state.Fuel
+        M = np.array([entity.mass for entity in state])
+        exact = calc.grav_acc(X, Y, M, Fuel)
+        np.testing.assert_allclose(
+            calc.grav_acc_from_sources(X, Y, M, Fuel, np.arange(len(X))),
+            exact, rtol=1e-9)
+        # Leaving out the test particles makes no noticeable difference.
+        np.testing.assert_allclose(
+            calc.grav_acc_from_sources(X, Y, M, Fuel, sources),
+            exact, rtol=1e-9)
+        np.testing.assert_allclose(
+            barnes_hut.grav_acc(X, Y, M, Fuel, 0, sources),
+            exact, rtol=1e-9)
+
+        # Fixed steps only have to resolve orbits around gravity sources.
+        state[common.HABITAT].landed_on = common.EARTH
+        hab_index = state._name_to_index(common.HABITAT)
+        earth_index = state._name_to_index(common.EARTH)
+        masses = M + Fuel
+        expected = min(
+            np.sqrt(np.hypot(X[i] - X[j], Y[i] - Y[j]) ** 3 /
+                    (common.G * (masses[i] + masses[j])))
+            for i in range(len(state)) for j in sources
+            if i != j and {i, j} != {hab_index, earth_index})
+        np.testing.assert_allclose(
+            integrators.stable_step_size(state, sources),
+            integrators.DYNAMICAL_TIME_FRACTION * expected, rtol=1e-9)
+        self.assertEqual(
+            integrators.stable_step_size(state, np.arange(len(state))),
+            integrators.stable_step_size(state))
+
+    def test_ephemeris(self):
+        """Test that using an ephemeris gives the same simulation."""
+        savestate = common.load_savefile(common.savefile('LEO.json'))
+        initial_t = savestate.timestamp
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = Path(tempdir) / 'LEO.npy'
+            ephemeris.build(savestate, duration=6 * 60 * 60, path=path)
+            ephem = ephemeris.Ephemeris(path)
+
+            # The ephemeris starts off where the savefile is.
+            np.testing.assert_allclose(
+                ephem(initial_t)[0],
+                [entity.x for entity in savestate if not entity.artificial],
+                atol=1)
+
+            states = []
+            for engine_ephem in [None, ephem]:
+                with PhysicsEngine('LEO.json', ephem=engine_ephem) \
+                        as physics_engine:
+                    physics_engine.handle_requests(
+                        [network.Request(
+                            ident=network.Request.TIME_ACC_SET,
+                            time_acc_set=common.TIME_ACCS[-3].value)],
+                        requested_t=initial_t)
+                    states.append(physics_engine.get_state(initial_t + 5000))
+                    if engine_ephem is not None:
+                        self.assertIsInstance(
+                            physics_engine._solutions[-1],
+                            ephemeris.ExpandedSolution)
+
+        simulated, looked_up = states
+        for name in [common.HABITAT, common.AYSE, common.EARTH, 'Phobos']:
+            self.assertAlmostEqual(
+                calc.distance(simulated[name], looked_up[name]), 0,
+                delta=10)
+
+        # Events see the same full y-vector that was just derived, so that
+        # the engine's _EventEvaluator can share work between them.
+        artificials = np.array([
+            index for index, entity in enumerate(savestate)
+            if entity.artificial])
+        system = ephemeris.ReducedSystem(savestate, artificials)
+        seen = []
+
+        def derive(t, y_1d):
+            seen.append(y_1d)
+            return np.zeros_like(y_1d)
+
+        def event(t, y_1d):
+            seen.append(y_1d)
+            return 1
+
+        reduced_derive = system.derive(derive)
+        reduced_event = system.event(event)
+        reduced_y_1d = system.reduce(savestate.y0())
+        reduced_derive(0, reduced_y_1d)
+        reduced_event(0, reduced_y_1d)
+        reduced_event(0, reduced_y_1d)
+        self.assertIs(seen[1], seen[0])
+        self.assertIs(seen[2], seen[0])
+        # Derivatives are always of the latest contents.
+        reduced_y_1d[0] += 1
+        reduced_derive(0, reduced_y_1d)
+        self.assertIsNot(seen[3], seen[0])
+        self.assertEqual(seen[3][artificials[0]], reduced_y_1d[0])
+        reduced_event(1, reduced_y_1d)
+        self.assertIsNot(seen[4], seen[3])
+
+    def test_kepler_coast(self):
+        """Test that coasts can be propagated analytically."""
+        # Check elliptic, circular, and hyperbolic orbits against numerical
+        # integration, forwards and backwards in time.
+        mu = common.G * 5.972e24
+
+        def two_body(t, y):
+            r = y[:2]
+            return np.concatenate((y[2:], -mu * r / calc.fastnorm(r) ** 3))
+
+        for r0, v0 in [((7e6, 1e6), (-2000, 9000)),
+                       ((7e6, 0), (0, np.sqrt(mu / 7e6))),
+                       ((7e6, 0), (0, 12000))]:
+            orbit = kepler.KeplerOrbit(np.array(r0), np.array(v0), mu)
+            for dt in [5000, -3000]:
+                expected = scipy.integrate.solve_ivp(
+                    two_body, [0, dt], np.concatenate((r0, v0)),
+                    method='DOP853', rtol=1e-12, atol=1e-6).y[:, -1]
+                r, v = orbit(dt)
+                np.testing.assert_allclose(r, expected[:2], atol=1e-2)
+                np.testing.assert_allclose(v, expected[2:], atol=1e-5)
+
+        # The Habitat and AYSE are both in orbit around the Earth.
+        savestate = common.load_savefile(common.savefile('LEO.json'))
+        initial_t = savestate.timestamp
+        states = []
+        for integrator in [integrators.RK45, integrators.KEPLER]:
+            with PhysicsEngine('LEO.json', integrator) as physics_engine:
+                physics_engine.handle_requests(
+                    [network.Request(ident=network.Request.TIME_ACC_SET,
+                                     time_acc_set=common.TIME_ACCS[-2].value)],
+                    requested_t=initial_t)
+                states.append(physics_engine.get_state(initial_t + 50000))
+                if integrator == integrators.KEPLER:
+                    self.assertIsInstance(physics_engine._solutions[-1],
+                                          kepler.CoastSolution)
+
+        numerical, analytic = states
+        for name in [common.HABITAT, common.AYSE]:
+            self.assertAlmostEqual(
+                calc.semimajor_axis(analytic[name], analytic[common.EARTH]),
+                calc.semimajor_axis(savestate[name], savestate[common.EARTH]),
+                delta=1)
+            self.assertAlmostEqual(
+                calc.distance(numerical[name], analytic[name]), 0,
+                delta=1000)
+
+        # Borrelly is just in front of the Habitat, and far too light to
+        # knock the Habitat off its Kepler orbit before they collide.
+        state = common.load_savefile(common.savefile('LEO.json'))
+        state.time_acc = common.TIME_ACCS[-2].value
+        hab = state[common.HABITAT]
+        comet = state['Borrelly']
+        direction = hab.v - state[common.EARTH].v
+        direction /= calc.fastnorm(direction)
+        comet.pos = hab.pos + direction * (comet.r + hab.r + 2000)
+        comet.v = hab.v - direction * 20
+        first_collisions = []
+        for integrator in [integrators.RK45, integrators.KEPLER]:
+            trajectory = physics.simulate(
+                state, state.timestamp + 100, integrator=integrator)
+            first_collisions.append(min(
+                t for t, event in trajectory.events
+                if isinstance(event, physics.engine.CollisionEvent)))
+        # The Habitat coasted right up to Borrelly.
+        self.assertTrue(any(
+            isinstance(segment.solution, kepler.CoastSolution)
+            for segment in trajectory._segments
+            if segment.t_max == first_collisions[1]))
+        self.assertAlmostEqual(first_collisions[1], first_collisions[0],
+                               delta=0.01)
+
+    def test_persistent_simthread(self):
+        """Test that requests don't restart the simthread."""
+        with PhysicsEngine('tests/habitat.json') as physics_engine:
+            simthread = physics_engine._simthread
+            initial = physics_engine.get_state(0)
+
+            # Requests are applied at their simtime, even if the simthread
+            # has already simulated past it.
+            physics_engine.get_state(5)
+            physics_engine.handle_requests([
+                network.Request(
+                    ident=network.Request.HAB_THROTTLE_SET,
+                    throttle_set=1)],
+                requested_t=6)
+            throttled = physics_engine.get_state(6)
+            moved = physics_engine.get_state(11)
+
+            # Sending no requests doesn't interrupt the simulation.
+            solutions = list(physics_engine._solutions)
+            physics_engine.handle_requests([], requested_t=11)
+            self.assertEqual(list(physics_engine._solutions), solutions)
+
+            self.assertIs(physics_engine._simthread, simthread)
+            self.assertTrue(simthread.is_alive())
+            self.assertEqual(initial[0].throttle, 0)
+            self.assertEqual(throttled[0].throttle, 1)
+            self.assertAlmostEqual(throttled[0].vx, initial[0].vx)
+            self.assertTrue(moved[0].vx > throttled[0].vx)
+            self.assertEqual(physics_engine._commands_applied,
+                             physics_engine._commands_sent)
+
+    def test_simulate(self):
+        """Test that simulate() agrees with the threaded engine."""
+        state = common.load_savefile(common.savefile('tests/habitat.json'))
+        throttle_set = [network.Request(
+            ident=network.Request.HAB_THROTTLE_SET, throttle_set=1)]
+
+        trajectory = physics.simulate(
+            state, 15, sample_times=[0, 10, 15],
+            requests_at_times=[(10, throttle_set)])
+        with PhysicsEngine('tests/habitat.json') as physics_engine:
+            physics_engine.get_state(5)
+            physics_engine.handle_requests(throttle_set, requested_t=10)
+            expected = physics_engine.get_state(15)
+
+        initial, throttled, moved = trajectory.states
+        np.testing.assert_array_equal(trajectory.t, [0, 10, 15])
+        self.assertEqual(moved.timestamp, 15)
+        self.assertEqual(initial[0].throttle, 0)
+        # Requests apply at exactly their simtime.
+        self.assertEqual(throttled[0].throttle, 1)
+        self.assertAlmostEqual(throttled[0].vx, initial[0].vx)
+        self.assertAlmostEqual(moved[0].fuel, expected[0].fuel)
+        self.assertAlmostEqual(moved[0].vx, expected[0].vx)
+        self.assertTrue(
+            throttled[0].vx < trajectory(12.5)[0].vx < moved[0].vx)
+        with self.assertRaises(ValueError):
+            trajectory(16)
+
+        # Events are recorded, like the collision at t=42 in
+        # test_simple_collision.
+        collision = physics.simulate(
+            common.load_savefile(
+                common.savefile('tests/simple-collision.json')), 50)
+        (t, event), = collision.events
+        self.assertIsInstance(event, physics.engine.CollisionEvent)
+        self.assertAlmostEqual(t, 42, delta=1)
+
+        # Paused states stay where they are.
+        state.time_acc = 0
+        trajectory = physics.simulate(state, 100, sample_times=[100])
+        self.assertEqual(trajectory.states[0].timestamp, 100)
+        self.assertEqual(trajectory.states[0][0].x, state[0].x)
+
+    def test_lockstep(self):
+        """Test that lockstep simulation is exactly repeatable."""
+        state = common.load_savefile(common.savefile('tests/habitat.json'))
+        throttle_set = [network.Request(
+            ident=network.Request.HAB_THROTTLE_SET, throttle_set=1)]
+        first = lockstep.Lockstep(state)
+        second = lockstep.Lockstep(state)
+        for step in range(20):
+            requests = throttle_set if step == 5 else []
+            first.advance(requests)
+            second.advance(requests)
+            if step == 10:
+                # Starting from a snapshot gives the same steps as well.
+                second = lockstep.Lockstep(
+                    PhysicsState(None, second.state.as_proto()), second.step)
+        self.assertEqual(first.step, 20)
+        self.assertEqual(first.state_hash(), second.state_hash())
+        np.testing.assert_array_equal(first.state.y0(), second.state.y0())
+        self.assertAlmostEqual(
+            first.state.timestamp,
+            state.timestamp + 20 * lockstep.STEP_DURATION * state.time_acc)
+        self.assertEqual(first.state[0].throttle, 1)
+        self.assertNotEqual(first.state_hash(), lockstep.state_hash(state))
+
     def test_drag(self):
         """Test that drag is small but noticeable during unpowered flight."""
         atmosphere_save = common.load_savefile(common.savefile(
@@ -276,6 +862,531 @@ class PhysicsEngineTestCase(unittest.TestCase):
         self.assertGreater(60, drag)
 
 
+class NetworkTestCase(unittest.TestCase):
+    """Test that clients and the physics server talk to each other."""
+
+    def setUp(self):
+        self.state_server = network.StateServer()
+        self.server = grpc.server(
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=network.MAX_SERVER_THREADS))
+        network.add_state_server_to_server(self.state_server, self.server)
+        self.server.add_insecure_port(f'[::]:{network.DEFAULT_PORT}')
+        self.state = common.load_savefile(
+            common.savefile('tests/habitat.json'))
+        self.state_server.notify_state_change(self.state.as_proto())
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop(grace=None)
+
+    def wait_for_state(self, client) -> PhysicsState:
+        for _ in range(100):
+            state = client.pop_state()
+            if state is not None:
+                return state
+            time.sleep(0.05)
+        self.fail('Never got a state from the server.')
+
+    def test_subscribe_state(self):
+        """Test that subscribed clients get new states and send commands."""
+        client = network.StateClient(network.Request.MIST, 'localhost')
+        try:
+            # Ask for updates rarely, so that the only updates we get are
+            # the first one, and the one after we send a command.
+            client.subscribe(max_updates_per_second=0.01)
+            self.assertEqual(self.wait_for_state(client).timestamp,
+                             self.state.timestamp)
+
+            client.send_commands([network.Request(
+                ident=network.Request.HAB_THROTTLE_SET, throttle_set=1)])
+            self.assertTrue(self.state_server.wait_for_commands(timeout=5))
+            commands = self.state_server.pop_timed_commands()
+            self.assertEqual(len(commands), 1)
+            received_time, command = commands[0]
+            self.assertLessEqual(received_time, time.monotonic())
+            self.assertEqual(command.client, network.Request.MIST)
+            self.assertFalse(self.state_server.wait_for_commands(timeout=0))
+
+            # These states are too soon to be sent, unless they have our
+            # command simulated. The first one doesn't yet.
+            self.state.timestamp = 1
+            self.state_server.notify_state_change(
+                self.state.as_proto(), simulated_command_seq=0)
+            self.state.timestamp = 2
+            self.state_server.notify_state_change(self.state.as_proto())
+            self.assertEqual(self.wait_for_state(client).timestamp, 2)
+            self.assertIsNone(client.pop_state())
+            self.assertEqual(
+                len(self.state_server.addr_to_connected_clients), 1)
+
+            # Unsubscribed clients get the same state, already serialized.
+            self.assertEqual(client.get_state([]).timestamp, 2)
+        finally:
+            client.close()
+
+    def test_shared_memory(self):
+        """Test that clients on this computer read states from memory."""
+        publisher = network.SharedStatePublisher(
+            self.state, network.shared_state_name())
+        client = network.StateClient(network.Request.MIST, 'localhost')
+        try:
+            publisher.publish(self.state)
+            client.subscribe(max_updates_per_second=0.01, shared_memory=True)
+            self.assertEqual(self.wait_for_state(client).timestamp,
+                             self.state.timestamp)
+
+            # These states never go through the subscription. Publish enough
+            # of them to go all the way around the ring buffer.
+            for timestamp in range(1, 2 * network.SHARED_STATE_SLOTS):
+                self.state.timestamp = timestamp
+                self.state.craft_entity().fuel -= 1
+                publisher.publish(self.state)
+                state = client.pop_state()
+                self.assertEqual(state.timestamp, timestamp)
+                np.testing.assert_array_equal(state.y0(), self.state.y0())
+            self.assertIsNone(client.pop_state())
+        finally:
+            client.close()
+            publisher.close()
+
+    def test_packed_state(self):
+        """Test that PackedStates decode to the states they were made from."""
+        encoder = network.PackedStateEncoder(deltas=True)
+        decoder = network.PackedStateDecoder()
+
+        def send(state: PhysicsState) -> protos.PackedState:
+            self.state_server.notify_state_change(state.as_proto())
+            with self.state_server._internal_state_lock:
+                snapshot = self.state_server._latest_snapshot()
+            packed = protos.PackedState.FromString(encoder.encode(snapshot))
+            decoder.update(packed)
+            decoded = decoder.state()
+            np.testing.assert_array_equal(decoded.y0(), state.y0())
+            self.assertEqual(decoded.as_proto(), state.as_proto())
+            return packed
+
+        state = common.load_savefile(common.savefile('OCESS.json'))
+        first = send(state)
+        self.assertTrue(first.HasField('entity_table'))
+
+        # Only what changed is sent, and the entity table isn't resent.
+        state.timestamp += 1
+        state['Earth'].x += 1
+        state.craft_entity().fuel -= 1
+        state.reference = 'Moon'
+        delta = send(state)
+        self.assertFalse(delta.HasField('entity_table'))
+        self.assertEqual(len(delta.y_indices), 2)
+        self.assertLess(delta.ByteSize(), state.as_proto().ByteSize() / 10)
+
+        # The craft isn't sent, but docking changes it on the client too.
+        self.assertEqual(decoder.state().craft, common.HABITAT)
+        state[common.HABITAT].landed_on = common.AYSE
+        send(state)
+        self.assertEqual(state.craft, common.AYSE)
+        self.assertEqual(decoder.state().craft, common.AYSE)
+
+        # Clients that are sent the same state share the same bytes.
+        with self.state_server._internal_state_lock:
+            snapshot = self.state_server._latest_snapshot()
+        self.assertIs(
+            network.PackedStateEncoder(deltas=True).encode(snapshot),
+            network.PackedStateEncoder(deltas=True).encode(snapshot))
+
+        # Changing the entity table sends the whole table again.
+        earth = state['Earth']
+        earth.mass *= 2
+        state['Earth'] = earth
+        changed_table = send(state)
+        self.assertTrue(changed_table.HasField('entity_table'))
+        self.assertEqual(changed_table.entity_table_version,
+                         first.entity_table_version + 1)
+
+
+    def test_interests(self):
+        """Test that clients are only sent the parts of states they want."""
+        state = common.load_savefile(common.savefile('OCESS.json'))
+        encoder = network.PackedStateEncoder(deltas=True, interests=[
+            network.Interest(entities=['Earth'], fields=['x', 'y']),
+            network.Interest(entities=['Habitat'])])
+        decoder = network.PackedStateDecoder()
+
+        def send(due) -> PhysicsState:
+            self.state_server.notify_state_change(state.as_proto())
+            with self.state_server._internal_state_lock:
+                snapshot = self.state_server._latest_snapshot()
+            decoder.update(protos.PackedState.FromString(
+                encoder.encode(snapshot, due)))
+            return decoder.state()
+
+        decoded = send(due=None)
+        np.testing.assert_array_equal(decoded['Earth'].pos,
+                                      state['Earth'].pos)
+        self.assertEqual(decoded['Earth'].vx, 0)
+        self.assertEqual(decoded['Habitat'].fuel, state['Habitat'].fuel)
+        self.assertEqual(decoded['Habitat'].landed_on,
+                         state['Habitat'].landed_on)
+        self.assertEqual(decoded['Moon'].x, 0)
+        self.assertEqual(decoded['Moon'].landed_on, '')
+        self.assertEqual(decoded.time_acc, state.time_acc)
+
+        # Interests that aren't due aren't updated.
+        state['Earth'].x += 1
+        state.craft_entity().fuel -= 1
+        decoded = send(due=[0])
+        self.assertEqual(decoded['Earth'].x, state['Earth'].x)
+        self.assertEqual(decoded['Habitat'].fuel, state['Habitat'].fuel + 1)
+        decoded = send(due=[1])
+        self.assertEqual(decoded['Habitat'].fuel, state['Habitat'].fuel)
+
+    def test_trajectory(self):
+        """Test that clients can evaluate the trajectory the server sends."""
+        decoder = network.PackedStateDecoder()
+        with PhysicsEngine('tests/three-body.json') as physics_engine:
+            state = physics_engine.get_state(1)
+            segments = physics_engine.get_segments(state.timestamp)
+            self.assertNotEqual(segments, [])
+            self.state_server.notify_state_change(state.as_proto(), segments)
+            with self.state_server._internal_state_lock:
+                snapshot = self.state_server._latest_snapshot()
+            encoder = network.PackedStateEncoder(deltas=True, trajectory=True)
+            decoder.update(protos.PackedState.FromString(
+                encoder.encode(snapshot)))
+
+            for t in np.linspace(state.timestamp, segments[-1].t_max, 5):
+                expected = physics_engine.get_state(t)
+                interpolated = decoder.state_at(t)
+                self.assertEqual(interpolated.timestamp, t)
+                np.testing.assert_allclose(
+                    interpolated.y0(), expected.y0(), rtol=1e-9, atol=1e-6)
+
+        # Past the end of the trajectory, entities stop where it ends.
+        self.assertEqual(
+            decoder.state_at(segments[-1].t_max + 100).timestamp,
+            segments[-1].t_max)
+
+    def test_lockstep(self):
+        """Test that lockstep clients simulate the same states as the
+        server, and get a new snapshot if they don't."""
+        simulation = lockstep.Lockstep(self.state)
+        self.state_server.notify_lockstep_step(
+            simulation.step_message([], snapshot=True),
+            simulation.state.as_proto())
+        client = network.StateClient(network.Request.MIST, 'localhost')
+        mirror = lockstep.LockstepMirror(client)
+
+        def wait_for_mirror():
+            for _ in range(100):
+                state = mirror.state()
+                if state is not None and \
+                        state.timestamp == simulation.state.timestamp:
+                    return state
+                time.sleep(0.05)
+            self.fail('Never got the latest step from the server.')
+
+        try:
+            wait_for_mirror()
+            throttle_set = [network.Request(
+                ident=network.Request.HAB_THROTTLE_SET, throttle_set=1)]
+            for step in range(lockstep.HASH_INTERVAL):
+                requests = throttle_set if step == 0 else []
+                state = simulation.advance(requests)
+                self.state_server.notify_lockstep_step(
+                    simulation.step_message(requests), state.as_proto())
+            np.testing.assert_array_equal(
+                wait_for_mirror().y0(), simulation.state.y0())
+            self.assertEqual(mirror.resyncs, 0)
+
+            # Pretend the mirror got out of sync.
+            simulation.advance([])
+            out_of_sync = simulation.step_message([])
+            out_of_sync.state_hash = 1234
+            out_of_sync.has_state_hash = True
+            self.state_server.notify_lockstep_step(
+                out_of_sync, simulation.state.as_proto())
+            np.testing.assert_array_equal(
+                wait_for_mirror().y0(), simulation.state.y0())
+            for _ in range(100):
+                if mirror.resyncs == 1:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(mirror.resyncs, 1)
+        finally:
+            mirror.close()
+            client.close()
+
+    def test_relay(self):
+        """Test that a relay serves states from the physics server, and sends
+        commands back to it."""
+        relay_port = network.DEFAULT_PORT + 1
+        downstream = network.AsyncStateServer()
+        downstream.notify_state_change(self.state.as_proto())
+        downstream.start(relay_port)
+        shared_state_publisher = network.SharedStatePublisher(
+            self.state, network.shared_state_name(port=relay_port))
+        upstream = network.StateClient(network.Request.RELAY, 'localhost')
+        packed_states = upstream.subscribe_packed(trajectory=True)
+        relay_thread = threading.Thread(
+            target=relay.relay_states,
+            args=(packed_states, downstream, shared_state_publisher))
+        relay_thread.start()
+        threading.Thread(
+            target=relay.forward_commands, args=(downstream, upstream),
+            daemon=True).start()
+        client = network.StateClient(
+            network.Request.MC_FLIGHT, 'localhost', port=relay_port)
+
+        try:
+            client.subscribe()
+            self.state.timestamp += 1
+            self.state_server.notify_state_change(self.state.as_proto())
+            for _ in range(100):
+                state = client.pop_state()
+                if state is not None and \
+                        state.timestamp == self.state.timestamp:
+                    break
+                time.sleep(0.05)
+            else:
+                self.fail('Never got the new state through the relay.')
+            np.testing.assert_array_equal(state.y0(), self.state.y0())
+
+            client.send_commands([network.Request(
+                ident=network.Request.HAB_THROTTLE_SET, throttle_set=1)])
+            self.assertTrue(self.state_server.wait_for_commands(timeout=5))
+            command, = self.state_server.pop_commands()
+            self.assertEqual(command.throttle_set, 1)
+            self.assertEqual(command.client, network.Request.RELAY)
+        finally:
+            packed_states.cancel()
+            relay_thread.join()
+            client.close()
+            upstream.close()
+            downstream.stop(grace=None)
+            shared_state_publisher.close()
+
+
+class AsyncNetworkTestCase(NetworkTestCase):
+    """Test that clients and an AsyncStateServer talk to each other."""
+
+    def setUp(self):
+        self.state_server = network.AsyncStateServer()
+        self.state = common.load_savefile(
+            common.savefile('tests/habitat.json'))
+        self.state_server.notify_state_change(self.state.as_proto())
+        self.state_server.start()
+
+    def tearDown(self):
+        self.state_server.stop(grace=None)
+
+    def test_many_subscribers(self):
+        """Test that one thread serves more clients than a threaded server
+        has threads."""
+        clients = [
+            network.StateClient(network.Request.MC_FLIGHT, 'localhost')
+            for _ in range(network.MAX_SERVER_THREADS)]
+        try:
+            for client in clients:
+                client.subscribe()
+            for client in clients:
+                self.wait_for_state(client)
+
+            self.state.timestamp += 1
+            self.state_server.notify_state_change(self.state.as_proto())
+            for client in clients:
+                self.assertEqual(self.wait_for_state(client).timestamp,
+                                 self.state.timestamp)
+        finally:
+            for client in clients:
+                client.close()
+
+
+class SessionTestCase(unittest.TestCase):
+    """Test that one physics server can host many sessions."""
+
+    def setUp(self):
+        self.session_server = network.SessionServer()
+        self.state = common.load_savefile(
+            common.savefile('tests/habitat.json'))
+
+    def tearDown(self):
+        self.session_server.stop(grace=None)
+
+    def test_routing(self):
+        """Test that clients talk to the session they pick."""
+        for session, timestamp in [('alpha', 1), ('beta', 2)]:
+            self.state.timestamp = timestamp
+            self.session_server.add_session(session).notify_state_change(
+                self.state.as_proto())
+        self.session_server.start()
+
+        alpha = network.StateClient(network.Request.MIST, 'localhost')
+        beta = network.StateClient(
+            network.Request.MIST, 'localhost', session='beta')
+        gamma = network.StateClient(
+            network.Request.MIST, 'localhost', session='gamma')
+        try:
+            # Clients that don't pick a session get the first one.
+            self.assertEqual(alpha.get_state().timestamp, 1)
+            self.assertEqual(beta.get_state().timestamp, 2)
+            with self.assertRaises(grpc.RpcError) as error:
+                gamma.get_state()
+            self.assertEqual(error.exception.code(), grpc.StatusCode.NOT_FOUND)
+
+            beta.subscribe()
+            for _ in range(100):
+                if beta.pop_state() is not None:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(self.session_server.idle_time('beta'), 0)
+            self.assertGreater(self.session_server.idle_time('alpha'), 0)
+        finally:
+            for client in [alpha, beta, gamma]:
+                client.close()
+
+    def test_pause(self):
+        """Test that a session keeps its state when it's paused."""
+        session = sessions.Session(
+            'test', common.savefile('tests/habitat.json'),
+            self.session_server.add_session('test'), integrators.RK45,
+            None, publish_rate=30)
+        self.session_server.start()
+        client = network.StateClient(
+            network.Request.MIST, 'localhost', session='test')
+        try:
+            session.resume()
+            client.subscribe()
+            client.send_commands([network.Request(
+                ident=network.Request.HAB_THROTTLE_SET, throttle_set=1)])
+            for _ in range(600):
+                state = client.pop_state()
+                if state is not None and state[0].throttle == 1:
+                    break
+                time.sleep(0.05)
+            else:
+                self.fail('The session never simulated our command.')
+
+            session.pause()
+            self.assertFalse(session.running)
+            paused = client.get_state()
+            self.assertEqual(paused[0].throttle, 1)
+            self.assertGreaterEqual(paused.timestamp, state.timestamp)
+
+            # Clients are sent the paused state until the session resumes.
+            time.sleep(0.5)
+            self.assertEqual(client.get_state().timestamp, paused.timestamp)
+            session.resume()
+            for _ in range(600):
+                state = client.pop_state()
+                if state is not None and state.timestamp > paused.timestamp:
+                    break
+                time.sleep(0.05)
+            else:
+                self.fail('The session never resumed.')
+            self.assertEqual(state[0].throttle, 1)
+            session.pause()
+        finally:
+            client.close()
+            common.session_file('test.json').unlink(missing_ok=True)
+
+    def test_commands_simulated(self):
+        """Test that clients of a session are sent the first state that has
+        their commands simulated, which the worker process reports."""
+        session = sessions.Session(
+            'test', common.savefile('tests/habitat.json'),
+            self.session_server.add_session('test'), integrators.RK45,
+            None, publish_rate=30)
+        self.session_server.start()
+        client = network.StateClient(
+            network.Request.MIST, 'localhost', session='test')
+        try:
+            session.resume()
+            # Ask for updates rarely, so that after the first one we only
+            # get the one with our command simulated.
+            client.subscribe(max_updates_per_second=0.01)
+            for _ in range(100):
+                if client.pop_state() is not None:
+                    break
+                time.sleep(0.05)
+            client.send_commands([network.Request(
+                ident=network.Request.HAB_THROTTLE_SET, throttle_set=1)])
+            for _ in range(600):
+                state = client.pop_state()
+                if state is not None:
+                    break
+                time.sleep(0.05)
+            else:
+                self.fail('Never got the state with our command simulated.')
+            self.assertEqual(state[0].throttle, 1)
+            session.pause()
+        finally:
+            client.close()
+            common.session_file('test.json').unlink(missing_ok=True)
+
+    def test_resume(self):
+        """Test that a get_state between checks resumes a paused session."""
+        session = sessions.Session(
+            'test', common.savefile('tests/habitat.json'),
+            self.session_server.add_session('test'), integrators.RK45,
+            None, publish_rate=30)
+        last_rpc_times = {'test': self.session_server.last_rpc_time('test')}
+        self.session_server.start()
+        client = network.StateClient(
+            network.Request.MIST, 'localhost', session='test')
+        try:
+            sessions._check_sessions(
+                self.session_server, [session], 60, last_rpc_times)
+            self.assertFalse(session.running)
+
+            # The RPC is over long before the next check.
+            client.get_state()
+            self.assertGreater(self.session_server.idle_time('test'), 0)
+            sessions._check_sessions(
+                self.session_server, [session], 60, last_rpc_times)
+            self.assertTrue(session.running)
+            session.pause()
+        finally:
+            client.close()
+            common.session_file('test.json').unlink(missing_ok=True)
+
+
+class EnsembleTestCase(unittest.TestCase):
+    """Test runs of the Ensemble program."""
+
+    def test_crash(self):
+        """Test that a run records what the craft crashed into."""
+        state = common.load_savefile(common.savefile('OCESS.json'))
+        hab = state[common.HABITAT]
+        earth = state[common.EARTH]
+        hab.landed_on = ''
+        up = (hab.pos - earth.pos) / calc.distance(hab, earth)
+        hab.pos = earth.pos + up * (earth.r + hab.r + 2000)
+        hab.v = earth.v - up * 200
+        y0 = state.y0()
+
+        memory = shared_memory.SharedMemory(create=True, size=y0.nbytes)
+        try:
+            initial_states = np.ndarray(
+                (1, len(y0)), dtype=PhysicsState.DTYPE, buffer=memory.buf)
+            initial_states[0] = y0
+            ensemble._init_worker(
+                memory.name, initial_states.shape,
+                state.as_proto().SerializeToString(), state.timestamp + 60,
+                integrators.RK45, None)
+            outcome = ensemble._run(0, 1)
+        finally:
+            del initial_states, ensemble._initial_states
+            ensemble._initial_states_memory.close()
+            memory.close()
+            memory.unlink()
+
+        self.assertEqual(outcome['collided_with'],
+                         state._name_to_index(common.EARTH))
+        # It's a 2 km fall at about 200 m/s, slowed down by the atmosphere.
+        self.assertGreater(outcome['collision_time'], state.timestamp + 8)
+        self.assertLess(outcome['collision_time'], state.timestamp + 15)
+
+
 class EntityTestCase(unittest.TestCase):
     """Tests that state.Entity properly proxies underlying proto."""
 
@@ -387,6 +1498,61 @@ class PhysicsStateTestCase(unittest.TestCase):
         self.assertEqual(ps['First'].x, 55)
         self.assertEqual(ps['First'].y, 66)
 
+    def test_view(self):
+        """Test that a state made from another state shares its EntityTable
+        and is a view of the y-vector, unless it's a copy."""
+        ps = PhysicsState(None, self.proto_state)
+        ps.reference = 'Second'
+        y = ps.y0().copy()
+
+        view = PhysicsState(y, ps)
+        self.assertIs(view._table, ps._table)
+        self.assertIs(view.y0(), y)
+        self.assertEqual(view.reference, 'Second')
+        self.assertEqual(view.timestamp, 5)
+        view['First'].x = 500
+        self.assertEqual(y[0], 500)
+        # Only the view has a new reference.
+        view.reference = 'First'
+        self.assertEqual(ps.reference, 'Second')
+
+        copy = PhysicsState(y, ps, copy=True)
+        self.assertIs(copy._table, ps._table)
+        copy['First'].x = 10
+        self.assertEqual(view['First'].x, 500)
+
+        # Changing an unchanging field doesn't change any other state.
+        view['Second'].mass = 5
+        self.assertEqual(view['Second'].mass, 5)
+        self.assertEqual(ps['Second'].mass, 101)
+        self.assertEqual(view['Second'].name, 'Second')
+
+        with self.assertRaises(PhysicsState.NoEntityError):
+            ps['Third']
+
+    def test_bulk_accessors(self):
+        """Test that bulk accessors are views of the y-vector."""
+        ps = PhysicsState(None, self.proto_state)
+        self.assertEqual(ps.Fields.shape, (len(_FIELD_ORDERING), 2))
+        np.testing.assert_array_equal(
+            ps.Fields[_FIELD_ORDERING['fuel']], [60, 61])
+        np.testing.assert_array_equal(ps.Positions, [[10, 20], [11, 21]])
+        np.testing.assert_array_equal(ps.Velocities, [[30, 40], [31, 41]])
+
+        ps.Positions = np.array([[1, 2], [3, 4]])
+        self.assertEqual(ps['Second'].y, 4)
+        ps.Velocities[0] = [5, 6]
+        self.assertEqual(ps['First'].vx, 5)
+        self.assertEqual(ps['First'].vy, 6)
+        ps.Fields[_FIELD_ORDERING['throttle']] = 0
+        self.assertEqual(ps['Second'].throttle, 0)
+
+        proto = ps.as_proto()
+        self.assertEqual(proto.entities[1].x, 3)
+        self.assertEqual(proto.entities[1].landed_on, 'First')
+        self.assertTrue(proto.entities[1].broken)
+        self.assertEqual(proto.entities[0].mass, 100)
+
 
 class CalculationsTestCase(unittest.TestCase):
     """Tests instantaneous orbit parameter calculations.
@@ -462,8 +1628,6 @@ class CalculationsTestCase(unittest.TestCase):
 
 def test_performance():
     # This just runs for 10 seconds and collects profiling data.
-    import time
-
     with PhysicsEngine('OCESS.json') as physics_engine:
         physics_engine.handle_requests([
             network.Request(ident=network.Request.TIME_ACC_SET,